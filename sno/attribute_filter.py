@@ -0,0 +1,303 @@
+import decimal
+import operator
+import re
+
+from .schema import Schema
+
+
+_TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+        |(?P<string>'(?:[^']|'')*')
+        |(?P<quoted_name>"(?:[^"]|"")*")
+        |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+        |(?P<symbol><=|>=|<>|!=|==|=|<|>|\(|\)|,)
+    )""",
+    re.VERBOSE,
+)
+
+_KEYWORDS = {"AND", "OR", "NOT", "IS", "NULL", "IN", "LIKE", "TRUE", "FALSE"}
+
+_COMPARISONS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<>": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+_NUMERIC_TYPES = ("integer", "float", "numeric")
+_STRING_TYPES = ("text", "date", "time", "timestamp", "interval")
+
+
+def _tokenize(expression):
+    """Yields (kind, value) for each token in the expression."""
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match:
+            raise ValueError(f"Unexpected character at: {expression[pos:].strip()}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            value = float(value) if re.search(r"[.eE]", value) else int(value)
+        elif kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "quoted_name":
+            kind, value = "name", value[1:-1].replace('""', '"')
+        elif kind == "name" and value.upper() in _KEYWORDS:
+            kind, value = "keyword", value.upper()
+        yield kind, value
+
+
+def _and(a, b):
+    if a is False or b is False:
+        return False
+    if a is None or b is None:
+        return None
+    return True
+
+
+def _or(a, b):
+    if a is True or b is True:
+        return True
+    if a is None or b is None:
+        return None
+    return False
+
+
+def _not(a):
+    return None if a is None else not a
+
+
+class _Parser:
+    """
+    A recursive descent parser, which compiles an expression into a function that takes a tuple
+    of values - one for each column in col_names - and returns True, False or None (unknown).
+    """
+
+    def __init__(self, expression, schema):
+        self.tokens = list(_tokenize(expression))
+        self.pos = 0
+        self.schema = schema
+        self.col_names = []
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, kind, value=None):
+        token_kind, token_value = self.peek()
+        if token_kind == kind and (value is None or token_value == value):
+            self.pos += 1
+            return token_value
+        return None
+
+    def expect(self, kind, value=None):
+        result = self.accept(kind, value)
+        if result is None:
+            found = self.peek()[1]
+            found = "end of expression" if found is None else repr(found)
+            raise ValueError(f"Expected {value or kind}, found {found}")
+        return result
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Empty expression")
+        result = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Unexpected {self.peek()[1]!r}")
+        return result
+
+    def parse_or(self):
+        result = self.parse_and()
+        while self.accept("keyword", "OR"):
+            left, right = result, self.parse_and()
+            result = lambda values, a=left, b=right: _or(a(values), b(values))
+        return result
+
+    def parse_and(self):
+        result = self.parse_not()
+        while self.accept("keyword", "AND"):
+            left, right = result, self.parse_not()
+            result = lambda values, a=left, b=right: _and(a(values), b(values))
+        return result
+
+    def parse_not(self):
+        if self.accept("keyword", "NOT"):
+            inner = self.parse_not()
+            return lambda values: _not(inner(values))
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        if self.accept("symbol", "("):
+            result = self.parse_or()
+            self.expect("symbol", ")")
+            return result
+
+        column = self.parse_column()
+        get = self.value_getter(column)
+
+        if self.accept("keyword", "IS"):
+            negate = bool(self.accept("keyword", "NOT"))
+            self.expect("keyword", "NULL")
+            return lambda values: (get(values) is None) != negate
+
+        negate = bool(self.accept("keyword", "NOT"))
+        if self.accept("keyword", "IN"):
+            self.expect("symbol", "(")
+            literals = {self.parse_literal(column)}
+            while self.accept("symbol", ","):
+                literals.add(self.parse_literal(column))
+            self.expect("symbol", ")")
+            return self.null_safe(get, lambda v: (v in literals) != negate)
+
+        if self.accept("keyword", "LIKE"):
+            if column.data_type not in _STRING_TYPES:
+                raise ValueError(
+                    f"Can't use LIKE on {column.data_type} column {column.name!r}"
+                )
+            pattern = self.parse_literal(column)
+            regex = re.compile(
+                "".join(
+                    ".*" if c == "%" else "." if c == "_" else re.escape(c)
+                    for c in pattern
+                ),
+                re.DOTALL,
+            )
+            return self.null_safe(get, lambda v: bool(regex.fullmatch(v)) != negate)
+
+        if negate:
+            raise ValueError("Expected IN or LIKE after NOT")
+
+        symbol = self.expect("symbol")
+        compare = _COMPARISONS.get(symbol)
+        if compare is None:
+            raise ValueError(f"Expected a comparison, found {symbol!r}")
+        literal = self.parse_literal(column)
+        return self.null_safe(get, lambda v: compare(v, literal))
+
+    def parse_column(self):
+        name = self.expect("name")
+        try:
+            column = self.schema.column_by_name(name)
+        except KeyError:
+            raise ValueError(f"No such column: {name!r}")
+        is_null_test = self.peek() == ("keyword", "IS")
+        if column.data_type in ("geometry", "blob") and not is_null_test:
+            raise ValueError(
+                f"Can't filter on {column.data_type} column {name!r}, except with IS [NOT] NULL"
+            )
+        return column
+
+    def value_getter(self, column):
+        if column.name not in self.col_names:
+            self.col_names.append(column.name)
+        index = self.col_names.index(column.name)
+        if column.data_type == "numeric":
+            # Numeric values are stored as strings, so as not to lose precision.
+            def get(values):
+                value = values[index]
+                return None if value is None else decimal.Decimal(value)
+
+            return get
+        return operator.itemgetter(index)
+
+    def parse_literal(self, column):
+        kind, value = self.peek()
+        if kind == "keyword" and value in ("TRUE", "FALSE"):
+            kind, value = "boolean", value == "TRUE"
+        elif kind not in ("number", "string"):
+            raise ValueError(f"Expected a value to compare {column.name!r} with")
+        self.pos += 1
+
+        data_type = column.data_type
+        if data_type in _NUMERIC_TYPES and kind == "number":
+            return decimal.Decimal(str(value)) if data_type == "numeric" else value
+        if data_type in _STRING_TYPES and kind == "string":
+            return value
+        if data_type == "boolean" and kind == "boolean":
+            return value
+        raise ValueError(
+            f"Can't compare {data_type} column {column.name!r} with {kind} {value!r}"
+        )
+
+    @staticmethod
+    def null_safe(get, predicate):
+        def _predicate(values):
+            value = get(values)
+            return None if value is None else predicate(value)
+
+        return _predicate
+
+
+class AttributeFilter:
+    """
+    Matches features whose attributes satisfy an expression, eg: status = 'proposed' AND area > 1000
+
+    Expressions are a subset of SQL - column names compared against literal values with one of
+    = != <> < <= > >=, [NOT] IN (...), [NOT] LIKE, or IS [NOT] NULL, combined with AND, OR, NOT and
+    parentheses. Column names can be double-quoted, and strings are single-quoted. Comparisons
+    are checked against the dataset schema when the expression is parsed, and as in SQL, a
+    comparison with a NULL value is neither true nor false, so doesn't match either way.
+    """
+
+    def __init__(self, expression, schema):
+        self.expression = expression
+        self.schema = schema
+        parser = _Parser(expression, schema)
+        self._predicate = parser.parse()
+        # The columns referenced by the expression - the only ones that need to be decoded.
+        self.col_names = tuple(parser.col_names)
+
+    def __str__(self):
+        return self.expression
+
+    def __reduce__(self):
+        # The parsed predicate can't be pickled - so it is parsed again when unpickled.
+        return (
+            _parse_attribute_filter,
+            (self.expression, self.schema.to_column_dicts()),
+        )
+
+    def matching_pks(self, feature_tuples):
+        """
+        Given tuples of (pk, *values), where the values are for the columns in col_names, yields
+        the primary key of each that matches.
+        """
+        predicate = self._predicate
+        for pk, *values in feature_tuples:
+            if predicate(values) is True:
+                yield pk
+
+    def scan(self, repo, dataset, num_workers=1):
+        """
+        Yields the primary key of every feature in the dataset that matches. Only the primary key
+        and the columns referenced by the expression are decoded. If num_workers is more than 1,
+        the features are read by that many worker processes, each scanning a different tree of
+        feature blobs (or bucket, for Datasets V3) at a time - and yielded in no particular order.
+        """
+        col_names = (dataset.primary_key,) + self.col_names
+        if dataset.VERSION < 2:
+            yield from self.matching_pks(dataset.feature_tuples(col_names))
+            return
+
+        for pks in dataset.map_feature_shards(
+            repo, _scan_shard, (self,), num_workers=num_workers
+        ):
+            yield from pks
+
+
+def _scan_shard(dataset, shard, attribute_filter):
+    """Returns a list of the primary keys of the matching features in the given shard."""
+    col_names = (dataset.primary_key,) + attribute_filter.col_names
+    features = dataset.decode_shard(shard, keys=False, col_names=col_names)
+    return list(attribute_filter.matching_pks(features))
+
+
+def _parse_attribute_filter(expression, schema_column_dicts):
+    return AttributeFilter(expression, Schema.from_column_dicts(schema_column_dicts))
@@ -6,7 +6,7 @@ from .import_source import ImportSource
 
 class BaseDataset(ImportSource):
     """
-    Common interface for all datasets - so far this is Dataset1, Dataset2 -
+    Common interface for all datasets - so far this is Dataset1, Dataset2, Dataset3 -
     and even Dataset0 (but this is only supported for `sno upgrade`)
     """
 
@@ -18,6 +18,8 @@ class BaseDataset(ImportSource):
 
     META_PATH = None  # Eg ".sno-dataset/meta/"
     FEATURE_PATH = None  # Eg ".sno-dataset/feature/"
+    # Eg ".sno-dataset/value/" - for datasets that support out-of-line values
+    VALUE_PATH = None
 
     def __init__(self, tree, path):
         """
@@ -42,12 +44,15 @@ class BaseDataset(ImportSource):
     def for_version(cls, version):
         from .dataset1 import Dataset1
         from .dataset2 import Dataset2
+        from .dataset3 import Dataset3
 
         version = int(version)
         if version == 1:
             return Dataset1
         elif version == 2:
             return Dataset2
+        elif version == 3:
+            return Dataset3
 
         raise ValueError(f"No Dataset implementation found for version={version}")
 
@@ -55,6 +60,11 @@ class BaseDataset(ImportSource):
         # ImportSource method - by default, a dataset should import with the same path it already has.
         return self.path
 
+    @property
+    def estimated_feature_count(self):
+        # ImportSource method - datasets can count their features without reading them.
+        return self.feature_count
+
     @classmethod
     def is_dataset_tree(cls, tree):
         """
@@ -114,6 +124,17 @@ class BaseDataset(ImportSource):
         else:
             raise KeyError(f"No data found at rel-path {rel_path}, type={type(leaf)}")
 
+    def get_blob_id_at(self, rel_path):
+        """
+        Return the OID of the blob at the given relative path from within this dataset,
+        or None if there is no blob at that path. Unlike get_data_at, the blob data is not read.
+        """
+        try:
+            leaf = self.tree / str(rel_path)
+        except KeyError:
+            return None
+        return leaf.id if leaf.type_str == "blob" else None
+
     def full_path(self, rel_path):
         """Given a path relative to this dataset, returns its full path from the repo root."""
         return f"{self.path}/{rel_path}"
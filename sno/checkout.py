@@ -9,6 +9,8 @@ from .exceptions import (
     NO_WORKING_COPY,
 )
 
+from .cli_util import SpatialFilterType
+from .spatial_filter import SpatialFilter
 from .structure import RepositoryStructure
 from .structs import CommitWithReference
 from .working_copy import WorkingCopy
@@ -19,21 +21,66 @@ _DISCARD_CHANGES_HELP_MESSAGE = (
 )
 
 
-def reset_wc_if_needed(repo, target_tree_or_commit, *, discard_changes=False):
-    """Resets the working copy to the target if it does not already match, or if discard_changes is True."""
+_SPATIAL_FILTER_HELP = (
+    "Only check out features that intersect the given polygon - CRS;GEOMETRY where CRS is eg EPSG:4326 "
+    "and GEOMETRY is a polygon in WKT or a bounding box MIN_X,MIN_Y,MAX_X,MAX_Y - or read it from a file "
+    "with @FILENAME. Use 'none' to remove an existing spatial filter."
+)
+
+
+def reset_wc_if_needed(
+    repo,
+    target_tree_or_commit,
+    *,
+    discard_changes=False,
+    rewrite=False,
+    spatial_filter=None,
+):
+    """
+    Resets the working copy to the target if it does not already match, or if discard_changes is True.
+    If rewrite is True, every table is dropped and written again - eg, because the spatial filter changed.
+    spatial_filter - a new SpatialFilter, or False to remove it, or None to leave it unchanged. It is only
+    stored in the repo config once the working copy has been written with it - see update_spatial_filter.
+    """
     working_copy = WorkingCopy.get(repo, allow_uncreated=True)
     if working_copy is None:
         click.echo(
             "(Bare sno repository - to create a working copy, use `sno create-workingcopy`)"
         )
+        update_spatial_filter(repo, spatial_filter)
         return
 
+    if spatial_filter is not None:
+        working_copy.spatial_filter = spatial_filter or None
+    _reset_wc(
+        repo,
+        working_copy,
+        target_tree_or_commit,
+        discard_changes=discard_changes,
+        rewrite=rewrite,
+    )
+    update_spatial_filter(repo, spatial_filter)
+
+
+def _reset_wc(repo, working_copy, target_tree_or_commit, *, discard_changes, rewrite):
     if not working_copy.is_initialised():
         click.echo(f"Creating working copy at {working_copy.path} ...")
         working_copy.create_and_initialise()
         datasets = list(RepositoryStructure(repo))
         working_copy.write_full(target_tree_or_commit, *datasets, safe=False)
 
+    elif rewrite:
+        click.echo(f"Rewriting {working_copy.path} ...")
+        base_datasets = list(
+            RepositoryStructure.lookup(repo, working_copy.get_db_tree())
+        )
+        working_copy.drop_table(target_tree_or_commit, *base_datasets)
+        target_datasets = list(
+            RepositoryStructure(repo, tree=target_tree_or_commit.peel(pygit2.Tree))
+        )
+        working_copy.write_full(target_tree_or_commit, *target_datasets)
+        return
+
     db_tree_matches = (
         working_copy.get_db_tree() == target_tree_or_commit.peel(pygit2.Tree).hex
     )
@@ -43,6 +90,21 @@ def reset_wc_if_needed(repo, target_tree_or_commit, *, discard_changes=False):
         working_copy.reset(target_tree_or_commit, force=discard_changes)
 
 
+def update_spatial_filter(repo, spatial_filter):
+    """
+    Stores the given spatial filter in the repo config - spatial_filter is a SpatialFilter, or False to
+    remove it, or None to leave it unchanged. Returns True if it changed, in which case the working copy
+    needs to be rewritten.
+    """
+    if spatial_filter is None:
+        return False
+    spatial_filter = spatial_filter or None
+    if spatial_filter == SpatialFilter.from_config(repo):
+        return False
+    SpatialFilter.write_config(repo, spatial_filter)
+    return True
+
+
 @click.command()
 @click.pass_context
 @click.option("new_branch", "-b", help="Name for new branch")
@@ -63,8 +125,9 @@ def reset_wc_if_needed(repo, target_tree_or_commit, *, discard_changes=False):
     help="If a local branch of given name doesn't exist, but a remote does, "
     "this option guesses that the user wants to create a local to track the remote",
 )
+@click.option("--spatial-filter", type=SpatialFilterType(), help=_SPATIAL_FILTER_HELP)
 @click.argument("refish", default=None, required=False)
-def checkout(ctx, new_branch, force, discard_changes, do_guess, refish):
+def checkout(ctx, new_branch, force, discard_changes, do_guess, spatial_filter, refish):
     """ Switch branches or restore working tree files """
     repo = ctx.obj.repo
 
@@ -99,7 +162,13 @@ def checkout(ctx, new_branch, force, discard_changes, do_guess, refish):
     same_commit = repo.head.peel(pygit2.Commit) == commit
 
     force = force or discard_changes
-    if not same_commit and not force:
+    # A spatial_filter of False means the filter is being removed.
+    new_spatial_filter = spatial_filter or None
+    spatial_filter_changed = (
+        spatial_filter is not None
+        and new_spatial_filter != SpatialFilter.from_config(repo)
+    )
+    if (not same_commit or spatial_filter_changed) and not force:
         ctx.obj.check_not_dirty(help_message=_DISCARD_CHANGES_HELP_MESSAGE)
 
     if new_branch:
@@ -122,7 +191,13 @@ def checkout(ctx, new_branch, force, discard_changes, do_guess, refish):
         head_ref = new_branch.name
 
     WorkingCopy.ensure_config_exists(repo)
-    reset_wc_if_needed(repo, commit, discard_changes=discard_changes)
+    reset_wc_if_needed(
+        repo,
+        commit,
+        discard_changes=discard_changes,
+        rewrite=spatial_filter_changed,
+        spatial_filter=spatial_filter,
+    )
 
     repo.set_head(head_ref)
 
@@ -317,8 +392,9 @@ def restore(ctx, source, pathspec):
     is_flag=True,
     help="Discard local changes in working copy if necessary",
 )
+@click.option("--spatial-filter", type=SpatialFilterType(), help=_SPATIAL_FILTER_HELP)
 @click.argument("wc_path", nargs=1, required=False)
-def create_workingcopy(ctx, discard_changes, wc_path):
+def create_workingcopy(ctx, discard_changes, spatial_filter, wc_path):
     """
     Create a new working copy - if one already exists it will be deleted.
     Usage: sno create-workingcopy [PATH]
@@ -363,4 +439,4 @@ def create_workingcopy(ctx, discard_changes, wc_path):
         new_wc.delete(keep_container_if_possible=True)
 
     head_commit = repo.head.peel(pygit2.Commit)
-    reset_wc_if_needed(repo, head_commit)
+    reset_wc_if_needed(repo, head_commit, spatial_filter=spatial_filter)
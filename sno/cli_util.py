@@ -2,6 +2,10 @@ import json
 import click
 import jsonschema
 
+from .out_of_line import OutOfLine
+from .path_structure import PathStructure
+from .spatial_filter import SpatialFilter
+
 
 def add_help_subcommand(group):
     @group.command(add_help_option=False, hidden=True)
@@ -115,6 +119,54 @@ class JsonFromFile(StringFromFile):
         return value
 
 
+class PathStructureType(click.ParamType):
+    """A path structure spec - either "auto", or "LEVELSxBRANCHES" eg "3x256". See PathStructure."""
+
+    name = "path-structure"
+
+    def convert(self, value, param, ctx):
+        if not isinstance(value, str):
+            return value
+        try:
+            return PathStructure.parse(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
+class OutOfLineType(click.ParamType):
+    """An out-of-line spec - "none", "geometry", MIN_SIZE, or "geometry,MIN_SIZE". See OutOfLine."""
+
+    name = "out-of-line"
+
+    def convert(self, value, param, ctx):
+        if not isinstance(value, str):
+            return value
+        try:
+            return OutOfLine.parse(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
+class SpatialFilterType(StringFromFile):
+    """
+    A spatial filter spec - CRS;GEOMETRY - see SpatialFilter. Or "none", for no spatial filter,
+    which is converted to False so that it can be told apart from the option not being given.
+    """
+
+    name = "spatial-filter"
+
+    def convert(self, value, param, ctx):
+        if not isinstance(value, str):
+            return value
+        value = super().convert(value, param, ctx).strip()
+        if value.lower() == "none":
+            return False
+        try:
+            return SpatialFilter.parse(value)
+        except ValueError as e:
+            self.fail(str(e), param, ctx)
+
+
 def call_and_exit_flag(*args, callback, is_eager=True, **kwargs):
     """
     Add an is_flag option that, when set, eagerly calls the given callback with only the context as a parameter.
@@ -112,6 +112,7 @@ def commit(ctx, message, allow_empty, output_format, filters):
 
     working_copy.reset_tracking_table(commit_filter)
     working_copy.update_state_table_tree(new_commit.peel(pygit2.Tree).id.hex)
+    working_copy.delete_features_outside_spatial_filter(wc_diff)
 
     jdict = commit_obj_to_json(new_commit, repo, wc_diff)
     if do_json:
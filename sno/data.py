@@ -1,12 +1,19 @@
 import sys
 
 import click
+import pygit2
 
 from . import status
-from .cli_util import add_help_subcommand
+from .cli_util import add_help_subcommand, PathStructureType
+from .core import check_git_user
+from .dataset_stats import DatasetStatsCache
+from .exceptions import NotFound, NO_TABLE
+from .fast_import import reshard_datasets
 from .output_util import dump_json_output
+from .path_structure import PathStructure
 from .structure import RepositoryStructure
 from .repo_files import RepoState
+from .working_copy import WorkingCopy
 
 
 # Changing these items would generally break the repo;
@@ -27,26 +34,56 @@ def data(ctx, **kwargs):
     type=click.Choice(["text", "json"]),
     default="text",
 )
+@click.option(
+    "--with-stats",
+    is_flag=True,
+    help=(
+        "Also show the number of features, the extent and the total size of each dataset. "
+        "These are cached, so are only slow to calculate the first time."
+    ),
+)
 @click.argument("refish", required=False, default="HEAD")
 @click.pass_context
-def data_ls(ctx, output_format, refish):
+def data_ls(ctx, output_format, with_stats, refish):
     """List all of the datasets in the sno repository"""
     repo = ctx.obj.get_repo(allowed_states=RepoState.ALL_STATES)
+    ds_stats = {}
     if repo.is_empty:
         ds_paths = []
     else:
         rs = RepositoryStructure.lookup(repo, refish)
-        ds_paths = [ds.path for ds in rs]
+        ds_paths = []
+        stats_cache = DatasetStatsCache(repo)
+        for ds in rs:
+            ds_paths.append(ds.path)
+            if with_stats:
+                ds_stats[ds.path] = stats_cache.get_stats(ds, rs.head_commit)
+        stats_cache.save()
 
     if output_format == "text":
         if ds_paths:
             for ds_path in ds_paths:
                 click.echo(ds_path)
+                if with_stats:
+                    _echo_stats(ds_stats[ds_path])
         else:
             ctx.invoke(status.status)
 
     elif output_format == "json":
-        dump_json_output({"sno.data.ls/v1": ds_paths}, sys.stdout)
+        output = {"sno.data.ls/v1": ds_paths}
+        if with_stats:
+            output["sno.data.stats/v1"] = {
+                ds_path: stats.to_json() for ds_path, stats in ds_stats.items()
+            }
+        dump_json_output(output, sys.stdout)
+
+
+def _echo_stats(stats):
+    click.echo(f"    Features: {stats.feature_count:,d}")
+    if stats.extent is not None:
+        min_x, max_x, min_y, max_y = stats.extent
+        click.echo(f"    Extent: ({min_x}, {min_y}) - ({max_x}, {max_y})")
+    click.echo(f"    Size: {stats.blob_bytes:,d} bytes")
 
 
 @data.command(name="version")
@@ -69,3 +106,57 @@ def data_version(ctx, output_format):
             )
     elif output_format == "json":
         dump_json_output({"sno.data.version": version}, sys.stdout)
+
+
+@data.command(name="reshard")
+@click.option(
+    "--path-structure",
+    type=PathStructureType(),
+    help=(
+        "How features should be sharded into trees: 'auto' to choose based on the number of "
+        "features, or LEVELSxBRANCHES eg '3x256'. Defaults to the sno.dataset.pathStructure "
+        "config, or 'auto'."
+    ),
+)
+@click.option("--message", "-m", help="Use the given message as the commit message.")
+@click.argument("datasets", nargs=-1)
+@click.pass_context
+def data_reshard(ctx, path_structure, message, datasets):
+    """
+    Change how the features of datasets are sharded into trees, and commit the result.
+    Features are moved, not rewritten, so this is much quicker than re-importing them.
+
+    Reshards every dataset, unless one or more DATASETS are given.
+    """
+    repo = ctx.obj.repo
+    check_git_user(repo)
+
+    working_copy = WorkingCopy.get(repo)
+    if working_copy:
+        working_copy.assert_db_tree_match(repo.head.peel(pygit2.Tree))
+        working_copy.check_not_dirty()
+
+    if path_structure is None:
+        path_structure = PathStructure.spec_from_config(repo) or PathStructure.AUTO
+
+    rs = RepositoryStructure(repo)
+    if datasets:
+        ds_list = []
+        for ds_path in datasets:
+            dataset = rs.get(ds_path)
+            if dataset is None:
+                raise NotFound(
+                    f"No valid dataset found at '{ds_path}'", exit_code=NO_TABLE
+                )
+            ds_list.append(dataset)
+    else:
+        ds_list = list(rs)
+
+    new_structures = reshard_datasets(repo, ds_list, path_structure, message=message)
+
+    if working_copy:
+        # Only the paths of the features have changed, so the working copy is still up to date.
+        working_copy.update_state_table_tree(repo.head.peel(pygit2.Tree).id.hex)
+
+    for ds_path, new_structure in new_structures.items():
+        click.echo(f"Resharded {ds_path}/ to {new_structure}")
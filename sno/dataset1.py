@@ -198,6 +198,16 @@ class Dataset1(RichBaseDataset):
 
             yield tupleizer(blob)
 
+    def get_feature_tuples_by_oid(self, repo, pk_oids, col_names):
+        """
+        Like get_feature_tuples, but takes (pk, blob-oid) pairs for the features - as found in a diff
+        of two feature trees - so the blobs are read straight from the object database, and no paths
+        need be looked up. Features are yielded in the same order as pk_oids.
+        """
+        tupleizer = self.build_feature_tupleizer(col_names)
+        for pk, oid in pk_oids:
+            yield tupleizer(repo[oid], pk)
+
     def build_feature_tupleizer(self, tuple_cols):
         field_cid_map = self.field_cid_map
 
@@ -209,7 +219,10 @@ class Dataset1(RichBaseDataset):
                 ftuple_order.append(field_cid_map[field_name])
         ftuple_order = tuple(ftuple_order)
 
-        def tupleizer(blob):
+        def tupleizer(blob, pk_value=None):
+            # The pk_value is decoded from the blob's name, unless it is supplied.
+            if pk_value is None and -1 in ftuple_order:
+                pk_value = self.decode_path_to_1pk(blob.name)
             bin_feature = msgpack.unpackb(
                 blob.data,
                 ext_hook=self._msgpack_unpack_ext,
@@ -217,10 +230,7 @@ class Dataset1(RichBaseDataset):
                 use_list=False,
             )
             return tuple(
-                [
-                    self.decode_path_to_1pk(blob.name) if c == -1 else bin_feature[c]
-                    for c in ftuple_order
-                ]
+                [pk_value if c == -1 else bin_feature[c] for c in ftuple_order]
             )
 
         return tupleizer
@@ -359,8 +369,13 @@ class Dataset1(RichBaseDataset):
                 json.dumps(value).encode("utf8"),
             )
 
-    def import_iter_feature_blobs(self, resultset, source, replacing_dataset=None):
-        """For the given import source, yields the feature blobs that should be written."""
+    def import_iter_feature_blobs(
+        self, resultset, source, replacing_dataset=None, num_workers=1
+    ):
+        """
+        For the given import source, yields the feature blobs that should be written.
+        Features are always encoded serially - num_workers is ignored for V1 datasets.
+        """
         pk_field = source.primary_key
 
         field_cid_map = self.get_field_cid_map(source)
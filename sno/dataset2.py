@@ -1,4 +1,7 @@
+import collections
 import functools
+import itertools
+import multiprocessing
 import os
 
 import click
@@ -7,7 +10,11 @@ import pygit2
 from . import crs_util, gpkg_adapter
 from .rich_base_dataset import RichBaseDataset
 from .exceptions import InvalidOperation, NotYetImplemented, PATCH_DOES_NOT_APPLY
+from .feature_cache import feature_cache
+from .geometry import Geometry
 from .meta_items import META_ITEM_NAMES
+from .out_of_line import OutOfLine
+from .path_structure import PathStructure
 from .schema import Legend, Schema
 from .serialise_util import (
     msg_pack,
@@ -19,10 +26,12 @@ from .serialise_util import (
     hexhash,
     ensure_bytes,
     ensure_text,
+    HashedBlob,
+    ValueRef,
 )
 
 
-def find_blobs_in_tree(tree, max_depth=4):
+def find_blobs_in_tree(tree, max_depth=PathStructure.MAX_LEVELS):
     """
     Recursively yields possible blobs in the given directory tree,
     up to a given max_depth.
@@ -38,6 +47,48 @@ def find_blobs_in_tree(tree, max_depth=4):
 _blob_to_memoryview = memoryview
 
 
+# The dataset and schema that each worker process of import_iter_feature_blobs encodes features with.
+_encode_worker_state = {}
+
+
+def _init_encode_worker(
+    dataset_class, dataset_path, path_structure, out_of_line, schema_column_dicts
+):
+    dataset = dataset_class(tree=None, path=dataset_path)
+    dataset.path_structure = PathStructure(*path_structure)
+    dataset.out_of_line = OutOfLine(*out_of_line)
+    _encode_worker_state["dataset"] = dataset
+    _encode_worker_state["schema"] = Schema.from_column_dicts(schema_column_dicts)
+
+
+def _encode_feature_batch(features):
+    dataset = _encode_worker_state["dataset"]
+    schema = _encode_worker_state["schema"]
+    return [
+        blob
+        for feature in features
+        for blob in dataset.encode_feature_blobs(feature, schema)
+    ]
+
+
+# The dataset, and the function and arguments that each worker process of Dataset2.map_feature_shards
+# applies to every shard it is given.
+_shard_worker_state = {}
+
+
+def _init_shard_worker(repo_path, dataset_class, dataset_path, tree_id, func, args):
+    repo = pygit2.Repository(repo_path)
+    _shard_worker_state["repo"] = repo
+    _shard_worker_state["dataset"] = dataset_class(repo[tree_id], dataset_path)
+    _shard_worker_state["func"] = func
+    _shard_worker_state["args"] = args
+
+
+def _map_shard(shard_id):
+    state = _shard_worker_state
+    return state["func"](state["dataset"], state["repo"][shard_id], *state["args"])
+
+
 class Dataset2(RichBaseDataset):
     """
     - Uses messagePack to serialise features.
@@ -53,9 +104,25 @@ class Dataset2(RichBaseDataset):
             [legend-b-hash]   = [column-id0, column-id1, ...]
             ...
 
-        [hex(pk-hash):2]/
+        feature/
           [hex(pk-hash):2]/
-            [base64(pk-value)]  = [msgpack([legend-x-hash, value0, value1, ...])]
+            [hex(pk-hash):2]/
+              [base64(pk-value)]  = [msgpack([legend-x-hash, value0, value1, ...])]
+
+    The number of levels of trees that features are sharded into, and the number of branches at each
+    level, can be changed per dataset - see PathStructure. This is recorded at meta/path-structure.json,
+    if it isn't the default shown above.
+
+    Optionally, some values - eg geometries - can be stored out-of-line, each in a blob of its own,
+    which the feature blob refers to by OID - see OutOfLine. This is recorded at meta/out-of-line.json.
+    The value blobs of a feature are stored in a tree with the same path as the feature blob, but in
+    value/ instead of feature/:
+
+        value/
+          [hex(pk-hash):2]/
+            [hex(pk-hash):2]/
+              [base64(pk-value)]/
+                [hex(value-blob-oid)]  = [msgpack(value)]
 
     Dataset2 is initialised pointing at a particular directory tree, and uses that
     to read features and schemas. However, it never writes to the tree, since this
@@ -71,6 +138,7 @@ class Dataset2(RichBaseDataset):
 
     FEATURE_PATH = DATASET_PATH + "feature/"
     META_PATH = DATASET_PATH + "meta/"
+    VALUE_PATH = DATASET_PATH + "value/"
 
     LEGEND_DIRNAME = "legend"
     LEGEND_PATH = META_PATH + "legend/"
@@ -84,10 +152,74 @@ class Dataset2(RichBaseDataset):
     METADATA_PATH = META_PATH + "metadata/"
     DATASET_METADATA_PATH = METADATA_PATH + "dataset.json"
 
+    PATH_STRUCTURE_PATH = META_PATH + "path-structure.json"
+    OUT_OF_LINE_PATH = META_PATH + "out-of-line.json"
+
+    _path_structure = None
+    _out_of_line = None
+
+    @property
+    def path_structure(self):
+        """The PathStructure that this dataset's features are stored in."""
+        if self._path_structure is None:
+            data = None
+            if self.tree is not None:
+                data = self.get_data_at(self.PATH_STRUCTURE_PATH, missing_ok=True)
+            if data is not None:
+                self._path_structure = PathStructure.from_json(json_unpack(data))
+            else:
+                self._path_structure = PathStructure.DEFAULT
+        return self._path_structure
+
+    @path_structure.setter
+    def path_structure(self, path_structure):
+        """Sets the PathStructure that features are encoded with - for datasets that aren't yet written."""
+        self._path_structure = path_structure
+
+    def encode_path_structure(self):
+        """
+        Returns the path and the data which *should be written* to record this dataset's path structure -
+        or None for the data, if it is the default, since then nothing should be written.
+        """
+        path_structure = self.path_structure
+        data = None
+        if path_structure != PathStructure.DEFAULT:
+            data = json_pack(path_structure.to_json())
+        return self.full_path(self.PATH_STRUCTURE_PATH), data
+
+    @property
+    def out_of_line(self):
+        """The OutOfLine that says which values of new features are stored out-of-line."""
+        if self._out_of_line is None:
+            data = None
+            if self.tree is not None:
+                data = self.get_data_at(self.OUT_OF_LINE_PATH, missing_ok=True)
+            if data is not None:
+                self._out_of_line = OutOfLine.from_json(json_unpack(data))
+            else:
+                self._out_of_line = OutOfLine.NONE
+        return self._out_of_line
+
+    @out_of_line.setter
+    def out_of_line(self, out_of_line):
+        """Sets the OutOfLine that features are encoded with - for datasets that aren't yet written."""
+        self._out_of_line = out_of_line
+
+    def encode_out_of_line(self):
+        """
+        Returns the path and the data which *should be written* to record which values this dataset stores
+        out-of-line - or None for the data, if none are, since then nothing should be written.
+        """
+        out_of_line = self.out_of_line
+        data = None
+        if out_of_line.enabled:
+            data = json_pack(out_of_line.to_json())
+        return self.full_path(self.OUT_OF_LINE_PATH), data
+
     @functools.lru_cache()
     def get_meta_item(self, name):
         if name == "version":
-            return 2
+            return self.VERSION
 
         rel_path = self.META_PATH + name
         data = self.get_data_at(rel_path, missing_ok=name in META_ITEM_NAMES)
@@ -143,19 +275,54 @@ class Dataset2(RichBaseDataset):
         """
         return self.full_path(self.SCHEMA_PATH), schema.dumps()
 
-    def get_raw_feature_dict(self, pk_values=None, *, path=None, data=None):
+    def get_raw_feature_dict(
+        self, pk_values=None, *, path=None, data=None, resolve_refs=True
+    ):
         """
         Gets the feature with the given primary key(s) / at the given "full" path.
         The result is a "raw" feature dict, values are keyed by column ID,
         and contains exactly those values that are actually stored in the tree,
         which might not be the same values that are now in the schema.
         To get a feature consistent with the current schema, call get_feature.
+        If resolve_refs is False, any values stored out-of-line are returned as ValueRefs -
+        two ValueRefs are equal only if the values they refer to are equal, so they can be
+        compared without reading the values.
         """
+        legend, pk_values, non_pk_values = self._get_feature_values(
+            pk_values, path, data, resolve_refs=resolve_refs
+        )
+        return legend.value_tuples_to_raw_dict(pk_values, non_pk_values)
 
+    def _get_feature_values(self, pk_values, path, data, resolve_refs=True):
+        """
+        Returns the stored values of the feature with the given primary key(s) / at the given
+        "full" path, as a tuple (legend, pk_values, non_pk_values). See get_raw_feature_dict.
+        """
+        # Similarly to pk_values and path, if the caller knows data, they can supply that too
+        # to avoid redundant work.
+        if data is None:
+            pk_values, rel_path = self._get_feature_pks_and_path(pk_values, path)
+            data = self._get_feature_data(rel_path)
+        elif pk_values is not None:
+            pk_values = self.schema.sanitise_pks(pk_values)
+        elif path is not None:
+            pk_values = self.decode_path_to_pks(path)
+        else:
+            raise ValueError("Either <pk_values> or <path> must be supplied")
+
+        legend_hash, non_pk_values = msg_unpack(data)
+        if resolve_refs:
+            non_pk_values = self._resolve_value_refs(pk_values, non_pk_values)
+        return self.get_legend(legend_hash), pk_values, non_pk_values
+
+    def _get_feature_pks_and_path(self, pk_values, path):
+        """
+        Returns (pk_values, rel_path) for the feature with the given primary key(s) / at the given
+        "full" path.
+        """
         # The caller must supply at least one of (pk_values, path) so we know which
         # feature is meant. We can infer whichever one is missing from the one supplied.
         # If the caller knows both already, they can supply both, to avoid redundant work.
-        # Similarly, if the caller knows data, they can supply that too to avoid redundant work.
         if pk_values is None and path is None:
             raise ValueError("Either <pk_values> or <path> must be supplied")
 
@@ -164,16 +331,65 @@ class Dataset2(RichBaseDataset):
         else:
             pk_values = self.decode_path_to_pks(path)
 
-        if data is None:
-            if path is not None:
-                rel_path = self.ensure_rel_path(path)
-            else:
-                rel_path = self.encode_pks_to_path(pk_values, relative=True)
-            data = self.get_data_at(rel_path, as_memoryview=True)
+        if path is not None:
+            rel_path = self.ensure_rel_path(path)
+        else:
+            rel_path = self.encode_pks_to_path(pk_values, relative=True)
+        return pk_values, rel_path
 
-        legend_hash, non_pk_values = msg_unpack(data)
-        legend = self.get_legend(legend_hash)
-        return legend.value_tuples_to_raw_dict(pk_values, non_pk_values)
+    def _get_feature_data(self, rel_path):
+        """Returns the stored data of the feature at the given path, relative to this dataset."""
+        return self.get_data_at(rel_path, as_memoryview=True)
+
+    def _get_feature_blob(self, rel_path):
+        """
+        Returns the blob of the feature at the given path, relative to this dataset -
+        or None, if features aren't stored in a blob each. Raises KeyError if there is no feature.
+        """
+        return self.tree / rel_path
+
+    def has_out_of_line_values(self):
+        """Returns True if any of this dataset's features have values that are stored out-of-line."""
+        return self.tree is not None and self.VALUE_PATH in self.tree
+
+    def _resolve_value_refs(self, pk_values, non_pk_values):
+        """
+        Returns the given non_pk_values of the feature with the given pk_values, with any ValueRefs
+        replaced by the values they refer to, which are read from the feature's value tree.
+        """
+        if not any(isinstance(v, ValueRef) for v in non_pk_values):
+            return non_pk_values
+        feature_path = self.encode_pks_to_path(pk_values, relative=True)
+        value_path = self.feature_value_path(feature_path)
+        return [
+            self._get_value(value_path, v) if isinstance(v, ValueRef) else v
+            for v in non_pk_values
+        ]
+
+    def _get_value(self, value_path, value_ref):
+        """Returns the value that the given ValueRef refers to, from the given value tree."""
+        path = f"{value_path}/{value_ref.blob_id}"
+        return msg_unpack(self.get_data_at(path, as_memoryview=True))
+
+    def feature_value_path(self, feature_path):
+        """
+        Given the path of a feature blob - either full or relative to this dataset - returns the path
+        of the tree that holds the feature's out-of-line values, which is full or relative to match.
+        """
+        prefix, sep, suffix = feature_path.partition(self.FEATURE_PATH)
+        if not sep:
+            raise ValueError(f"Not a feature path: {feature_path}")
+        return f"{prefix}{self.VALUE_PATH}{suffix}"
+
+    def get_value_blobs(self, feature_path):
+        """
+        Yields the blobs in the value tree of the feature at the given path, relative to this dataset.
+        """
+        if not self.has_out_of_line_values():
+            return
+        value_path = self.feature_value_path(feature_path)
+        if value_path in self.tree:
+            yield from self.tree / value_path
 
     def get_feature(self, pk_values=None, *, path=None, data=None, keys=True):
         """
@@ -181,26 +397,149 @@ class Dataset2(RichBaseDataset):
         The result is either a dict of values keyed by column name (if keys=True)
         or a tuple of values in schema order (if keys=False).
         """
-        raw_dict = self.get_raw_feature_dict(pk_values=pk_values, path=path, data=data)
-        return self.schema.feature_from_raw_dict(raw_dict, keys=keys)
+        if data is None:
+            pk_values, rel_path = self._get_feature_pks_and_path(pk_values, path)
+            blob = self._get_feature_blob(rel_path)
+            if blob is not None:
+                # Decoded via the feature cache - see _decode_feature_blobs.
+                pk_blobs = [(pk_values, blob)]
+                return next(self._decode_feature_blobs(pk_blobs, keys, None))
+            path = rel_path
+
+        legend, pk_values, non_pk_values = self._get_feature_values(
+            pk_values, path, data
+        )
+        decode = self.schema.feature_decoder(legend, keys=keys)
+        return decode(pk_values, non_pk_values)
+
+    def feature_shards(self):
+        """
+        Yields every object that the features of this dataset are sharded into, so that they can be
+        read in parallel - for Datasets V2, every tree that directly contains feature blobs, or
+        for Datasets V3, every bucket blob. See decode_shard.
+        Features are always stored the same number of levels deep - see encode_pks_to_path - so the
+        tree is walked directly, without checking the type of every entry.
+        """
+        if self.FEATURE_PATH not in self.tree:
+            return
+        shards = [self.tree / self.FEATURE_PATH]
+        for i in range(self.path_structure.levels):
+            shards = itertools.chain.from_iterable(shards)
+        yield from shards
 
-    def features(self, keys=True, fast=None):
+    def decode_shard(self, shard, keys=True, col_names=None):
         """
-        Returns a generator that calls get_feature once per feature.
-        Each entry in the generator is the path of the feature and then the feature itself.
+        Yields the features stored in the given shard - see feature_shards - the same way as
+        decode_feature_blobs yields the features stored in blobs.
         """
+        return self.decode_feature_blobs(shard, keys=keys, col_names=col_names)
 
-        # TODO: optimise.
-        if self.FEATURE_PATH not in self.tree:
+    def map_feature_shards(self, repo, func, args=(), *, num_workers=1):
+        """
+        Yields func(self, shard, *args) for every shard of this dataset - see feature_shards.
+        If num_workers is more than 1, the shards are handed out to that many worker processes, each
+        of which opens the dataset itself - so func must be a module-level function, args must be
+        picklable, and the results are yielded in no particular order.
+        """
+        if num_workers <= 1:
+            for shard in self.feature_shards():
+                yield func(self, shard, *args)
             return
-        for blob in find_blobs_in_tree(self.tree / self.FEATURE_PATH):
-            yield self.get_feature(path=blob.name, data=blob.data, keys=keys)
+
+        shard_ids = (shard.hex for shard in self.feature_shards())
+        with multiprocessing.Pool(
+            num_workers,
+            initializer=_init_shard_worker,
+            initargs=(repo.path, type(self), self.path, self.tree.hex, func, args),
+        ) as pool:
+            yield from pool.imap_unordered(_map_shard, shard_ids, chunksize=16)
+
+    def decode_feature_blobs(self, blobs, keys=True, col_names=None):
+        """
+        Yields the feature stored in each of the given feature blobs - either as a dict of values
+        keyed by column name (if keys=True), or as a tuple of values in schema order (if keys=False).
+        If col_names is supplied, only those columns are decoded, and they are returned in that order.
+        """
+        pk_blobs = ((msg_unpack(b64decode_str(blob.name)), blob) for blob in blobs)
+        return self._decode_feature_blobs(pk_blobs, keys, col_names, cache=False)
+
+    def _decode_feature_blobs(self, pk_blobs, keys, col_names, cache=True):
+        """
+        Like decode_feature_blobs, but takes (pk_values, blob) pairs - for when the blobs weren't
+        found in a tree, and so don't have names that the primary key values can be decoded from.
+        If cache is True and every column is wanted, features are looked up in and added to the
+        process-wide feature_cache, so that a feature blob that is read again isn't decoded again.
+        Reading every feature in a dataset shouldn't use the cache - it would just evict everything else.
+        """
+        schema = self.schema
+        if col_names is not None:
+            col_names = tuple(col_names)
+            columns = [schema.column_by_name(name) for name in col_names]
+            if all(c.pk_index is not None for c in columns):
+                # Only primary key values are needed - these are decoded from the blob's name,
+                # so the blob itself is never read.
+                decode = schema.feature_decoder(schema.legend, keys, col_names)
+                for pk_values, blob in pk_blobs:
+                    yield decode(pk_values, ())
+                return
+            skip_geometry = not any(c.data_type == "geometry" for c in columns)
+        else:
+            skip_geometry = False
+
+        # Cached features are tuples of values in schema order, which are zipped with the
+        # column names if keys=True - so they are decoded with keys=False.
+        cache = cache and col_names is None
+        decode_keys = keys and not cache
+        names = [c.name for c in schema.columns] if keys else None
+
+        resolve_refs = self.has_out_of_line_values()
+        decoders = {}
+        for pk_values, blob in pk_blobs:
+            cache_key = None
+            if cache and isinstance(blob, pygit2.Blob):
+                cache_key = (blob.id, tuple(pk_values), schema)
+                feature = feature_cache.get(cache_key)
+                if feature is not None:
+                    yield dict(zip(names, feature)) if keys else feature
+                    continue
+
+            legend_hash, non_pk_values = msg_unpack(
+                _blob_to_memoryview(blob), skip_geometry=skip_geometry
+            )
+            if resolve_refs:
+                non_pk_values = self._resolve_value_refs(pk_values, non_pk_values)
+            # Looking up the decoder by legend hash here is quicker than hashing the legend itself.
+            decode = decoders.get(legend_hash)
+            if decode is None:
+                legend = self.get_legend(legend_hash)
+                decode = decoders[legend_hash] = schema.feature_decoder(
+                    legend, decode_keys, col_names
+                )
+            feature = decode(pk_values, non_pk_values)
+            if cache_key is not None:
+                feature_cache.put(cache_key, feature)
+            yield dict(zip(names, feature)) if keys and cache else feature
+
+    def features(self, keys=True, fast=None):
+        """
+        Yields every feature in this dataset - either as a dict of values keyed by column name
+        (if keys=True), or as a tuple of values in schema order (if keys=False).
+        """
+        blobs = itertools.chain.from_iterable(self.feature_shards())
+        return self.decode_feature_blobs(blobs, keys=keys)
+
+    def feature_tuples(self, col_names=None, **kwargs):
+        """
+        Optimised feature iterator yielding tuples, ordered by the columns from col_names -
+        or in schema order, if col_names is None, as when this dataset is an import source.
+        Only the requested columns are decoded - see decode_feature_blobs.
+        """
+        blobs = itertools.chain.from_iterable(self.feature_shards())
+        return self.decode_feature_blobs(blobs, keys=False, col_names=col_names)
 
     @property
     def feature_count(self):
-        if self.FEATURE_PATH not in self.tree:
-            return 0
-        return sum(1 for blob in find_blobs_in_tree(self.tree / self.FEATURE_PATH))
+        return sum(len(blob_tree) for blob_tree in self.feature_shards())
 
     @classmethod
     def decode_path_to_pks(cls, path):
@@ -220,34 +559,91 @@ class Dataset2(RichBaseDataset):
         Given a "raw" feature dict (keyed by column IDs) and a legend, returns the path
         and the data which *should be written* to write this feature. This is almost the
         inverse of get_raw_feature_dict, except Dataset2 doesn't write the data.
+        Any values that are stored out-of-line must also be written - see encode_raw_feature_dict_blobs.
+        """
+        return self.encode_raw_feature_dict_blobs(
+            raw_feature_dict, legend, relative=relative
+        )[-1]
+
+    def encode_raw_feature_dict_blobs(self, raw_feature_dict, legend, relative=False):
+        """
+        Like encode_raw_feature_dict, but returns a list of (path, data) tuples for every blob that
+        *should be written* to write this feature - first a blob for each value that is stored
+        out-of-line (see OutOfLine), and last the feature blob itself.
         """
         pk_values, non_pk_values = legend.raw_dict_to_value_tuples(raw_feature_dict)
         path = self.encode_pks_to_path(pk_values, relative=relative)
-        data = msg_pack([legend.hexhash(), non_pk_values])
-        return path, data
+        blobs = []
+        out_of_line = self.out_of_line
+        if out_of_line.enabled:
+            non_pk_values = list(non_pk_values)
+            for i, value in enumerate(non_pk_values):
+                if not out_of_line.stores_out_of_line(value):
+                    continue
+                value_data = HashedBlob.of(msg_pack(value))
+                blob_id = value_data.id.hex
+                value_path = f"{self.feature_value_path(path)}/{blob_id}"
+                blobs.append((value_path, value_data))
+                non_pk_values[i] = ValueRef(blob_id, isinstance(value, Geometry))
+        blobs.append((path, msg_pack([legend.hexhash(), non_pk_values])))
+        return blobs
 
     def encode_feature(self, feature, schema=None, relative=False):
         """
         Given a feature (either a dict keyed by column name, or a list / tuple in schema order),
         returns the path and the data which *should be written* to write this feature. This is
         almost the inverse of get_feature, except Dataset2 doesn't write the data.
+        Any values that are stored out-of-line must also be written - see encode_feature_blobs.
+        """
+        return self.encode_feature_blobs(feature, schema, relative=relative)[-1]
+
+    def encode_feature_blobs(self, feature, schema=None, relative=False):
+        """
+        Like encode_feature, but returns a list of (path, data) tuples for every blob that *should be
+        written* to write this feature - see encode_raw_feature_dict_blobs.
         """
         if schema is None:
             schema = self.schema
         raw_dict = schema.feature_to_raw_dict(feature)
-        return self.encode_raw_feature_dict(raw_dict, schema.legend, relative=relative)
+        return self.encode_raw_feature_dict_blobs(
+            raw_dict, schema.legend, relative=relative
+        )
 
     def encode_pks_to_path(self, pk_values, relative=False):
         """
         Given some pk values, returns the path the feature should be written to.
         pk_values should be a list or tuple of pk values.
         """
-        packed_pk = msg_pack(pk_values)
-        pk_hash = hexhash(packed_pk)
+        return self.encode_packed_pk_to_path(msg_pack(pk_values), relative=relative)
+
+    def encode_packed_pk_to_path(self, packed_pk, relative=False):
+        """Like encode_pks_to_path, but takes the pk values already serialised using msg_pack."""
+        tree_names = self.path_structure.tree_names(hexhash(packed_pk))
         filename = b64encode_str(packed_pk)
-        rel_path = f"{self.FEATURE_PATH}{pk_hash[:2]}/{pk_hash[2:4]}/{filename}"
+        rel_path = f"{self.FEATURE_PATH}{'/'.join(tree_names)}/{filename}"
         return rel_path if relative else self.full_path(rel_path)
 
+    def reshard_iter_feature_blobs(self, path_structure):
+        """
+        Yields (path, blob_id) tuples for the feature blobs that *should be written* to move every feature
+        in this dataset to where it belongs in the given PathStructure. The blobs themselves are unchanged,
+        and since the filename is the encoded primary key, that doesn't need to be decoded either.
+        Any out-of-line value blobs are moved along with the feature they belong to.
+        """
+        resharded = self.__class__(tree=None, path=self.path)
+        resharded.path_structure = path_structure
+        has_value_refs = self.has_out_of_line_values()
+        for blob_tree in self.feature_shards():
+            for blob in blob_tree:
+                packed_pk = b64decode_str(blob.name)
+                new_path = resharded.encode_packed_pk_to_path(packed_pk)
+                if has_value_refs:
+                    old_path = self.encode_packed_pk_to_path(packed_pk, relative=True)
+                    new_value_path = resharded.feature_value_path(new_path)
+                    for value_blob in self.get_value_blobs(old_path):
+                        yield f"{new_value_path}/{value_blob.name}", value_blob.id
+                yield new_path, blob.id
+
     def encode_1pk_to_path(self, pk_value, relative=False):
         """Given a feature's only pk value, returns the path the feature should be written to."""
         if isinstance(pk_value, (list, tuple)):
@@ -259,6 +655,10 @@ class Dataset2(RichBaseDataset):
         yield self.encode_schema(schema)
         yield self.encode_legend(schema.legend)
 
+        for path, data in (self.encode_path_structure(), self.encode_out_of_line()):
+            if data is not None:
+                yield path, data
+
         rel_meta_blobs = [
             (self.TITLE_PATH, source.get_meta_item("title")),
             (self.DESCRIPTION_PATH, source.get_meta_item("description")),
@@ -286,25 +686,44 @@ class Dataset2(RichBaseDataset):
                 blob.data,
             )
 
-    def import_iter_feature_blobs(self, resultset, source, replacing_dataset=None):
+    # Number of features sent to a worker process at a time, when encoding in parallel.
+    ENCODE_BATCH_SIZE = 5000
+
+    def import_iter_feature_blobs(
+        self, resultset, source, replacing_dataset=None, num_workers=1
+    ):
+        """
+        For the given import source, yields (path, data) tuples for the feature blobs that should
+        be written - and for any out-of-line value blobs, each just before the feature it belongs to.
+        If a feature is unchanged from the feature in the replacing_dataset,
+        data is the pygit2.Oid of the existing blob, which doesn't need to be written again.
+        """
         schema = source.schema
         if replacing_dataset is not None and replacing_dataset.schema != source.schema:
             # Optimisation: Try to avoid rewriting features for compatible schema changes.
             change_types = replacing_dataset.schema.diff_type_counts(source.schema)
-            if not change_types["pk_updates"]:
+            if (
+                not change_types["pk_updates"]
+                and replacing_dataset.out_of_line == self.out_of_line
+            ):
                 # We can probably avoid rewriting all features.
+                col_names = [c.name for c in schema]
                 for feature in resultset:
+                    if not isinstance(feature, dict):
+                        feature = dict(zip(col_names, feature))
                     pk_values = (feature[replacing_dataset.primary_key],)
-                    rel_path = self.encode_pks_to_path(pk_values, relative=True)
-                    try:
-                        existing_data = replacing_dataset.get_data_at(
-                            rel_path, as_memoryview=True
-                        )
-                    except KeyError:
+                    rel_path = replacing_dataset.encode_pks_to_path(
+                        pk_values, relative=True
+                    )
+                    existing_blob_id = replacing_dataset.get_blob_id_at(rel_path)
+                    if existing_blob_id is None:
                         # this feature isn't in the dataset we're replacing
-                        yield self.encode_feature(feature, schema)
+                        yield from self.encode_feature_blobs(feature, schema)
                         continue
 
+                    existing_data = replacing_dataset.get_data_at(
+                        rel_path, as_memoryview=True
+                    )
                     existing_feature_raw_dict = replacing_dataset.get_raw_feature_dict(
                         pk_values, data=existing_data
                     )
@@ -314,12 +733,72 @@ class Dataset2(RichBaseDataset):
                     )
                     if existing_feature == feature:
                         # Nothing changed? No need to rewrite the feature blob
-                        yield self.encode_pks_to_path(pk_values), existing_data
+                        feature_path = self.encode_pks_to_path(pk_values)
+                        value_path = self.feature_value_path(feature_path)
+                        for value_blob in replacing_dataset.get_value_blobs(rel_path):
+                            yield f"{value_path}/{value_blob.name}", value_blob.id
+                        yield feature_path, existing_blob_id
                     else:
-                        yield self.encode_feature(feature, schema)
+                        yield from self.encode_feature_blobs(feature, schema)
                 return
-        for feature in resultset:
-            yield self.encode_feature(feature, schema)
+
+        if num_workers > 1:
+            encoded = self._encode_features_in_parallel(resultset, schema, num_workers)
+        else:
+            encoded = itertools.chain.from_iterable(
+                self.encode_feature_blobs(feature, schema) for feature in resultset
+            )
+
+        if (
+            replacing_dataset is None
+            or replacing_dataset.path_structure != self.path_structure
+        ):
+            yield from encoded
+            return
+
+        # Optimisation: an unchanged feature encodes to exactly the same blob as before.
+        # Comparing blob OIDs is much cheaper than decoding and comparing the existing feature.
+        # The new blob's OID is kept with its data, so that it isn't hashed again when written.
+        for path, data in encoded:
+            existing_blob_id = replacing_dataset.get_blob_id_at(self.rel_path(path))
+            if existing_blob_id is None:
+                yield path, data
+                continue
+            data = data if isinstance(data, HashedBlob) else HashedBlob.of(data)
+            if existing_blob_id == data.id:
+                yield path, existing_blob_id
+            else:
+                yield path, data
+
+    def _encode_features_in_parallel(self, resultset, schema, num_workers):
+        """
+        Encodes features using a pool of worker processes. The resultset is still read
+        on this thread, in batches. Encoded batches are yielded in the order they were read,
+        so the output is exactly the same as if the features were encoded serially.
+        """
+        resultset = iter(resultset)
+        batches = iter(
+            lambda: list(itertools.islice(resultset, self.ENCODE_BATCH_SIZE)), []
+        )
+        with multiprocessing.Pool(
+            num_workers,
+            initializer=_init_encode_worker,
+            initargs=(
+                type(self),
+                self.path,
+                tuple(self.path_structure),
+                tuple(self.out_of_line),
+                schema.to_column_dicts(),
+            ),
+        ) as pool:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(pool.apply_async(_encode_feature_batch, (batch,)))
+                # Don't read too far ahead of whoever is consuming the encoded features.
+                if len(pending) >= num_workers * 2:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
 
     def encode_feature_blob(self, feature):
         # TODO - the dataset interface still needs some work:
@@ -327,16 +806,96 @@ class Dataset2(RichBaseDataset):
         return self.encode_feature(feature, self.schema)[1]
 
     def get_feature_tuples(self, row_pks, col_names=None, *, ignore_missing=False):
+        """
+        Yields the feature with each of the given primary keys as a tuple of values -
+        either in schema order, or ordered by the columns from col_names if that is supplied.
+        All the paths are encoded up front and sorted, so that the feature tree is walked in order
+        and each bucket tree is only looked up once - as a result, features are yielded in path order,
+        not in the order of row_pks.
+        """
         # TODO - make the signature more like the features method, which supports results as tuples or dicts.
-        # TODO - support col_names (and maybe support it for features method too).
+        pk_blobs = self._find_feature_blobs(row_pks, ignore_missing=ignore_missing)
+        return self._decode_feature_blobs(pk_blobs, False, col_names)
+
+    def get_feature_tuples_by_oid(self, repo, pk_oids, col_names=None):
+        """
+        Like get_feature_tuples, but takes (pk, blob-oid) pairs for the features - as found in a diff
+        of two feature trees - so the blobs are read straight from the object database, and no paths
+        need be looked up. Features are yielded in the same order as pk_oids.
+        """
+        sanitise_pks = self.schema.sanitise_pks
+        pk_blobs = ((sanitise_pks(pk), repo[oid]) for pk, oid in pk_oids)
+        return self._decode_feature_blobs(pk_blobs, False, col_names)
+
+    def _find_feature_blobs(self, row_pks, *, ignore_missing=False):
+        """
+        Yields (pk_values, blob) for each of the given primary keys, in path order - see get_feature_tuples.
+        """
+        sanitise_pks = self.schema.sanitise_pks
+        path_structure = self.path_structure
+        path_parts = []
         for pk in row_pks:
-            try:
-                yield self.get_feature(pk, keys=False)
-            except KeyError:
-                if ignore_missing:
-                    continue
-                else:
-                    raise
+            pk_values = sanitise_pks(pk)
+            packed_pk = msg_pack(pk_values)
+            tree_names = path_structure.tree_names(hexhash(packed_pk))
+            path_parts.append((tree_names, b64encode_str(packed_pk), pk_values))
+        path_parts.sort(key=lambda p: p[:2])
+
+        feature_tree = ()
+        if self.FEATURE_PATH in self.tree:
+            feature_tree = self.tree / self.FEATURE_PATH
+
+        def _find_in_tree(tree, parts, level):
+            if level == path_structure.levels:
+                for tree_names, filename, pk_values in parts:
+                    if filename in tree:
+                        yield pk_values, tree[filename]
+                    elif not ignore_missing:
+                        path = f"{self.FEATURE_PATH}{'/'.join(tree_names)}/{filename}"
+                        raise KeyError(f"No feature found at {self.full_path(path)}")
+                return
+            for name, subtree_parts in itertools.groupby(
+                parts, key=lambda p: p[0][level]
+            ):
+                subtree = tree[name] if name in tree else ()
+                yield from _find_in_tree(subtree, subtree_parts, level + 1)
+
+        return _find_in_tree(feature_tree, path_parts, 0)
+
+    def _write_feature(
+        self, feature_writer, old_path, new_path, new_feature, encode_kwargs
+    ):
+        if not (self.out_of_line.enabled or self.has_out_of_line_values()):
+            super()._write_feature(
+                feature_writer, old_path, new_path, new_feature, encode_kwargs
+            )
+            return
+
+        new_blobs = []
+        if new_feature:
+            new_blobs = self.encode_feature_blobs(
+                new_feature, relative=True, **encode_kwargs
+            )
+        new_value_paths = set(path for path, data in new_blobs[:-1])
+
+        if old_path and old_path != new_path:
+            feature_writer.remove(old_path)
+            feature_writer.remove(self.feature_value_path(old_path))
+        if new_path:
+            # Only the value blobs that have changed are removed and written - the rest are left as they are.
+            new_value_tree_path = self.feature_value_path(new_path)
+            existing = set(
+                f"{new_value_tree_path}/{blob.name}"
+                for blob in self.get_value_blobs(new_path)
+            )
+            if existing and not new_value_paths:
+                feature_writer.remove(new_value_tree_path)
+            else:
+                for path in existing - new_value_paths:
+                    feature_writer.remove(path)
+            new_blobs = [(p, d) for p, d in new_blobs if p not in existing]
+        for path, data in new_blobs:
+            feature_writer.insert(path, data)
 
     def apply_meta_diff(
         self, meta_diff, tree_builder, *, allow_missing_old_values=False
@@ -0,0 +1,441 @@
+import collections
+import contextlib
+import functools
+import io
+import itertools
+
+import msgpack
+
+from .diff_structs import DeltaDiff, Delta
+from .dataset2 import Dataset2
+from .exceptions import NotYetImplemented
+from .filter_util import UNFILTERED
+from .out_of_line import OutOfLine
+from .serialise_util import (
+    msg_pack,
+    msg_unpack,
+    b64decode_str,
+    hexhash,
+)
+
+
+def encode_bucket(records):
+    """
+    Given the features in a bucket as a dict {packed_pk: data}, returns the data of the bucket blob.
+    The bucket is a msgpack array of two arrays - every packed primary key in sorted order, and the
+    data of the feature with each of those primary keys, in the same order.
+    """
+    packed_pks = sorted(records)
+    return msg_pack([packed_pks, [bytes(records[p]) for p in packed_pks]])
+
+
+def decode_bucket(data):
+    """Given the data of a bucket blob, returns the features in it as a dict {packed_pk: data}."""
+    packed_pks, feature_data = msg_unpack(data)
+    return dict(zip(packed_pks, feature_data))
+
+
+def bucket_feature_count(data):
+    """
+    Given the data of a bucket blob, returns the number of features in it - which is read from the
+    header of the array of primary keys, without unpacking the keys or any of the feature data.
+    """
+    unpacker = msgpack.Unpacker(io.BytesIO(data), read_size=16)
+    unpacker.read_array_header()
+    return unpacker.read_array_header()
+
+
+class BucketCache:
+    """
+    A process-wide cache of the most recently used decoded buckets, for looking up individual features.
+    Buckets are keyed by the OID of the bucket blob - since buckets are content-addressed, one that is
+    unchanged between two versions of a dataset is only decoded once, and no dataset is kept alive.
+    """
+
+    DEFAULT_MAX_SIZE = 64
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._buckets = collections.OrderedDict()
+
+    def get(self, blob):
+        """Returns the features in the given bucket blob, as returned by decode_bucket. Don't modify the result."""
+        bucket = self._buckets.get(blob.id)
+        if bucket is not None:
+            self._buckets.move_to_end(blob.id)
+            return bucket
+        bucket = decode_bucket(blob.data)
+        self._buckets[blob.id] = bucket
+        if len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def clear(self):
+        self._buckets.clear()
+
+
+bucket_cache = BucketCache()
+
+
+class Dataset3(Dataset2):
+    """
+    Experimental. The same as Dataset2, except that the features are packed into bucket blobs -
+    one blob for each leaf of the path structure - instead of being stored in a blob each.
+    A huge dataset has hundreds of times fewer git objects this way.
+
+    any/structure/mylayer/
+      .sno-dataset/
+        meta/
+          [same as Dataset2]
+
+        feature/
+          [hex(pk-hash):2]/
+            [hex(pk-hash):2]  = [msgpack([[msgpack(pk-values), ...], [feature-data, ...]])]
+
+    Each feature still has a "virtual" path - the path of its bucket followed by the same filename
+    as in Dataset2 - which is used to encode and decode its primary key, but no blob exists at that path.
+    Out-of-line values are not yet supported.
+    """
+
+    VERSION = 3
+
+    VALUE_PATH = None
+
+    @property
+    def out_of_line(self):
+        return OutOfLine.NONE
+
+    @out_of_line.setter
+    def out_of_line(self, out_of_line):
+        if out_of_line.enabled:
+            raise NotYetImplemented(
+                "Out-of-line values are not yet supported for Datasets V3"
+            )
+
+    def has_out_of_line_values(self):
+        return False
+
+    def bucket_path(self, packed_pk, relative=False):
+        """Given pk values already serialised using msg_pack, returns the path of the bucket the feature belongs in."""
+        tree_names = self.path_structure.tree_names(hexhash(packed_pk))
+        rel_path = f"{self.FEATURE_PATH}{'/'.join(tree_names)}"
+        return rel_path if relative else self.full_path(rel_path)
+
+    @staticmethod
+    def _split_feature_path(path):
+        """Given a feature's virtual path, returns a tuple (bucket_path, packed_pk)."""
+        bucket_path, filename = path.rsplit("/", 1)
+        return bucket_path, b64decode_str(filename)
+
+    def _iter_feature_records(self):
+        """Yields (pk_values, data) for every feature in this dataset."""
+        for bucket in self.feature_shards():
+            for packed_pk, data in decode_bucket(bucket.data).items():
+                yield msg_unpack(packed_pk), data
+
+    def decode_bucket_records(self, records, keys=True, col_names=None):
+        """
+        Yields the features from a bucket - given as returned by decode_bucket - the same way
+        as Dataset2.decode_feature_blobs yields the features stored in blobs.
+        """
+        pk_records = ((msg_unpack(pk), data) for pk, data in records.items())
+        return self._decode_feature_blobs(pk_records, keys, col_names)
+
+    def decode_shard(self, shard, keys=True, col_names=None):
+        """Yields the features stored in the given bucket blob - see decode_bucket_records."""
+        return self.decode_bucket_records(
+            decode_bucket(shard.data), keys=keys, col_names=col_names
+        )
+
+    def features(self, keys=True, fast=None):
+        return self._decode_feature_blobs(self._iter_feature_records(), keys, None)
+
+    def feature_tuples(self, col_names=None, **kwargs):
+        return self._decode_feature_blobs(
+            self._iter_feature_records(), False, col_names
+        )
+
+    @property
+    def feature_count(self):
+        return sum(bucket_feature_count(b.data) for b in self.feature_shards())
+
+    def _read_bucket(self, bucket_path):
+        """Returns the features in the bucket at the given relative path as a dict {packed_pk: data}."""
+        data = None
+        if self.tree is not None:
+            data = self.get_data_at(bucket_path, as_memoryview=True, missing_ok=True)
+        return decode_bucket(data) if data is not None else {}
+
+    def _get_bucket(self, bucket_path):
+        """Like _read_bucket, but uses the bucket_cache. Don't modify the result."""
+        if self.tree is None:
+            return {}
+        try:
+            blob = self.tree / bucket_path
+        except KeyError:
+            return {}
+        return bucket_cache.get(blob) if blob.type_str == "blob" else {}
+
+    def _get_feature_data(self, rel_path):
+        bucket_path, packed_pk = self._split_feature_path(rel_path)
+        try:
+            return self._get_bucket(bucket_path)[packed_pk]
+        except KeyError:
+            raise KeyError(f"No feature found at {self.full_path(rel_path)}")
+
+    def _get_feature_blob(self, rel_path):
+        return None
+
+    def _decode_feature_blobs(self, pk_blobs, keys, col_names, cache=False):
+        # Features aren't stored in blobs of their own, so there are no blob IDs to cache them by.
+        return super()._decode_feature_blobs(pk_blobs, keys, col_names, cache=False)
+
+    def _feature_exists_at(self, rel_path):
+        bucket_path, packed_pk = self._split_feature_path(rel_path)
+        return packed_pk in self._get_bucket(bucket_path)
+
+    def _find_feature_blobs(self, row_pks, *, ignore_missing=False):
+        """
+        Yields (pk_values, data) for each of the given primary keys, grouped by bucket, so that
+        each bucket is only read once.
+        """
+        sanitise_pks = self.schema.sanitise_pks
+        records = []
+        for pk in row_pks:
+            pk_values = sanitise_pks(pk)
+            packed_pk = msg_pack(pk_values)
+            bucket_path = self.bucket_path(packed_pk, relative=True)
+            records.append((bucket_path, packed_pk, pk_values))
+        records.sort(key=lambda r: r[:2])
+
+        for bucket_path, bucket_records in itertools.groupby(
+            records, key=lambda r: r[0]
+        ):
+            bucket = self._read_bucket(bucket_path)
+            for _, packed_pk, pk_values in bucket_records:
+                data = bucket.get(packed_pk)
+                if data is not None:
+                    yield pk_values, data
+                elif not ignore_missing:
+                    path = self.encode_packed_pk_to_path(packed_pk)
+                    raise KeyError(f"No feature found at {path}")
+
+    def get_feature_tuples_by_oid(self, repo, pk_oids, col_names=None):
+        """
+        Like Dataset2.get_feature_tuples_by_oid, but the OIDs are of the bucket blobs the features are in -
+        see diff_feature_oids. Each run of features from the same bucket only decodes that bucket once.
+        """
+        sanitise_pks = self.schema.sanitise_pks
+
+        def _records():
+            bucket_id = bucket = None
+            for pk, oid in pk_oids:
+                if oid != bucket_id:
+                    bucket_id, bucket = oid, decode_bucket(repo[oid].data)
+                pk_values = sanitise_pks(pk)
+                yield pk_values, bucket[msg_pack(pk_values)]
+
+        return self._decode_feature_blobs(_records(), False, col_names)
+
+    @staticmethod
+    def _feature_tree_or_none(dataset):
+        if dataset is None or dataset.tree is None:
+            return None
+        if dataset.FEATURE_PATH not in dataset.tree:
+            return None
+        return dataset.tree / dataset.FEATURE_PATH
+
+    @classmethod
+    def _diff_feature_records(cls, old, new):
+        """
+        Yields (packed_pk, old_data, new_data, new_bucket_id) for every feature that is different
+        in dataset new than in dataset old. Either dataset can be None. old_data is None for inserts,
+        and new_data and new_bucket_id are None for deletes.
+        Features from the same bucket of dataset new are always yielded consecutively.
+        """
+        old_tree = cls._feature_tree_or_none(old)
+        new_tree = cls._feature_tree_or_none(new)
+        if old_tree is None and new_tree is None:
+            return
+        elif old_tree is None:
+            diff_index = new_tree.diff_to_tree(swap=True)
+        elif new_tree is None:
+            diff_index = old_tree.diff_to_tree()
+        else:
+            diff_index = old_tree.diff_to_tree(new_tree)
+
+        # When the path structure has changed, features move between buckets - so the records of
+        # every changed bucket must be collected before they can be compared. Otherwise, each bucket
+        # can be compared with the bucket at the same path.
+        resharded = (
+            old_tree is not None
+            and new_tree is not None
+            and old.path_structure != new.path_structure
+        )
+        old_records = {}
+        new_records = {}
+        for d in diff_index.deltas:
+            if d.status not in cls._INSERT_UPDATE_DELETE:
+                # RENAMED, COPIED, IGNORED, TYPECHANGE, UNMODIFIED, UNREADABLE, UNTRACKED
+                raise NotImplementedError(f"Delta status: {d.status_char()}")
+            if d.status in cls._UPDATE_DELETE:
+                old_records.update(decode_bucket((old_tree / d.old_file.path).data))
+            if d.status in cls._INSERT_UPDATE:
+                new_bucket_id = d.new_file.id
+                for packed_pk, data in decode_bucket(
+                    (new_tree / d.new_file.path).data
+                ).items():
+                    new_records[packed_pk] = data, new_bucket_id
+            if not resharded:
+                yield from cls._compare_records(old_records, new_records)
+                old_records.clear()
+                new_records.clear()
+
+        yield from cls._compare_records(old_records, new_records)
+
+    @staticmethod
+    def _compare_records(old_records, new_records):
+        for packed_pk, (new_data, new_bucket_id) in new_records.items():
+            old_data = old_records.pop(packed_pk, None)
+            if old_data != new_data:
+                yield packed_pk, old_data, new_data, new_bucket_id
+        for packed_pk, old_data in old_records.items():
+            yield packed_pk, old_data, None, None
+
+    @classmethod
+    def _decode_packed_pk_to_1pk(cls, packed_pk):
+        decoded = msg_unpack(packed_pk)
+        if len(decoded) != 1:
+            raise ValueError(f"Expected a single pk_value, got {decoded}")
+        return decoded[0]
+
+    def diff_feature(self, other, feature_filter=UNFILTERED, reverse=False):
+        """
+        Generates a diff from self -> other, but only for features that match the feature_filter.
+        If reverse is true, generates a diff from other -> self.
+        The buckets that changed are decoded to find which of the features in them changed.
+        """
+        result = DeltaDiff()
+        feature_filter = feature_filter or UNFILTERED
+
+        if reverse:
+            old, new = other, self
+        else:
+            old, new = self, other
+
+        for packed_pk, old_data, new_data, _ in self._diff_feature_records(old, new):
+            pk = self._decode_packed_pk_to_1pk(packed_pk)
+            if str(pk) not in feature_filter:
+                continue
+
+            old_half_delta = None
+            if old_data is not None:
+                old_half_delta = (
+                    pk,
+                    functools.partial(old.get_feature, (pk,), data=old_data),
+                )
+            new_half_delta = None
+            if new_data is not None:
+                new_half_delta = (
+                    pk,
+                    functools.partial(new.get_feature, (pk,), data=new_data),
+                )
+            result.add_delta(Delta(old_half_delta, new_half_delta))
+
+        return result
+
+    def diff_feature_oids(self, other):
+        deleted_pks = []
+        changed_pk_oids = []
+        for packed_pk, old_data, new_data, new_bucket_id in self._diff_feature_records(
+            self, other
+        ):
+            pk = self._decode_packed_pk_to_1pk(packed_pk)
+            if new_data is None:
+                deleted_pks.append(pk)
+            else:
+                changed_pk_oids.append((pk, new_bucket_id))
+        return deleted_pks, changed_pk_oids
+
+    @contextlib.contextmanager
+    def _feature_writer(self, tree_builder):
+        bucket_writer = _BucketWriter(self)
+        yield bucket_writer
+        bucket_writer.write_to(tree_builder)
+
+    def import_iter_feature_blobs(
+        self, resultset, source, replacing_dataset=None, num_workers=1
+    ):
+        """
+        Yields (path, data) tuples for each feature of the given import source - where path is the
+        feature's virtual path. These must be sorted by path and packed into buckets before they are
+        written - see pack_feature_blobs. Unchanged features can't be referred to by blob ID, since
+        they don't have a blob each, so replacing_dataset isn't used.
+        """
+        return super().import_iter_feature_blobs(
+            resultset, source, replacing_dataset=None, num_workers=num_workers
+        )
+
+    def pack_feature_blobs(self, sorted_feature_blobs):
+        """
+        Given (path, data) tuples for features - sorted by path, as yielded by import_iter_feature_blobs -
+        yields (path, data) tuples for the bucket blobs that they should be packed into.
+        """
+        for bucket_path, feature_blobs in itertools.groupby(
+            sorted_feature_blobs, key=lambda b: b[0].rsplit("/", 1)[0]
+        ):
+            records = {
+                self._split_feature_path(path)[1]: data for path, data in feature_blobs
+            }
+            yield bucket_path, encode_bucket(records)
+
+    def reshard_iter_feature_blobs(self, path_structure):
+        """
+        Yields (path, data) tuples for the bucket blobs that *should be written* to move every feature
+        in this dataset to where it belongs in the given PathStructure. The features are unchanged,
+        but every bucket is rewritten.
+        """
+        from .fast_import import sort_blobs_by_path
+
+        resharded = self.__class__(tree=None, path=self.path)
+        resharded.path_structure = path_structure
+
+        def _feature_blobs():
+            for bucket in self.feature_shards():
+                for packed_pk, data in decode_bucket(bucket.data).items():
+                    yield resharded.encode_packed_pk_to_path(packed_pk), data
+
+        return resharded.pack_feature_blobs(sort_blobs_by_path(_feature_blobs()))
+
+
+class _BucketWriter:
+    """
+    Buffers the features written to a Dataset3 by apply_feature_diff - so that each bucket
+    that has changed is only rewritten once, no matter how many of its features have changed.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.buckets = {}
+
+    def _bucket(self, bucket_path):
+        bucket = self.buckets.get(bucket_path)
+        if bucket is None:
+            bucket = dict(self.dataset._get_bucket(bucket_path))
+            self.buckets[bucket_path] = bucket
+        return bucket
+
+    def insert(self, path, data):
+        bucket_path, packed_pk = self.dataset._split_feature_path(path)
+        self._bucket(bucket_path)[packed_pk] = data
+
+    def remove(self, path):
+        bucket_path, packed_pk = self.dataset._split_feature_path(path)
+        self._bucket(bucket_path).pop(packed_pk, None)
+
+    def write_to(self, tree_builder):
+        for bucket_path, records in self.buckets.items():
+            if records:
+                tree_builder.insert(bucket_path, encode_bucket(records))
+            elif self.dataset._get_bucket(bucket_path):
+                tree_builder.remove(bucket_path)
@@ -0,0 +1,289 @@
+import json
+import logging
+from collections import namedtuple
+
+import pygit2
+
+from .dataset3 import decode_bucket
+from .exceptions import NotYetImplemented
+from .geometry import gpkg_geom_to_envelope
+from .repo_files import DATASET_STATS, read_repo_file, write_repo_file
+
+
+L = logging.getLogger("sno.dataset_stats")
+
+
+def union_extents(a, b):
+    """Returns the smallest extent that contains both of the given (min_x, max_x, min_y, max_y) extents."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+
+
+def _touches_boundary(envelope, extent):
+    """Returns True if removing a geometry with the given envelope could shrink the given extent."""
+    return (
+        envelope[0] <= extent[0]
+        or envelope[1] >= extent[1]
+        or envelope[2] <= extent[2]
+        or envelope[3] >= extent[3]
+    )
+
+
+class DatasetStats(
+    namedtuple("DatasetStats", ("feature_count", "extent", "blob_bytes"))
+):
+    """
+    Statistics about the features in a dataset:
+    feature_count - the number of features.
+    extent - the 2D extent of every feature's geometry as a tuple (min_x, max_x, min_y, max_y),
+        or None if the dataset has no geometry column or no non-empty geometries.
+    blob_bytes - the total size of every feature blob, in bytes.
+    """
+
+    EMPTY = None  # Set below.
+
+    def to_json(self):
+        return {
+            "featureCount": self.feature_count,
+            "extent": list(self.extent) if self.extent is not None else None,
+            "blobBytes": self.blob_bytes,
+        }
+
+    @classmethod
+    def from_json(cls, json_dict):
+        extent = json_dict["extent"]
+        return cls(
+            json_dict["featureCount"],
+            tuple(extent) if extent is not None else None,
+            json_dict["blobBytes"],
+        )
+
+
+DatasetStats.EMPTY = DatasetStats(0, None, 0)
+
+
+def _geometry_index(dataset):
+    """Returns the index of the dataset's geometry column in schema order, or None if it has none."""
+    geom_columns = dataset.schema.geometry_columns
+    if not geom_columns:
+        return None
+    return dataset.schema.columns.index(geom_columns[0])
+
+
+class DatasetStatsCache:
+    """
+    Caches DatasetStats in the DATASET_STATS file in the sno repository, keyed by the OID of each
+    dataset's feature tree - since trees are content-addressed, the stats for a tree never change.
+    The stats for a tree that isn't yet in the cache are calculated from the cached stats of the
+    same dataset in an ancestor commit, if there are any, by diffing the two feature trees.
+    Otherwise, every feature is read.
+    Only datasets V2 are supported.
+    """
+
+    # Only the most recently used stats are kept.
+    MAX_ENTRIES = 1000
+    # How many first-parent ancestors to search for a commit with cached stats.
+    MAX_ANCESTOR_DEPTH = 100
+
+    _INSERT_UPDATE = (pygit2.GIT_DELTA_ADDED, pygit2.GIT_DELTA_MODIFIED)
+    _UPDATE_DELETE = (pygit2.GIT_DELTA_MODIFIED, pygit2.GIT_DELTA_DELETED)
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._entries = None
+        self._dirty = False
+
+    @property
+    def entries(self):
+        """Dict of {feature-tree-OID: DatasetStats.to_json()}, in order of least to most recently used."""
+        if self._entries is None:
+            data = read_repo_file(self.repo, DATASET_STATS, missing_ok=True)
+            try:
+                self._entries = json.loads(data) if data else {}
+            except json.JSONDecodeError:
+                L.warning("Ignoring invalid %s file", DATASET_STATS)
+                self._entries = {}
+        return self._entries
+
+    def save(self):
+        """Writes any stats that have been calculated since this cache was loaded."""
+        if not self._dirty:
+            return
+        entries = self.entries
+        while len(entries) > self.MAX_ENTRIES:
+            del entries[next(iter(entries))]
+        write_repo_file(self.repo, DATASET_STATS, json.dumps(entries))
+        self._dirty = False
+
+    @staticmethod
+    def _feature_tree(dataset):
+        if dataset.FEATURE_PATH not in dataset.tree:
+            return None
+        return dataset.tree / dataset.FEATURE_PATH
+
+    def _get_cached(self, feature_tree):
+        key = feature_tree.hex
+        json_dict = self.entries.pop(key, None)
+        if json_dict is None:
+            return None
+        # Move to the end, so that it is the most recently used.
+        self.entries[key] = json_dict
+        return DatasetStats.from_json(json_dict)
+
+    def _put(self, feature_tree, stats):
+        self.entries[feature_tree.hex] = stats.to_json()
+        self._dirty = True
+
+    def feature_count(self, dataset):
+        """
+        Returns the number of features in the dataset - from the cache if possible, otherwise it is
+        counted - which is much quicker than calculating all the stats, so nothing new is cached.
+        """
+        if dataset.VERSION < 2:
+            return dataset.feature_count
+        feature_tree = self._feature_tree(dataset)
+        if feature_tree is None:
+            return 0
+        stats = self._get_cached(feature_tree)
+        if stats is not None:
+            return stats.feature_count
+        return dataset.feature_count
+
+    def get_stats(self, dataset, commit=None):
+        """
+        Returns the DatasetStats for the given dataset. If the commit that the dataset is from is
+        supplied, its ancestors are searched for stats that can be updated, instead of reading
+        every feature.
+        """
+        if dataset.VERSION < 2:
+            raise NotYetImplemented(
+                "Sorry, dataset statistics are only supported for Datasets V2 and up"
+            )
+        feature_tree = self._feature_tree(dataset)
+        if feature_tree is None:
+            return DatasetStats.EMPTY
+
+        stats = self._get_cached(feature_tree)
+        if stats is not None:
+            return stats
+
+        if commit is not None:
+            ancestor = self._find_ancestor_with_stats(dataset, commit)
+            if ancestor is not None:
+                stats = self._update_stats(*ancestor, dataset)
+        if stats is None:
+            stats = self._calculate_stats(dataset)
+
+        self._put(feature_tree, stats)
+        return stats
+
+    def _find_ancestor_with_stats(self, dataset, commit):
+        """
+        Searches the first-parent ancestors of the given commit for a version of the given dataset
+        with cached stats. Returns a tuple (ancestor_dataset, stats), or None if there is none.
+        """
+        for i in range(self.MAX_ANCESTOR_DEPTH):
+            if not commit.parents:
+                return None
+            commit = commit.parents[0]
+            try:
+                ancestor_dataset = dataset.__class__(
+                    commit.peel(pygit2.Tree) / dataset.path, dataset.path
+                )
+            except KeyError:
+                # The dataset didn't exist before this point.
+                return None
+            feature_tree = self._feature_tree(ancestor_dataset)
+            if feature_tree is None:
+                return None
+            stats = self._get_cached(feature_tree)
+            if stats is not None:
+                return ancestor_dataset, stats
+        return None
+
+    def _update_stats(self, old_dataset, old_stats, dataset):
+        """
+        Calculates the stats for the given dataset by applying the diff from the old dataset to the
+        stats of the old dataset. Returns None if they can't be calculated this way - that is,
+        if the schema has changed, or if features were removed from the edge of the extent.
+        """
+        if dataset.VERSION >= 3:
+            # The diff is between buckets, not features - see _calculate_stats.
+            return None
+        if old_dataset.get_data_at(
+            old_dataset.SCHEMA_PATH, missing_ok=True
+        ) != dataset.get_data_at(dataset.SCHEMA_PATH):
+            return None
+
+        old_tree = self._feature_tree(old_dataset)
+        new_tree = self._feature_tree(dataset)
+        if old_tree is None:
+            # Every feature is new - there's nothing to be gained by diffing.
+            return None
+
+        feature_count, extent, blob_bytes = old_stats
+        removed_blobs = []
+        added_blobs = []
+        for delta in old_tree.diff_to_tree(new_tree).deltas:
+            if delta.status in self._UPDATE_DELETE:
+                removed_blobs.append(old_tree / delta.old_file.path)
+            if delta.status in self._INSERT_UPDATE:
+                added_blobs.append(new_tree / delta.new_file.path)
+
+        feature_count += len(added_blobs) - len(removed_blobs)
+        blob_bytes += sum(b.size for b in added_blobs)
+        blob_bytes -= sum(b.size for b in removed_blobs)
+
+        geom_index = _geometry_index(dataset)
+        if geom_index is not None:
+            for feature in old_dataset.decode_feature_blobs(removed_blobs, keys=False):
+                envelope = gpkg_geom_to_envelope(feature[geom_index])
+                if envelope is None:
+                    continue
+                if extent is None or _touches_boundary(envelope, extent):
+                    return None
+            for feature in dataset.decode_feature_blobs(added_blobs, keys=False):
+                extent = union_extents(
+                    extent, gpkg_geom_to_envelope(feature[geom_index])
+                )
+
+        L.debug("Updated stats for %s using %d changes", dataset.path, len(added_blobs))
+        return DatasetStats(feature_count, extent, blob_bytes)
+
+    @staticmethod
+    def _calculate_stats(dataset):
+        """Calculates the stats for the given dataset by reading every feature."""
+        feature_count = 0
+        extent = None
+        blob_bytes = 0
+        geom_index = _geometry_index(dataset)
+        if dataset.VERSION >= 3:
+            # blob_bytes is the total size of the features packed into every bucket.
+            for bucket in dataset.feature_shards():
+                records = decode_bucket(bucket.data)
+                feature_count += len(records)
+                blob_bytes += sum(len(data) for data in records.values())
+                if geom_index is None:
+                    continue
+                for feature in dataset.decode_bucket_records(records, keys=False):
+                    extent = union_extents(
+                        extent, gpkg_geom_to_envelope(feature[geom_index])
+                    )
+            L.debug("Calculated stats for %s", dataset.path)
+            return DatasetStats(feature_count, extent, blob_bytes)
+
+        for blob_tree in dataset.feature_shards():
+            feature_count += len(blob_tree)
+            blob_bytes += sum(blob.size for blob in blob_tree)
+            if geom_index is None:
+                continue
+            for feature in dataset.decode_feature_blobs(blob_tree, keys=False):
+                extent = union_extents(
+                    extent, gpkg_geom_to_envelope(feature[geom_index])
+                )
+
+        L.debug("Calculated stats for %s", dataset.path)
+        return DatasetStats(feature_count, extent, blob_bytes)
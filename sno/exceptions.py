@@ -15,6 +15,7 @@ INVALID_OPERATION = 20
 MERGE_CONFLICT = 21
 PATCH_DOES_NOT_APPLY = 22
 SCHEMA_VIOLATION = 23
+SPATIAL_FILTER_CONFLICT = 24
 
 NOT_YET_IMPLEMENTED = 30
 
@@ -1,16 +1,43 @@
+import collections
+import contextlib
+import functools
+import heapq
+import itertools
+import json
 import logging
 import subprocess
+import tempfile
+import threading
 import time
 import uuid
 from enum import Enum, auto
 
 import click
+import msgpack
 import pygit2
 
 from . import git_util
-from .exceptions import SubprocessError, InvalidOperation, NotFound, NO_CHANGES
+from .exceptions import (
+    SubprocessError,
+    InvalidOperation,
+    NotFound,
+    NotYetImplemented,
+    NO_CHANGES,
+)
 from .import_source import ImportSource
+from .native_import import NativeImport
+from .out_of_line import OutOfLine
+from .path_structure import PathStructure
 from .base_dataset import BaseDataset
+from .repo_files import (
+    read_repo_file,
+    remove_repo_file,
+    write_repo_file,
+    IMPORT_RESUME,
+)
+from .rich_tree_builder import RichTreeBuilder
+from .serialise_util import HashedBlob
+from .sno_repo import SnoConfigKeys
 from .structure import RepositoryStructure
 from .repository_version import get_repo_version, extra_blobs_for_version
 from .timestamps import minutes_to_tz_offset
@@ -19,6 +46,30 @@ from .timestamps import minutes_to_tz_offset
 L = logging.getLogger("sno.fast_import")
 
 
+class ImportBackend(Enum):
+    # Objects are written by a git-fast-import subprocess.
+    GIT_FAST_IMPORT = "git-fast-import"
+
+    # Objects are written straight to a packfile by sno - see NativeImport.
+    # Doesn't support checkpoints, or importing multiple streams.
+    NATIVE = "native"
+
+    @classmethod
+    def from_config(cls, repo):
+        """Returns the ImportBackend configured by sno.import.backend - defaults to GIT_FAST_IMPORT."""
+        config = repo.config
+        key = SnoConfigKeys.SNO_IMPORT_BACKEND
+        if key not in config:
+            return cls.GIT_FAST_IMPORT
+        try:
+            return cls(config[key])
+        except ValueError:
+            valid = ", ".join(b.value for b in cls)
+            raise InvalidOperation(
+                f"Invalid value for {key}: {config[key]} - should be one of: {valid}"
+            )
+
+
 class ReplaceExisting(Enum):
     # Don't replace any existing datasets.
     # Imports will start from the existing HEAD state.
@@ -44,6 +95,15 @@ def fast_import_tables(
     limit=None,
     max_pack_size="2G",
     max_delta_depth=0,
+    num_workers=1,
+    num_streams=1,
+    checkpoint_interval=None,
+    resume=False,
+    backend=None,
+    sort_by_path=False,
+    written_blobs=None,
+    path_structure=None,
+    out_of_line=None,
     extra_cmd_args=(),
 ):
     """
@@ -58,7 +118,30 @@ def fast_import_tables(
     limit - maximum number of features to import per source.
     max_pack_size - maximum size of pack files. Affects performance.
     max_delta_depth - maximum depth of delta-compression chains. Affects performance.
+    num_workers - number of worker processes used to encode features. Affects performance.
+    num_streams - number of git-fast-import processes to run concurrently, each importing
+        a different group of sources. Affects performance. Not supported if header is supplied,
+        or by the native backend.
+    checkpoint_interval - if set, progress is saved every time this many features are imported,
+        so that the import can be resumed if it is interrupted. See IMPORT_RESUME.
+        Not supported by the native backend.
+    resume - if True, resumes an interrupted import of the same sources, which was started with
+        checkpoint_interval set.
+    backend - the ImportBackend used to write objects. Read from the repo config if not supplied.
+    sort_by_path - if True, each dataset's feature blobs are sorted by path before they are written.
+        Improves locality of objects in the resulting packs, and makes delta-compression more
+        effective. Not supported with checkpoints, since features are no longer written in source order.
+    written_blobs - a WrittenBlobs object, for sharing the record of which blobs have been written
+        across several imports into the same repo. A new one is used for each import if not supplied.
+    path_structure - how the features of each new dataset are sharded into trees: a PathStructure, or
+        PathStructure.AUTO to choose one based on the number of features. Read from the repo config
+        if not supplied. Datasets that replace an existing dataset keep its path structure by default.
+    out_of_line - an OutOfLine, which says which values of each new dataset are stored out-of-line.
+        Read from the repo config if not supplied. Datasets that replace an existing dataset keep
+        its setting by default.
     extra_cmd_args - any extra args for the git-fast-import command.
+
+    Returns a dict of {dest_path: number of features imported}, with an entry for each source.
     """
 
     if replace_existing == ReplaceExisting.ALL:
@@ -78,6 +161,25 @@ def fast_import_tables(
 
     dataset_class = BaseDataset.for_version(repo_version)
 
+    if path_structure is None:
+        path_structure = PathStructure.spec_from_config(repo)
+    elif repo_version < 2:
+        raise InvalidOperation(
+            f"Path structures are not supported for V{repo_version} datasets"
+        )
+
+    if out_of_line is None:
+        out_of_line = OutOfLine.from_config(repo)
+    if out_of_line is not None and out_of_line.enabled:
+        if repo_version < 2:
+            raise InvalidOperation(
+                f"Out-of-line values are not supported for V{repo_version} datasets"
+            )
+        if repo_version >= 3:
+            raise NotYetImplemented(
+                f"Out-of-line values are not yet supported for V{repo_version} datasets"
+            )
+
     ImportSource.check_valid(sources)
     if replace_existing == ReplaceExisting.DONT_REPLACE:
         for source in sources:
@@ -86,6 +188,37 @@ def fast_import_tables(
                     f"Cannot import to {source.dest_path}/ - already exists in repository"
                 )
 
+    if num_streams > 1 and header is not None:
+        raise ValueError("num_streams > 1 is not supported with a custom header")
+    num_streams = min(num_streams, len(sources))
+
+    if backend is None:
+        backend = ImportBackend.from_config(repo)
+    if backend == ImportBackend.NATIVE:
+        if resume:
+            raise InvalidOperation(
+                "Can't resume import - not supported by the native import backend"
+            )
+        if num_streams > 1 or checkpoint_interval:
+            raise ValueError(
+                "The native import backend doesn't support num_streams > 1 or checkpoints"
+            )
+    if dataset_class.VERSION >= 3:
+        if resume:
+            raise InvalidOperation(
+                "Can't resume import - not supported for Datasets V3"
+            )
+        if checkpoint_interval:
+            # Every feature must be read before the buckets they are packed into can be written.
+            raise ValueError("Checkpoints are not supported for Datasets V3")
+
+    use_checkpoints = bool(checkpoint_interval or resume)
+    if use_checkpoints and (header is not None or num_streams > 1 or sort_by_path):
+        raise ValueError(
+            "Checkpoints are not supported with a custom header, with num_streams > 1, "
+            "or with sort_by_path"
+        )
+
     cmd = [
         "git",
         "fast-import",
@@ -102,89 +235,320 @@ def fast_import_tables(
 
         # may be None, if head is detached
         orig_branch = git_util.get_head_branch(repo)
-        header = generate_header(repo, sources, message, import_branch)
     else:
         import_branch = None
     orig_commit = git_util.get_head_commit(repo)
 
-    if not quiet:
-        click.echo("Starting git-fast-import...")
+    resume_state = None
+    resume_commit = None
+    # Datasets that were partly written before the import was interrupted, by dest_path.
+    resumed_datasets = {}
+    if resume:
+        resume_state = _read_resume_state(repo)
+        _check_resume_state(resume_state, sources, replace_existing, orig_commit)
+        import_branch = resume_state["importBranch"]
+        orig_branch = resume_state["origBranch"]
+        message = resume_state["message"]
+        if import_branch in repo.references:
+            resume_commit = repo.references[import_branch].peel(pygit2.Commit)
+            # Make sure the remaining features are written using the same schemas
+            # as the features that were already written.
+            resume_structure = RepositoryStructure(repo, commit=resume_commit)
+            for source in sources:
+                existing_dataset = resume_structure.get(source.dest_path)
+                if existing_dataset is not None:
+                    source.schema = existing_dataset.schema.align_to_self(source.schema)
+                    resumed_datasets[source.dest_path] = existing_dataset
+    elif use_checkpoints:
+        _discard_resume_state(repo)
+        if message is None:
+            message = generate_message(sources)
+        resume_state = {
+            "importBranch": import_branch,
+            "origBranch": orig_branch,
+            "origCommit": orig_commit.oid.hex if orig_commit is not None else None,
+            "replaceExisting": replace_existing.name,
+            "message": message,
+            "sources": {
+                source.dest_path: {"featuresWritten": 0, "done": False}
+                for source in sources
+            },
+        }
+        _write_resume_state(repo, resume_state)
 
-    p = subprocess.Popen(
-        cmd,
-        cwd=repo.path,
-        stdin=subprocess.PIPE,
+    if import_branch is not None:
+        header = generate_header(repo, sources, message, import_branch)
+
+    import_kwargs = dict(
+        quiet=quiet,
+        limit=limit,
+        num_workers=num_workers,
+        sort_by_path=sort_by_path,
+        path_structure=path_structure,
+        out_of_line=out_of_line,
     )
-    try:
-        if replace_existing != ReplaceExisting.ALL:
-            header += f"from {orig_commit.oid}\n"
-        p.stdin.write(header.encode("utf8"))
 
-        # Write any extra blobs supplied by the client or needed for this version.
-        for i, blob_path in write_blobs_to_stream(p.stdin, extra_blobs):
-            if replace_existing != ReplaceExisting.ALL and blob_path in head_tree:
-                raise ValueError(f"{blob_path} already exists")
+    feature_counts = {}
 
-        for source in sources:
-            replacing_dataset = None
-            if replace_existing == ReplaceExisting.GIVEN:
-                # Delete the existing dataset, before we re-import it.
-                p.stdin.write(f"D {source.dest_path}\n".encode("utf8"))
-
-                try:
-                    replacing_dataset = RepositoryStructure(repo)[source.dest_path]
-                except KeyError:
-                    pass
-                else:
-                    # We just deleted the legends, but we still need them to reimport
-                    # data efficiently. Copy them from the original dataset.
-                    for x in write_blobs_to_stream(
-                        p.stdin, replacing_dataset.iter_legend_blob_data()
+    if num_streams > 1:
+        _fast_import_streams(
+            repo,
+            cmd,
+            sources,
+            dataset_class,
+            num_streams=num_streams,
+            import_branch=import_branch,
+            message=message,
+            parent_commit=(
+                orig_commit if replace_existing != ReplaceExisting.ALL else None
+            ),
+            base_tree=head_tree if replace_existing != ReplaceExisting.ALL else None,
+            extra_blobs=extra_blobs,
+            replace_existing=replace_existing,
+            feature_counts=feature_counts,
+            **import_kwargs,
+        )
+    else:
+        if backend == ImportBackend.NATIVE:
+            if not quiet:
+                click.echo("Starting native import...")
+            p = NativeImport(repo)
+        else:
+            if not quiet:
+                click.echo("Starting git-fast-import...")
+            p = subprocess.Popen(
+                cmd,
+                cwd=repo.path,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE if use_checkpoints else None,
+            )
+            if written_blobs is None:
+                written_blobs = WrittenBlobs()
+            import_kwargs["written_blobs"] = written_blobs
+
+        def checkpoint(source, features_written, done=False):
+            # End the current commit, and ask git-fast-import to write out everything so far.
+            # The next commit continues on from the current commit on the same branch.
+            p.stdin.write(b"\ncheckpoint\nprogress checkpoint\n")
+            p.stdin.write(header.encode("utf8"))
+            p.stdin.flush()
+            # Wait until git-fast-import has actually finished the checkpoint.
+            if not p.stdout.readline():
+                raise BrokenPipeError()
+            resume_state["sources"][source.dest_path] = {
+                "featuresWritten": features_written,
+                "done": done,
+            }
+            _write_resume_state(repo, resume_state)
+
+        try:
+            if resume_commit is not None:
+                p.stdin.write((header + f"from {resume_commit.oid}\n").encode("utf8"))
+            else:
+                first_header = header
+                if replace_existing != ReplaceExisting.ALL:
+                    first_header += f"from {orig_commit.oid}\n"
+                p.stdin.write(first_header.encode("utf8"))
+
+                # Write any extra blobs supplied by the client or needed for this version.
+                for i, blob_path in write_blobs_to_stream(
+                    p.stdin, extra_blobs, written_blobs
+                ):
+                    if (
+                        replace_existing != ReplaceExisting.ALL
+                        and blob_path in head_tree
                     ):
-                        pass
+                        raise ValueError(f"{blob_path} already exists")
 
-            dataset = dataset_class(tree=None, path=source.dest_path)
+            for source in sources:
+                skip_features = 0
+                if resume_commit is not None:
+                    source_state = resume_state["sources"][source.dest_path]
+                    if source_state["done"]:
+                        feature_counts[source.dest_path] = source_state[
+                            "featuresWritten"
+                        ]
+                        if not quiet:
+                            click.echo(
+                                f"Skipping {source} - already imported to {source.dest_path}/"
+                            )
+                        continue
+                    skip_features = source_state["featuresWritten"]
 
-            with source:
-                if limit:
-                    num_rows = min(limit, source.feature_count)
-                    num_rows_text = f"{num_rows:,d} of {source.feature_count:,d}"
-                else:
-                    num_rows = source.feature_count
-                    num_rows_text = f"{num_rows:,d}"
+                replacing_dataset = None
+                if replace_existing == ReplaceExisting.GIVEN:
+                    if not skip_features:
+                        # Delete the existing dataset, before we re-import it.
+                        p.stdin.write(f"D {source.dest_path}\n".encode("utf8"))
+                    replacing_dataset = _get_replacing_dataset(repo, source)
 
-                if not quiet:
-                    click.echo(
-                        f"Importing {num_rows_text} features from {source} to {source.dest_path}/ ..."
+                source_kwargs = import_kwargs
+                resumed_dataset = resumed_datasets.get(source.dest_path)
+                if resumed_dataset is not None and resumed_dataset.VERSION >= 2:
+                    # The remaining features must be sharded and stored the same way as those
+                    # already written - path_structure may be AUTO, and the estimated feature
+                    # count it was resolved from may have changed since.
+                    source_kwargs = dict(
+                        import_kwargs,
+                        path_structure=resumed_dataset.path_structure,
+                        out_of_line=resumed_dataset.out_of_line,
                     )
 
-                for x in write_blobs_to_stream(
-                    p.stdin, dataset.import_iter_meta_blobs(repo, source)
-                ):
-                    pass
+                with source:
+                    features_written = _import_single_source(
+                        repo,
+                        p.stdin,
+                        source,
+                        dataset_class,
+                        replacing_dataset,
+                        skip_features=skip_features,
+                        checkpoint_interval=checkpoint_interval,
+                        on_checkpoint=functools.partial(checkpoint, source),
+                        **source_kwargs,
+                    )
+                feature_counts[source.dest_path] = features_written
+                if use_checkpoints:
+                    checkpoint(source, features_written, done=True)
 
-                # features
-                t1 = time.monotonic()
-                src_iterator = source.features()
+            p.stdin.write(b"\ndone\n")
+        except BrokenPipeError:
+            # if git-fast-import dies early, we get an EPIPE here
+            # we'll deal with it below
+            pass
+        except Exception:
+            if backend == ImportBackend.NATIVE:
+                # Discard the unfinished pack.
+                p.stdin.close()
+            raise
+        else:
+            p.stdin.close()
+        t2 = time.monotonic()
+        p.wait()
+        if p.returncode != 0:
+            if use_checkpoints and not quiet:
+                click.echo(
+                    "To continue this import from the last checkpoint, run it again with --resume",
+                    err=True,
+                )
+            raise SubprocessError(
+                f"{backend.value} error! {p.returncode}", exit_code=p.returncode
+            )
+        t3 = time.monotonic()
+        if not quiet:
+            click.echo(f"Closed in {(t3-t2):.0f}s")
+        if written_blobs is not None and written_blobs.hits:
+            L.info(f"Skipped resending {written_blobs.hits:,d} duplicate blobs")
 
-                for i, blob_path in write_blobs_to_stream(
-                    p.stdin,
-                    dataset.import_iter_feature_blobs(
-                        src_iterator, source, replacing_dataset=replacing_dataset
-                    ),
-                ):
-                    if i and i % 100000 == 0 and not quiet:
-                        click.echo(f"  {i:,d} features... @{time.monotonic()-t1:.1f}s")
-
-                    if limit is not None and i == (limit - 1):
-                        click.secho(f"  Stopping at {limit:,d} features", fg="yellow")
-                        break
-                t2 = time.monotonic()
-                if not quiet:
-                    click.echo(f"Added {num_rows:,d} Features to index in {t2-t1:.1f}s")
-                    click.echo(
-                        f"Overall rate: {(num_rows/(t2-t1 or 1E-3)):.0f} features/s)"
-                    )
+    if use_checkpoints:
+        # Each checkpoint started a new commit - replace them all with a single commit.
+        _squash_import_branch(
+            repo,
+            import_branch,
+            orig_commit if replace_existing != ReplaceExisting.ALL else None,
+        )
+
+    if import_branch is not None:
+        # we created a temp branch for the import above.
+        try:
+            if head_tree and not allow_empty:
+                if repo.revparse_single(import_branch).peel(pygit2.Tree) == head_tree:
+                    raise NotFound("No changes to commit", exit_code=NO_CHANGES)
+            latest_commit_oid = repo.references[import_branch].peel(pygit2.Commit).oid
+            _move_head(
+                repo, orig_branch, latest_commit_oid, branch_exists=bool(head_tree)
+            )
+        finally:
+            # remove the import branch
+            repo.references.delete(import_branch)
+            if use_checkpoints:
+                remove_repo_file(repo, IMPORT_RESUME)
+
+    return feature_counts
+
+
+def _move_head(repo, orig_branch, commit_oid, *, branch_exists=True):
+    """Moves HEAD to the given commit - by resetting orig_branch, or directly if HEAD is detached."""
+    if orig_branch:
+        # reset the original branch head to the import branch, so it gets the new commits
+        if branch_exists:
+            # repo was non-empty before this, and head was not detached.
+            # so orig_branch exists already.
+            # we have to delete and re-create it at the new commit.
+            repo.references.delete(orig_branch)
+        repo.references.create(orig_branch, commit_oid)
+    else:
+        # head was detached before this. just update head to the new commit,
+        # so it's still detached.
+        repo.set_head(commit_oid)
+
+
+def reshard_datasets(repo, datasets, path_structure, *, message=None, quiet=False):
+    """
+    Moves the features of each of the given datasets to where they belong in the given path structure -
+    a PathStructure, or PathStructure.AUTO to choose one for each dataset based on its number of features -
+    and commits the result to HEAD using git-fast-import. The feature blobs themselves are unchanged.
+    Returns a dict of {dataset_path: PathStructure} for each dataset that was resharded.
+    """
+    new_structures = {}
+    for dataset in datasets:
+        if dataset.VERSION < 2:
+            raise InvalidOperation(
+                f"Path structures are not supported for V{dataset.VERSION} datasets"
+            )
+        feature_count = None
+        if path_structure == PathStructure.AUTO:
+            feature_count = dataset.feature_count
+        new_structure = PathStructure.resolve(path_structure, feature_count)
+        if new_structure != dataset.path_structure:
+            new_structures[dataset] = new_structure
+
+    if not new_structures:
+        raise NotFound("No changes to commit", exit_code=NO_CHANGES)
+
+    if message is None:
+        message = "Reshard " + ", ".join(
+            f"{dataset.path}/ to {new_structure}"
+            for dataset, new_structure in new_structures.items()
+        )
+
+    orig_commit = git_util.get_head_commit(repo)
+    orig_branch = git_util.get_head_branch(repo)
+    import_branch = f"refs/heads/{uuid.uuid4()}"
+    header = generate_header(repo, None, message, import_branch)
+
+    p = subprocess.Popen(
+        ["git", "fast-import", "--quiet", "--done"],
+        cwd=repo.path,
+        stdin=subprocess.PIPE,
+    )
+    try:
+        p.stdin.write(f"{header}from {orig_commit.oid}\n".encode("utf8"))
+        for dataset, new_structure in new_structures.items():
+            if not quiet:
+                click.echo(
+                    f"Resharding {dataset.path}/ from {dataset.path_structure} to {new_structure} ..."
+                )
+            feature_path = dataset.full_path(dataset.FEATURE_PATH).rstrip("/")
+            p.stdin.write(f"D {feature_path}\n".encode("utf8"))
+            if dataset.has_out_of_line_values():
+                value_path = dataset.full_path(dataset.VALUE_PATH).rstrip("/")
+                p.stdin.write(f"D {value_path}\n".encode("utf8"))
+
+            resharded = dataset.__class__(tree=None, path=dataset.path)
+            resharded.path_structure = new_structure
+            path, data = resharded.encode_path_structure()
+            if data is None:
+                p.stdin.write(f"D {path}\n".encode("utf8"))
+                blobs = dataset.reshard_iter_feature_blobs(new_structure)
+            else:
+                blobs = itertools.chain(
+                    [(path, data)], dataset.reshard_iter_feature_blobs(new_structure)
+                )
+
+            t1 = time.monotonic()
+            for i, blob_path in write_blobs_to_stream(p.stdin, blobs):
+                if i and i % 100000 == 0 and not quiet:
+                    click.echo(f"  {i:,d} features... @{time.monotonic()-t1:.1f}s")
 
         p.stdin.write(b"\ndone\n")
     except BrokenPipeError:
@@ -198,41 +562,578 @@ def fast_import_tables(
         raise SubprocessError(
             f"git-fast-import error! {p.returncode}", exit_code=p.returncode
         )
-    t3 = time.monotonic()
+
+    try:
+        new_commit_oid = repo.references[import_branch].peel(pygit2.Commit).oid
+        _move_head(repo, orig_branch, new_commit_oid)
+    finally:
+        repo.references.delete(import_branch)
+
+    return {
+        dataset.path: new_structure for dataset, new_structure in new_structures.items()
+    }
+
+
+def _get_replacing_dataset(repo, source):
+    """
+    Returns the existing dataset at source.dest_path, or None if there isn't one.
+    Any existing dataset is replaced by the import, but its legends are still needed
+    to reimport the data efficiently.
+    """
+    try:
+        return RepositoryStructure(repo)[source.dest_path]
+    except KeyError:
+        return None
+
+
+def _import_single_source(
+    repo,
+    stream,
+    source,
+    dataset_class,
+    replacing_dataset,
+    *,
+    quiet,
+    limit,
+    num_workers,
+    sort_by_path=False,
+    path_structure=None,
+    out_of_line=None,
+    written_blobs=None,
+    skip_features=0,
+    checkpoint_interval=None,
+    on_checkpoint=None,
+    stop_event=None,
+):
+    """
+    Writes the meta and feature blobs for a single source to the given git-fast-import stream.
+    The source should already be open, ie, this should be called within `with source:`
+    If sort_by_path is True, the feature blobs are sorted by path before they are written.
+    (Features of Datasets V3 are always sorted by path, to pack them into buckets).
+    path_structure - the PathStructure of the new dataset, or PathStructure.AUTO - see fast_import_tables.
+    out_of_line - the OutOfLine of the new dataset - see fast_import_tables.
+    written_blobs - if supplied, blobs that have already been written are referred to by ID instead.
+    The first skip_features features are skipped, since they have already been written.
+    Calls on_checkpoint(features_written) every checkpoint_interval features.
+    stop_event - a threading.Event. If it is set, the import stops with _ImportStopped as soon as possible.
+    Returns the total number of features written, including any that were skipped.
+    """
+    if replacing_dataset is not None:
+        # The existing dataset has been deleted, but we still need its legends
+        # to reimport data efficiently. Copy them from the original dataset.
+        for x in write_blobs_to_stream(
+            stream, replacing_dataset.iter_legend_blob_data(), written_blobs
+        ):
+            pass
+
+    dataset = dataset_class(tree=None, path=source.dest_path)
+    if dataset.VERSION >= 2:
+        if path_structure is None and replacing_dataset is not None:
+            dataset.path_structure = replacing_dataset.path_structure
+        else:
+            feature_count = None
+            if path_structure == PathStructure.AUTO:
+                feature_count = source.estimated_feature_count
+                if limit and feature_count is not None:
+                    feature_count = min(limit, feature_count)
+            dataset.path_structure = PathStructure.resolve(
+                path_structure, feature_count
+            )
+    if dataset.VERSION == 2:
+        if out_of_line is None and replacing_dataset is not None:
+            dataset.out_of_line = replacing_dataset.out_of_line
+        elif out_of_line is not None:
+            dataset.out_of_line = out_of_line
+
+    num_rows = None
     if not quiet:
-        click.echo(f"Closed in {(t3-t2):.0f}s")
+        # Features are counted as they are imported - this is just for reporting progress.
+        num_rows = source.estimated_feature_count
+        if num_rows is None:
+            num_rows_text = f"up to {limit:,d}" if limit else "all"
+        elif limit:
+            num_rows_text = f"{min(limit, num_rows):,d} of {num_rows:,d}"
+            num_rows = min(limit, num_rows)
+        else:
+            num_rows_text = f"{num_rows:,d}"
 
-    if import_branch is not None:
-        # we created a temp branch for the import above.
+        click.echo(
+            f"Importing {num_rows_text} features from {source} to {source.dest_path}/ ..."
+        )
+        if skip_features:
+            click.echo(f"  Resuming from feature {skip_features:,d}")
+
+    for x in write_blobs_to_stream(
+        stream, dataset.import_iter_meta_blobs(repo, source), written_blobs
+    ):
+        pass
+
+    # features
+    t1 = time.monotonic()
+    if dataset.VERSION >= 2:
+        # Datasets V2 can encode features that are tuples in schema order,
+        # which import sources can generally read more efficiently than dicts.
+        src_features = source.feature_tuples()
+    else:
+        src_features = source.features()
+    src_iterator = itertools.islice(src_features, skip_features, limit)
+    features_written = skip_features
+
+    if dataset.VERSION >= 3:
+        features_written = _write_feature_buckets(
+            repo,
+            stream,
+            dataset,
+            source,
+            src_iterator,
+            quiet=quiet,
+            limit=limit,
+            num_rows=num_rows,
+            num_workers=num_workers,
+            written_blobs=written_blobs,
+            stop_event=stop_event,
+        )
+    else:
+        feature_blobs = dataset.import_iter_feature_blobs(
+            src_iterator,
+            source,
+            replacing_dataset=replacing_dataset,
+            num_workers=num_workers,
+        )
+        if sort_by_path:
+            feature_blobs = sort_blobs_by_path(feature_blobs, tmp_dir=repo.path)
+
+        # Out-of-line value blobs are written just before the feature they belong to,
+        # but only the feature blobs themselves are counted.
+        value_path = dataset.VALUE_PATH and dataset.full_path(dataset.VALUE_PATH)
+        for _, blob_path in write_blobs_to_stream(stream, feature_blobs, written_blobs):
+            if value_path and blob_path.startswith(value_path):
+                continue
+            i = features_written
+            features_written += 1
+            if stop_event is not None and i % STOP_CHECK_INTERVAL == 0:
+                _check_stop_event(stop_event)
+            if i and i % 100000 == 0 and not quiet:
+                progress = f" ({i/num_rows:.0%})" if num_rows else ""
+                click.echo(
+                    f"  {i:,d} features{progress}... @{time.monotonic()-t1:.1f}s"
+                )
+
+            if checkpoint_interval and features_written % checkpoint_interval == 0:
+                on_checkpoint(features_written)
+
+        if limit is not None and features_written >= limit:
+            click.secho(f"  Stopping at {limit:,d} features", fg="yellow")
+    t2 = time.monotonic()
+    if not quiet:
+        num_added = features_written - skip_features
+        click.echo(f"Added {num_added:,d} Features to index in {t2-t1:.1f}s")
+        click.echo(f"Overall rate: {(num_added/(t2-t1 or 1E-3)):.0f} features/s)")
+    return features_written
+
+
+# How many features are imported between each check of the stop_event - see _import_single_source.
+STOP_CHECK_INTERVAL = 1000
+
+
+class _ImportStopped(Exception):
+    """Raised by a stream of a concurrent import when it stops because another stream failed."""
+
+
+def _check_stop_event(stop_event):
+    if stop_event.is_set():
+        raise _ImportStopped()
+
+
+def _write_feature_buckets(
+    repo,
+    stream,
+    dataset,
+    source,
+    src_features,
+    *,
+    quiet,
+    limit,
+    num_rows,
+    num_workers,
+    written_blobs,
+    stop_event=None,
+):
+    """
+    Writes the features from src_features to the given git-fast-import stream, packed into the bucket
+    blobs of a Dataset3. The encoded features are sorted by path so that each bucket can be packed in turn -
+    so progress is reported as the features are read, since nothing is written until they all have been.
+    src_features should already be limited to at most limit features. Returns the number of features written.
+    """
+    feature_blobs = dataset.import_iter_feature_blobs(
+        src_features, source, num_workers=num_workers
+    )
+
+    t1 = time.monotonic()
+    features_read = 0
+
+    def _report_progress(feature_blobs):
+        nonlocal features_read
+        for features_read, feature_blob in enumerate(feature_blobs, 1):
+            if stop_event is not None and features_read % STOP_CHECK_INTERVAL == 0:
+                _check_stop_event(stop_event)
+            if features_read % 100000 == 0 and not quiet:
+                progress = f" ({features_read/num_rows:.0%})" if num_rows else ""
+                click.echo(
+                    f"  {features_read:,d} features{progress}... @{time.monotonic()-t1:.1f}s"
+                )
+            yield feature_blob
+
+    sorted_blobs = sort_blobs_by_path(
+        _report_progress(feature_blobs), tmp_dir=repo.path
+    )
+    for i, blob_path in write_blobs_to_stream(
+        stream, dataset.pack_feature_blobs(sorted_blobs), written_blobs
+    ):
+        pass
+    if limit is not None and features_read >= limit:
+        click.secho(f"  Stopping at {limit:,d} features", fg="yellow")
+    return features_read
+
+
+def _read_resume_state(repo):
+    data = read_repo_file(repo, IMPORT_RESUME, missing_ok=True)
+    if data is None:
+        raise NotFound("There is no interrupted import to resume")
+    return json.loads(data)
+
+
+def _write_resume_state(repo, resume_state):
+    write_repo_file(repo, IMPORT_RESUME, json.dumps(resume_state, indent=2))
+
+
+def _discard_resume_state(repo):
+    """Forgets about any previous interrupted import - it can no longer be resumed."""
+    data = read_repo_file(repo, IMPORT_RESUME, missing_ok=True)
+    if data is None:
+        return
+    import_branch = json.loads(data)["importBranch"]
+    if import_branch in repo.references:
+        repo.references.delete(import_branch)
+    remove_repo_file(repo, IMPORT_RESUME)
+    click.echo("Discarding a previous interrupted import", err=True)
+
+
+def _check_resume_state(resume_state, sources, replace_existing, orig_commit):
+    """Makes sure the interrupted import is the same as the import we are resuming."""
+    if list(resume_state["sources"]) != [s.dest_path for s in sources]:
+        raise InvalidOperation(
+            "Can't resume import - the interrupted import was importing to: "
+            + ", ".join(f"{p}/" for p in resume_state["sources"])
+        )
+    if resume_state["replaceExisting"] != replace_existing.name:
+        raise InvalidOperation(
+            "Can't resume import - the replace-existing option has changed"
+        )
+    orig_commit_hex = orig_commit.oid.hex if orig_commit is not None else None
+    if resume_state["origCommit"] != orig_commit_hex:
+        raise InvalidOperation(
+            "Can't resume import - HEAD has changed since the import was interrupted"
+        )
+
+
+def _squash_import_branch(repo, import_branch, parent_commit):
+    """Replaces all the commits on the import branch with a single commit, with the given parent."""
+    tip = repo.references[import_branch].peel(pygit2.Commit)
+    commit_oid = repo.create_commit(
+        None,
+        tip.author,
+        tip.committer,
+        tip.message,
+        tip.tree.oid,
+        [parent_commit.oid] if parent_commit is not None else [],
+    )
+    repo.references.create(import_branch, commit_oid, force=True)
+
+
+def _fast_import_streams(
+    repo,
+    cmd,
+    sources,
+    dataset_class,
+    *,
+    num_streams,
+    import_branch,
+    message,
+    parent_commit,
+    base_tree,
+    extra_blobs,
+    replace_existing,
+    feature_counts,
+    **import_kwargs,
+):
+    """
+    Imports the given sources using several concurrent git-fast-import processes.
+    Each process imports a group of the sources to a temporary branch, and writes its own pack.
+    The resulting dataset trees are then composed onto base_tree, and committed to import_branch.
+    The number of features imported from each source is stored in feature_counts.
+    """
+    try:
+        # Each source is read on a different thread, so each needs its own connection / file handle.
+        stream_sources = [source.reopen() for source in sources]
+    except NotImplementedError:
+        click.secho(
+            f"Warning: {type(sources[0]).__name__} can't be read concurrently - "
+            "importing using a single git-fast-import process",
+            fg="yellow",
+            err=True,
+        )
+        stream_sources, num_streams = sources, 1
+
+    groups = [stream_sources[i::num_streams] for i in range(num_streams)]
+    stream_branches = [f"refs/heads/{uuid.uuid4()}" for group in groups]
+    errors = []
+    # Set as soon as any stream fails, so that the other streams stop too.
+    stop_event = threading.Event()
+
+    def _import_group(group, header):
         try:
-            if head_tree and not allow_empty:
-                if repo.revparse_single(import_branch).peel(pygit2.Tree) == head_tree:
-                    raise NotFound("No changes to commit", exit_code=NO_CHANGES)
-            latest_commit_oid = repo.references[import_branch].peel(pygit2.Commit).oid
-            if orig_branch:
-                # reset the original branch head to the import branch, so it gets the new commits
-                if head_tree:
-                    # repo was non-empty before this, and head was not detached.
-                    # so orig_branch exists already.
-                    # we have to delete and re-create it at the new commit.
-                    repo.references.delete(orig_branch)
-                repo.references.create(orig_branch, latest_commit_oid)
+            # pygit2 objects can't be shared between threads, so each has its own repository.
+            thread_repo = pygit2.Repository(repo.path)
+            p = subprocess.Popen(cmd, cwd=repo.path, stdin=subprocess.PIPE)
+            # Each git-fast-import process only knows about the blobs written to it.
+            written_blobs = WrittenBlobs()
+            try:
+                p.stdin.write(header.encode("utf8"))
+                for source in group:
+                    _check_stop_event(stop_event)
+                    replacing_dataset = None
+                    if replace_existing == ReplaceExisting.GIVEN:
+                        replacing_dataset = _get_replacing_dataset(thread_repo, source)
+                    with source:
+                        feature_counts[source.dest_path] = _import_single_source(
+                            thread_repo,
+                            p.stdin,
+                            source,
+                            dataset_class,
+                            replacing_dataset,
+                            written_blobs=written_blobs,
+                            stop_event=stop_event,
+                            **import_kwargs,
+                        )
+                p.stdin.write(b"\ndone\n")
+            except BrokenPipeError:
+                # if git-fast-import dies early, we get an EPIPE here
+                # we'll deal with it below
+                pass
+            except Exception:
+                # Without "done", git-fast-import exits without updating the stream branch.
+                with contextlib.suppress(BrokenPipeError):
+                    p.stdin.close()
+                p.wait()
+                raise
             else:
-                # head was detached before this. just update head to the new commit,
-                # so it's still detached.
-                repo.set_head(latest_commit_oid)
-        finally:
-            # remove the import branch
-            repo.references.delete(import_branch)
+                p.stdin.close()
+            p.wait()
+            if p.returncode != 0:
+                raise SubprocessError(
+                    f"git-fast-import error! {p.returncode}", exit_code=p.returncode
+                )
+        except _ImportStopped:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
 
+    if not import_kwargs["quiet"]:
+        click.echo(f"Starting {num_streams} git-fast-import processes...")
 
-def write_blobs_to_stream(stream, blobs):
-    for i, (blob_path, blob_data) in enumerate(blobs):
-        stream.write(
-            f"M 644 inline {blob_path}\ndata {len(blob_data)}\n".encode("utf8")
+    threads = [
+        threading.Thread(
+            target=_import_group,
+            args=(group, generate_header(repo, sources, message, stream_branch)),
+        )
+        for group, stream_branch in zip(groups, stream_branches)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        # Compose the imported datasets into a single tree.
+        tree_builder = RichTreeBuilder(repo, base_tree)
+        for blob_path, blob_data in extra_blobs:
+            if base_tree is not None and blob_path in base_tree:
+                raise ValueError(f"{blob_path} already exists")
+            tree_builder.insert(blob_path, blob_data)
+        for group, stream_branch in zip(groups, stream_branches):
+            stream_tree = repo.references[stream_branch].peel(pygit2.Tree)
+            for source in group:
+                tree_builder.insert(source.dest_path, stream_tree / source.dest_path)
+        new_tree = tree_builder.flush()
+    finally:
+        for stream_branch in stream_branches:
+            if stream_branch in repo.references:
+                repo.references.delete(stream_branch)
+
+    if message is None:
+        message = generate_message(sources)
+    repo.create_commit(
+        import_branch,
+        git_util.author_signature(repo),
+        git_util.committer_signature(repo),
+        message,
+        new_tree.oid,
+        [parent_commit.oid] if parent_commit is not None else [],
+    )
+
+
+# Blobs are sorted in memory until they reach this total size, and are then written to disk.
+SORT_BUFFER_SIZE = 256 * 1024 * 1024
+
+
+def _blob_path(blob):
+    return blob[0]
+
+
+def sort_blobs_by_path(blobs, *, buffer_size=SORT_BUFFER_SIZE, tmp_dir=None):
+    """
+    Yields the given (path, data) blobs sorted by path. data can be bytes or a pygit2.Oid.
+    Uses an external merge sort - see BlobSorter.
+    """
+    sorter = BlobSorter(buffer_size=buffer_size, tmp_dir=tmp_dir)
+    try:
+        for blob_path, blob_data in blobs:
+            sorter.add(blob_path, blob_data)
+        yield from sorter.sorted_blobs()
+    finally:
+        sorter.close()
+
+
+class BlobSorter:
+    """
+    Sorts (path, data) blobs by path using an external merge sort: blobs are sorted in memory in runs of
+    up to buffer_size bytes, any runs that don't fit in memory are written to temporary files, and then
+    all runs are merged. data can be bytes, a pygit2.Oid, or None.
+    """
+
+    def __init__(self, *, buffer_size=SORT_BUFFER_SIZE, tmp_dir=None):
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self._run_files = contextlib.ExitStack()
+        self._runs = []
+        self._run = []
+        self._run_size = 0
+
+    def add(self, blob_path, blob_data):
+        self._run.append((blob_path, blob_data))
+        self._run_size += len(blob_path)
+        if blob_data is not None:
+            self._run_size += len(getattr(blob_data, "raw", blob_data))
+        if self._run_size >= self.buffer_size:
+            run_file = self._run_files.enter_context(
+                tempfile.TemporaryFile(dir=self.tmp_dir)
+            )
+            self._runs.append(_spill_sorted_run(self._run, run_file))
+            self._run = []
+            self._run_size = 0
+
+    def sorted_blobs(self):
+        """
+        Yields every blob that was added, sorted by path. Blobs with the same path are yielded
+        in the order they were added. No more blobs should be added once this is called.
+        """
+        run = self._run
+        run.sort(key=_blob_path)
+        if self._runs:
+            L.info(f"Merging {len(self._runs) + 1} sorted runs of blobs")
+            yield from heapq.merge(*self._runs, run, key=_blob_path)
+        else:
+            yield from run
+
+    def close(self):
+        """Deletes any temporary files."""
+        self._run_files.close()
+        self._runs = []
+        self._run = []
+
+
+def _spill_sorted_run(run, run_file):
+    """Sorts the given blobs and writes them to run_file. Returns an iterator to read them back."""
+    run.sort(key=_blob_path)
+    packer = msgpack.Packer(use_bin_type=True)
+    for blob_path, blob_data in run:
+        is_oid = isinstance(blob_data, pygit2.Oid)
+        run_file.write(
+            packer.pack((blob_path, is_oid, blob_data.raw if is_oid else blob_data))
+        )
+    run.clear()
+    run_file.seek(0)
+    return (
+        (blob_path, pygit2.Oid(raw=data) if is_oid else data)
+        for blob_path, is_oid, data in msgpack.Unpacker(
+            run_file, raw=False, use_list=False
         )
-        stream.write(blob_data)
-        stream.write(b"\n")
+    )
+
+
+class WrittenBlobs:
+    """
+    A bounded record of the IDs of blobs that have been written to a git-fast-import stream.
+    A blob that has already been written can be referred to by its ID, instead of being sent again -
+    git-fast-import accepts the ID of any blob it has written, or that exists in the repository.
+    Once max_size blob IDs are recorded, the least recently used are forgotten.
+    """
+
+    # Each ID uses around 150 bytes of memory.
+    DEFAULT_MAX_SIZE = 250000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self._ids = collections.OrderedDict()
+
+    def check_and_add(self, blob_id):
+        """Returns True if the given blob ID has already been written - if not, records that it now has."""
+        key = blob_id.raw
+        if key in self._ids:
+            self._ids.move_to_end(key)
+            self.hits += 1
+            return True
+        self._ids[key] = None
+        if len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+        return False
+
+
+def write_blobs_to_stream(stream, blobs, written_blobs=None):
+    """
+    Writes (path, data) blobs to the given git-fast-import stream, yielding (i, path) as each is written.
+    data can be a pygit2.Oid instead of bytes, if the blob already exists in the repository -
+    or a HashedBlob, if its OID has already been calculated.
+    written_blobs - a WrittenBlobs object. If supplied, blobs that have already been written to this
+        stream are referred to by ID, instead of being written again.
+    """
+    if isinstance(stream, NativeImport):
+        for i, (blob_path, blob_data) in enumerate(blobs):
+            stream.write_blob(blob_path, blob_data)
+            yield i, blob_path
+        return
+
+    for i, (blob_path, blob_data) in enumerate(blobs):
+        if written_blobs is not None and not isinstance(blob_data, pygit2.Oid):
+            if isinstance(blob_data, HashedBlob):
+                blob_id = blob_data.id
+            else:
+                blob_id = pygit2.hash(blob_data)
+            if written_blobs.check_and_add(blob_id):
+                blob_data = blob_id
+        if isinstance(blob_data, pygit2.Oid):
+            stream.write(f"M 644 {blob_data.hex} {blob_path}\n".encode("utf8"))
+        else:
+            stream.write(
+                f"M 644 inline {blob_path}\ndata {len(blob_data)}\n".encode("utf8")
+            )
+            stream.write(blob_data)
+            stream.write(b"\n")
         yield i, blob_path
 
 
@@ -0,0 +1,87 @@
+import atexit
+import collections
+import logging
+
+
+L = logging.getLogger("sno.feature_cache")
+
+
+class FeatureCache:
+    """
+    A process-wide cache of decoded features, so that a command that reads the same feature blob more
+    than once - eg diff reading both versions of a feature, or a merge reading the ancestor, ours and
+    theirs - only decodes it once. Features are keyed by (blob ID, primary key values, schema), since a
+    feature blob doesn't contain the primary key values, and the same blob decodes differently under a
+    different schema. Each feature is stored as a tuple of values in schema order.
+    Once the cached features are estimated to use more than max_size bytes, the least recently used
+    are forgotten.
+    """
+
+    DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+    # Rough memory overhead of each entry and each value, on top of the size of any bytes / str values.
+    ENTRY_OVERHEAD = 200
+    VALUE_OVERHEAD = 16
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._features = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._features)
+
+    def get(self, key):
+        """Returns the feature with the given key, or None if it isn't cached."""
+        entry = self._features.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._features.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, feature):
+        """Caches the given feature - a tuple of values - with the given key."""
+        size = self.ENTRY_OVERHEAD
+        for value in feature:
+            size += self.VALUE_OVERHEAD
+            if isinstance(value, (bytes, str)):
+                size += len(value)
+        if size > self.max_size:
+            return
+        old_entry = self._features.pop(key, None)
+        if old_entry is not None:
+            self.size -= old_entry[1]
+        self._features[key] = (feature, size)
+        self.size += size
+        while self.size > self.max_size:
+            evicted_feature, evicted_size = self._features.popitem(last=False)[1]
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        """Forgets every cached feature. The hit and miss counts are kept."""
+        self._features.clear()
+        self.size = 0
+
+    def log_stats(self):
+        if not (self.hits or self.misses):
+            return
+        L.info(
+            "Feature cache: %d hits, %d misses, %d evictions, %d features cached (~%d KiB)",
+            self.hits,
+            self.misses,
+            self.evictions,
+            len(self._features),
+            self.size // 1024,
+        )
+
+
+feature_cache = FeatureCache()
+
+# So that running any command with -v shows how effective the cache was.
+atexit.register(feature_cache.log_stats)
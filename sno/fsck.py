@@ -5,6 +5,7 @@ import click
 import pygit2
 
 from . import gpkg
+from .dataset_stats import DatasetStatsCache
 from .exceptions import NotFound, NO_WORKING_COPY
 from .structure import RepositoryStructure
 
@@ -77,6 +78,7 @@ def fsck(ctx, reset_datasets, fsck_args):
             raise click.Abort()
 
         has_err = False
+        stats_cache = DatasetStatsCache(repo)
         for dataset in rs:
             click.secho(
                 f"\nDataset: '{dataset.path}/' (table: '{dataset.table_name}')",
@@ -96,7 +98,7 @@ def fsck(ctx, reset_datasets, fsck_args):
             dbcur.execute(f"SELECT COUNT(*) FROM {gpkg.ident(table)};")
             wc_count = dbcur.fetchall()[0][0]
             click.echo(f"{wc_count} features in {table}")
-            ds_count = dataset.feature_count
+            ds_count = stats_cache.feature_count(dataset)
             if wc_count != ds_count:
                 has_err = True
                 click.secho(
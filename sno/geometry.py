@@ -246,6 +246,113 @@ def parse_gpkg_geom(gpkg_geom):
     return wkb_offset, is_le, crs_id
 
 
+def gpkg_geom_to_envelope(gpkg_geom):
+    """
+    Returns the 2D envelope of the given GPKG geometry as a tuple (min_x, max_x, min_y, max_y),
+    or None if the geometry is None or empty. Uses the envelope from the GPKG header if there is
+    one - as there normally is, except for points - otherwise see wkb_to_envelope.
+    """
+    if gpkg_geom is None:
+        return None
+    flags = _validate_gpkg_geom(gpkg_geom)
+    if flags & _GPKG_EMPTY_BIT:
+        return None
+
+    envelope_size = gpkg_envelope_size(flags)
+    if envelope_size:
+        is_le = (flags & _GPKG_LE_BIT) != 0
+        return struct.unpack_from(f"{_bo(is_le)}dddd", gpkg_geom, 8)
+
+    return wkb_to_envelope(gpkg_geom, wkb_offset=8)
+
+
+def wkb_to_envelope(wkb, wkb_offset=0):
+    """
+    Returns the 2D envelope of the given WKB as a tuple (min_x, max_x, min_y, max_y), or None if
+    the geometry is empty. The coordinates are read directly from the WKB, without creating an OGR
+    geometry - except for curved geometries, since the envelope of an arc isn't the envelope of
+    the points that define it.
+    """
+    bounds = [math.inf, -math.inf, math.inf, -math.inf]
+    if _extend_wkb_bounds(wkb, wkb_offset, bounds) is None:
+        ogr_geom = ogr.CreateGeometryFromWkb(bytes(wkb[wkb_offset:]))
+        if ogr_geom.IsEmpty():
+            return None
+        return ogr_geom.GetEnvelope()
+    if bounds[0] > bounds[1]:
+        return None
+    return tuple(bounds)
+
+
+_WKB_MULTI_TYPES = (
+    ogr.wkbMultiPoint,
+    ogr.wkbMultiLineString,
+    ogr.wkbMultiPolygon,
+    ogr.wkbGeometryCollection,
+)
+
+
+def _extend_wkb_bounds(buf, offset, bounds):
+    """
+    Extends bounds - a list [min_x, max_x, min_y, max_y] - to include every point of the WKB
+    geometry at the given offset. Returns the offset of the end of the geometry, or None if the
+    geometry contains a type that isn't supported, in which case bounds is only partly extended.
+    """
+    is_le, geom_type = _wkb_endianness_and_geometry_type(buf, wkb_offset=offset)
+    bo = _bo(is_le)
+    offset += 5
+    flat_geom_type = ogr.GT_Flatten(geom_type)
+    dims = 2
+    if ogr.GT_HasZ(geom_type):
+        dims += 1
+    if ogr.GT_HasM(geom_type):
+        dims += 1
+
+    if flat_geom_type == ogr.wkbPoint:
+        x, y = struct.unpack_from(f"{bo}dd", buf, offset)
+        # An empty point has NaN coordinates.
+        if not math.isnan(x):
+            _extend_bounds(bounds, (x,), (y,))
+        return offset + dims * 8
+
+    (count,) = struct.unpack_from(f"{bo}I", buf, offset)
+    offset += 4
+    if flat_geom_type == ogr.wkbLineString:
+        return _extend_bounds_from_points(buf, offset, count, dims, bo, bounds)
+    elif flat_geom_type == ogr.wkbPolygon:
+        for i in range(count):
+            (num_points,) = struct.unpack_from(f"{bo}I", buf, offset)
+            offset = _extend_bounds_from_points(
+                buf, offset + 4, num_points, dims, bo, bounds
+            )
+        return offset
+    elif flat_geom_type in _WKB_MULTI_TYPES:
+        for i in range(count):
+            offset = _extend_wkb_bounds(buf, offset, bounds)
+            if offset is None:
+                return None
+        return offset
+    return None
+
+
+def _extend_bounds_from_points(buf, offset, num_points, dims, bo, bounds):
+    """
+    Extends bounds to include the given number of points, which are stored in buf at the given offset,
+    and returns the offset of the end of the points.
+    """
+    if num_points:
+        coords = struct.unpack_from(f"{bo}{num_points * dims}d", buf, offset)
+        _extend_bounds(bounds, coords[0::dims], coords[1::dims])
+    return offset + num_points * dims * 8
+
+
+def _extend_bounds(bounds, xs, ys):
+    bounds[0] = min(bounds[0], *xs)
+    bounds[1] = max(bounds[1], *xs)
+    bounds[2] = min(bounds[2], *ys)
+    bounds[3] = max(bounds[3], *ys)
+
+
 def gpkg_geom_to_ogr(gpkg_geom, parse_crs=False):
     """
     Parse GeoPackage geometry values to an OGR Geometry object
@@ -468,60 +575,3 @@ def hexewkb_to_gpkg_geom(hexewkb):
 
     # TODO: Construct normalised GPKG geometry in one go.
     return normalise_gpkg_geom(gpkg_geom)
-
-
-def geom_envelope(gpkg_geom):
-    """
-    Parse GeoPackage geometry to a 2D envelope.
-    This is a shortcut to avoid instantiating a full OGR geometry if possible.
-
-    Returns a 4-tuple (minx, maxx, miny, maxy), or None if the geometry is empty.
-
-    http://www.geopackage.org/spec/#gpb_format
-    """
-    if gpkg_geom is None:
-        return None
-
-    if not isinstance(gpkg_geom, bytes):
-        raise TypeError("Expected bytes")
-
-    if gpkg_geom[0:2] != b"GP":  # 0x4750
-        raise ValueError("Expected GeoPackage Binary Geometry")
-    (version, flags) = struct.unpack_from("BB", gpkg_geom, 2)
-    if version != 0:
-        raise NotImplementedError("Expected GeoPackage v1 geometry, got %d", version)
-
-    is_le = (flags & _GPKG_LE_BIT) != 0  # Endian-ness
-
-    if flags & (0b00100000):  # GeoPackageBinary type
-        raise NotImplementedError("ExtendedGeoPackageBinary")
-
-    if flags & _GPKG_EMPTY_BIT:  # Empty geometry
-        return None
-
-    envelope_typ = (flags & _GPKG_ENVELOPE_BITS) >> 1
-    # E: envelope contents indicator code (3-bit unsigned integer)
-    # 0: no envelope (space saving slower indexing option), 0 bytes
-    # 1: envelope is [minx, maxx, miny, maxy], 32 bytes
-    # 2: envelope is [minx, maxx, miny, maxy, minz, maxz], 48 bytes
-    # 3: envelope is [minx, maxx, miny, maxy, minm, maxm], 48 bytes
-    # 4: envelope is [minx, maxx, miny, maxy, minz, maxz, minm, maxm], 64 bytes
-    # 5-7: invalid
-
-    if envelope_typ == 0:
-        # parse the full geometry then get it's envelope
-        ogr_geom = gpkg_geom_to_ogr(gpkg_geom)
-        if ogr_geom.IsEmpty():
-            # envelope is apparently (0, 0, 0, 0), thanks OGR :/
-            return None
-        else:
-            return ogr_geom.GetEnvelope()
-    elif envelope_typ <= 4:
-        # we only care about 2D envelopes here
-        envelope = struct.unpack_from(f"{'<' if is_le else '>'}dddd", gpkg_geom, 8)
-        if any(math.isnan(c) for c in envelope):
-            return None
-        else:
-            return envelope
-    else:
-        raise ValueError("Invalid envelope contents indicator")
@@ -1,5 +1,6 @@
 import click
 import functools
+import itertools
 
 from .meta_items import META_ITEM_NAMES
 from .schema import Schema
@@ -119,6 +120,32 @@ class ImportSource:
         """
         raise NotImplementedError()
 
+    # Default number of features in each batch yielded by feature_batches.
+    FEATURE_BATCH_SIZE = 5000
+
+    def feature_batches(self, batch_size=None):
+        """
+        Yields lists of up to batch_size features, where each feature is a tuple of values in
+        schema order (rather than a dict). Subclasses should override this if they can read
+        features more efficiently in batches - eg by converting values a column at a time.
+        """
+        batch_size = batch_size or self.FEATURE_BATCH_SIZE
+        col_names = [c.name for c in self.schema]
+        features = self.features()
+        while True:
+            batch = [
+                tuple(f[name] for name in col_names)
+                for f in itertools.islice(features, batch_size)
+            ]
+            if not batch:
+                return
+            yield batch
+
+    def feature_tuples(self):
+        """Yields every feature as a tuple of values in schema order - see feature_batches."""
+        for batch in self.feature_batches():
+            yield from batch
+
     @property
     def feature_count(self):
         """Returns the number of features in self.features"""
@@ -128,6 +155,23 @@ class ImportSource:
             count += 1
         return count
 
+    @property
+    def estimated_feature_count(self):
+        """
+        Returns the number of features in self.features, or an estimate of it - or None if it
+        can't be found without reading every feature. Used for progress reporting only.
+        """
+        # Subclasses should override this if they have a cheap way to count or estimate features.
+        return None
+
+    def reopen(self):
+        """
+        Returns an equivalent ImportSource with its own resources (connections, file handles etc),
+        so that it can be read on a different thread to this one. Raises NotImplementedError
+        if this ImportSource doesn't support being read concurrently.
+        """
+        raise NotImplementedError()
+
     def __enter__(self):
         """Some import sources have resources that need to be opened and closed."""
         pass
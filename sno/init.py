@@ -9,16 +9,24 @@ from osgeo import gdal
 from sno import is_windows
 from . import checkout
 from .core import check_git_user
-from .cli_util import call_and_exit_flag, MutexOption, StringFromFile, JsonFromFile
+from .cli_util import (
+    call_and_exit_flag,
+    MutexOption,
+    OutOfLineType,
+    PathStructureType,
+    StringFromFile,
+    JsonFromFile,
+)
 from .exceptions import InvalidOperation
 from .import_source import ImportSource
 from .ogr_import_source import OgrImportSource, FORMAT_TO_OGR_MAP
-from .fast_import import fast_import_tables, ReplaceExisting
+from .fast_import import fast_import_tables, ImportBackend, ReplaceExisting
 from .structure import RepositoryStructure
-from .sno_repo import SnoRepo
+from .sno_repo import SnoConfigKeys, SnoRepo
 from .repository_version import (
     REPO_VERSIONS_CHOICE,
     REPO_VERSIONS_DEFAULT_CHOICE,
+    get_repo_version,
 )
 from .working_copy import WorkingCopy
 
@@ -150,6 +158,71 @@ def _add_datasets_to_working_copy(repo, *datasets, replace_existing=False):
     type=click.INT,
     help="--depth option to git-fast-import (advanced users only)",
 )
+@click.option(
+    "--workers",
+    "num_workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help=(
+        "Number of worker processes to use when encoding features. "
+        "Values greater than 1 can speed up importing large datasets."
+    ),
+)
+@click.option(
+    "--streams",
+    "num_streams",
+    default=1,
+    type=click.IntRange(min=1),
+    help=(
+        "Number of tables to import concurrently, each using its own git-fast-import process. "
+        "Only useful when importing more than one table."
+    ),
+)
+@click.option(
+    "--checkpoint-interval",
+    type=click.IntRange(min=1),
+    help=(
+        "Save progress every time this many features are imported, so that an interrupted "
+        "import can be resumed with --resume. Off by default - only worthwhile for very "
+        "large imports, since each checkpoint starts a new pack."
+    ),
+)
+@click.option(
+    "--sort-by-path",
+    is_flag=True,
+    help=(
+        "Write each dataset's features in path order, rather than in the order they are read. "
+        "Uses more memory and temporary disk space, but the resulting repository is better "
+        "organised and benefits more from --max-delta-depth."
+    ),
+)
+@click.option(
+    "--path-structure",
+    type=PathStructureType(),
+    help=(
+        "How features are sharded into trees: 'auto' to choose based on the number of features, "
+        "or LEVELSxBRANCHES eg '3x256'. Defaults to the sno.dataset.pathStructure config, or 2x256. "
+        "More levels make commits to huge datasets quicker."
+    ),
+)
+@click.option(
+    "--out-of-line",
+    type=OutOfLineType(),
+    help=(
+        "Which values are stored out-of-line, each in a blob of its own: 'none', 'geometry', "
+        "a minimum size in bytes eg '65536', or both eg 'geometry,65536'. Defaults to the "
+        "sno.dataset.outOfLine config, or 'none'. Large values that are stored out-of-line are "
+        "not written again when only the other attributes of a feature are edited."
+    ),
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help=(
+        "Resume an import that was interrupted, from its last saved checkpoint. "
+        "The same source, tables and options should be supplied as when the import was started."
+    ),
+)
 @click.option(
     "--checkout/--no-checkout",
     "do_checkout",
@@ -170,6 +243,13 @@ def import_table(
     replace_existing,
     allow_empty,
     max_delta_depth,
+    num_workers,
+    num_streams,
+    checkpoint_interval,
+    sort_by_path,
+    path_structure,
+    out_of_line,
+    resume,
     do_checkout,
 ):
     """
@@ -199,9 +279,40 @@ def import_table(
         )
         return
 
+    if num_streams > 1 or sort_by_path:
+        # Checkpoints aren't supported when importing multiple streams, or sorting by path.
+        option = "--streams" if num_streams > 1 else "--sort-by-path"
+        if resume:
+            raise click.UsageError(
+                f"Illegal usage: '--resume' doesn't support {option}"
+            )
+        if checkpoint_interval:
+            raise click.UsageError(
+                f"Illegal usage: '--checkpoint-interval' doesn't support {option}"
+            )
+
     repo = ctx.obj.repo
     check_git_user(repo)
 
+    if ImportBackend.from_config(repo) == ImportBackend.NATIVE:
+        # The native import backend writes a single pack, without checkpoints.
+        for option, is_set in (
+            ("--streams", num_streams > 1),
+            ("--checkpoint-interval", checkpoint_interval),
+        ):
+            if is_set:
+                raise click.UsageError(
+                    f"Illegal usage: '{option}' isn't supported by the native import backend "
+                    f"({SnoConfigKeys.SNO_IMPORT_BACKEND}={ImportBackend.NATIVE.value})"
+                )
+
+    repo_version = get_repo_version(repo)
+    if checkpoint_interval and repo_version >= 3:
+        # Datasets V3 are packed into buckets, which can't be written until every feature is read.
+        raise click.UsageError(
+            f"Illegal usage: '--checkpoint-interval' isn't supported for V{repo_version} repositories"
+        )
+
     if (
         not do_checkout
         and WorkingCopy.get(
@@ -266,6 +377,13 @@ def import_table(
         import_sources,
         message=message,
         max_delta_depth=max_delta_depth,
+        num_workers=num_workers,
+        num_streams=num_streams,
+        checkpoint_interval=checkpoint_interval,
+        sort_by_path=sort_by_path,
+        path_structure=path_structure,
+        out_of_line=out_of_line,
+        resume=resume,
         replace_existing=ReplaceExisting.GIVEN
         if replace_existing
         else ReplaceExisting.DONT_REPLACE,
@@ -10,7 +10,7 @@ from .conflicts import (
     conflicts_json_as_text,
 )
 from .diff import get_repo_diff
-from .exceptions import InvalidOperation
+from .exceptions import InvalidOperation, NotYetImplemented
 from .merge_util import AncestorOursTheirs, MergeIndex, MergeContext
 from .output_util import dump_json_output
 from .repo_files import (
@@ -112,6 +112,12 @@ def do_merge(repo, ff, ff_only, dry_run, commit, commit_message, quiet=False):
         index = repo.merge_trees(**tree3.as_dict())
 
     if index.conflicts:
+        if repo.version >= 3:
+            # Features are packed into buckets in Datasets V3, so these conflicts are between
+            # whole buckets - which may just hold different features that were edited on each side.
+            raise NotYetImplemented(
+                "Sorry, merges with conflicts are not yet supported for Datasets V3"
+            )
         merge_index = MergeIndex.from_pygit2_index(index)
 
         merge_jdict["conflicts"] = list_conflicts(
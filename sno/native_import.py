@@ -0,0 +1,213 @@
+import logging
+import re
+
+import pygit2
+
+from .pack_writer import PackWriter, OBJ_COMMIT
+from .serialise_util import HashedBlob
+
+
+L = logging.getLogger("sno.native_import")
+
+
+class NativeImport:
+    """
+    An in-process alternative to running a git-fast-import subprocess, which writes all objects
+    straight into a single new packfile using PackWriter.
+
+    Accepts the subset of the git-fast-import stream format that fast_import_tables writes -
+    a single commit, with optional from, merge and D commands - except that blobs are not written
+    to the stream as inline data, they are supplied using write_blob() instead.
+    Blob paths are sorted by path as they arrive - using an external merge sort, so they need not all
+    fit in memory - and once the stream is finished, trees are built bottom-up from the sorted paths.
+
+    Has the same interface as the subprocess.Popen object that it replaces - stdin, wait() and returncode -
+    except that if the import fails, wait() raises whatever caused it.
+    """
+
+    SIGNATURE_RE = re.compile(r"^(author|committer) (.+)$")
+
+    def __init__(self, repo):
+        from .fast_import import BlobSorter
+
+        self.repo = repo
+        self.stdin = self
+        self.returncode = None
+        self.error = None
+
+        self.pack_writer = PackWriter(repo)
+        self._buffer = b""
+        self._ref = None
+        self._signatures = {}
+        self._message = None
+        self._parents = []
+        self._done = False
+        # Sorts (path, raw_oid) items - a raw_oid of None means delete whatever is at path.
+        self._items = BlobSorter(tmp_dir=repo.path)
+
+    def write(self, data):
+        self._buffer += data
+        while self._buffer and self._parse_command():
+            pass
+
+    def flush(self):
+        pass
+
+    def write_blob(self, path, data):
+        """Adds the given blob at the given path. Data can be bytes, or the pygit2.Oid of an existing blob."""
+        if isinstance(data, pygit2.Oid):
+            oid = data
+        else:
+            known_oid = data.id if isinstance(data, HashedBlob) else None
+            oid = self.pack_writer.add_blob(data, known_oid)
+        self._items.add(path, oid.raw)
+
+    def close(self):
+        if not self._done:
+            # The stream was never finished - none of it is written to the repository.
+            self.pack_writer.abort()
+            self._items.close()
+            self.returncode = 1
+            return
+        try:
+            self._finish()
+            self.returncode = 0
+        except Exception as e:
+            self.error = e
+            self.returncode = 1
+        finally:
+            self._items.close()
+
+    def wait(self):
+        if self.error is not None:
+            raise self.error
+        return self.returncode
+
+    def _parse_command(self):
+        """
+        Parses and handles a single command from the start of the buffer.
+        Returns False if the buffer doesn't yet contain a complete command.
+        """
+        self._buffer = self._buffer.lstrip(b"\n")
+        line, sep, rest = self._buffer.partition(b"\n")
+        if not sep:
+            return False
+
+        line = line.decode("utf8")
+        if line.startswith("data "):
+            length = int(line[5:])
+            if len(rest) < length:
+                return False
+            self._message = rest[:length]
+            rest = rest[length:]
+        elif line.startswith("commit "):
+            if self._ref is not None:
+                raise ValueError("Native import only supports a single commit")
+            self._ref = line[7:]
+        elif self.SIGNATURE_RE.match(line):
+            kind, signature = self.SIGNATURE_RE.match(line).groups()
+            self._signatures[kind] = signature
+        elif line.startswith("from ") or line.startswith("merge "):
+            commitish = line.split(" ", 1)[1]
+            commit = self.repo.revparse_single(commitish).peel(pygit2.Commit)
+            self._parents.append(commit.id)
+        elif line.startswith("D "):
+            self._items.add(line[2:], None)
+        elif line == "done":
+            self._done = True
+        else:
+            raise ValueError(f"Unsupported command for native import: {line}")
+
+        self._buffer = rest
+        return True
+
+    def _finish(self):
+        base_tree = None
+        if self._parents:
+            base_tree = self.repo[self._parents[0]].peel(pygit2.Tree)
+
+        tree_oid = self._write_trees(base_tree, self._items.sorted_blobs())
+        if tree_oid is None:
+            tree_oid = self.pack_writer.add_tree([])
+
+        commit_data = b"".join(
+            [
+                b"tree %s\n" % tree_oid.hex.encode(),
+                *(b"parent %s\n" % p.hex.encode() for p in self._parents),
+                b"author %s\n" % self._signatures["author"].encode("utf8"),
+                b"committer %s\n" % self._signatures["committer"].encode("utf8"),
+                b"\n",
+                self._message,
+            ]
+        )
+        commit_oid = self.pack_writer.add_object(OBJ_COMMIT, commit_data)
+        self.pack_writer.finish()
+
+        self.repo.references.create(self._ref, commit_oid, force=True)
+
+    def _write_trees(self, base_tree, sorted_items):
+        """
+        Writes the trees that result from modifying base_tree (if any) by the given (path, raw_oid) items,
+        which must be sorted by path - so that the items inside each tree are contiguous. Each tree is
+        written to the pack as soon as the items move past it, so only the entries of the trees that are
+        currently open are kept in memory. Returns the root tree's pygit2.Oid, or None if it is empty.
+        """
+        # The names of the trees that are open, from the root down, and a dict of entries for each -
+        # starting out as those of the existing tree, if there is one.
+        open_names = []
+        open_entries = [self._tree_entries(base_tree)]
+
+        for path, raw_oid in sorted_items:
+            *tree_names, name = path.split("/")
+
+            common = 0
+            for open_name, tree_name in zip(open_names, tree_names):
+                if open_name != tree_name:
+                    break
+                common += 1
+            while len(open_names) > common:
+                self._close_tree(open_names, open_entries)
+
+            for tree_name in tree_names[common:]:
+                existing = open_entries[-1].get(tree_name)
+                sub_base_tree = None
+                if existing is not None and existing[0] == pygit2.GIT_FILEMODE_TREE:
+                    sub_base_tree = self.repo[existing[1]]
+                open_names.append(tree_name)
+                open_entries.append(self._tree_entries(sub_base_tree))
+
+            if raw_oid is None:
+                open_entries[-1].pop(name, None)
+            else:
+                open_entries[-1][name] = (
+                    pygit2.GIT_FILEMODE_BLOB,
+                    pygit2.Oid(raw=raw_oid),
+                )
+
+        while open_names:
+            self._close_tree(open_names, open_entries)
+        return self._add_tree(open_entries[0])
+
+    def _close_tree(self, open_names, open_entries):
+        """Writes the innermost open tree to the pack, and adds it to its parent - or removes it, if it is empty."""
+        name = open_names.pop()
+        tree_oid = self._add_tree(open_entries.pop())
+        if tree_oid is None:
+            open_entries[-1].pop(name, None)
+        else:
+            open_entries[-1][name] = (pygit2.GIT_FILEMODE_TREE, tree_oid)
+
+    def _add_tree(self, entries):
+        """Writes a tree with the given entries to the pack. Returns its pygit2.Oid, or None if it is empty."""
+        if not entries:
+            return None
+        return self.pack_writer.add_tree(
+            (name, mode, oid) for name, (mode, oid) in entries.items()
+        )
+
+    @staticmethod
+    def _tree_entries(tree):
+        """Returns a dict of {name: (filemode, pygit2.Oid)} for the entries of the given tree, if any."""
+        if tree is None:
+            return {}
+        return {obj.name: (obj.filemode, obj.id) for obj in tree}
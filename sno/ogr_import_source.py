@@ -1,4 +1,5 @@
 import functools
+import itertools
 import os
 import re
 import sys
@@ -17,7 +18,7 @@ from .exceptions import (
     NO_IMPORT_SOURCE,
     NO_TABLE,
 )
-from .geometry import Geometry, ogr_to_gpkg_geom
+from .geometry import Geometry, hexewkb_to_gpkg_geom, ogr_to_gpkg_geom
 from .import_source import ImportSource
 from .ogr_util import adapt_value_noop, get_type_value_adapter
 from .output_util import dump_json_output, get_input_mode, InputMode
@@ -224,6 +225,20 @@ class OgrImportSource(ImportSource):
             **meta_overrides,
         )
 
+    def reopen(self):
+        ds = self._ogr_open(self.ogr_source, allowed_drivers=[self.driver.ShortName])
+        result = self.__class__(
+            ds,
+            table=self.table,
+            source=self.source,
+            ogr_source=self.ogr_source,
+            primary_key=self._primary_key,
+            **self._meta_overrides,
+        )
+        result.schema = self.schema
+        result.dest_path = self.dest_path
+        return result
+
     @property
     @functools.lru_cache(maxsize=1)
     def ogrlayer(self):
@@ -302,6 +317,12 @@ class OgrImportSource(ImportSource):
     def feature_count(self):
         return self.ogrlayer.GetFeatureCount(force=False)
 
+    @property
+    def estimated_feature_count(self):
+        # Some drivers can't count features without reading them all - then OGR returns -1.
+        count = self.ogrlayer.GetFeatureCount(force=False)
+        return count if count >= 0 else None
+
     @property
     @functools.lru_cache(maxsize=1)
     def primary_key(self):
@@ -408,6 +429,62 @@ class OgrImportSource(ImportSource):
         for ogr_feature in self._iter_ogr_features():
             yield self._ogr_feature_to_sno_feature(ogr_feature)
 
+    # Typed getters which are faster than ogr.Feature.GetField, which has to look up the field type
+    # every time it is called. Other field types fall back to GetField.
+    OGR_TYPE_TO_FIELD_GETTER = {
+        ogr.OFTInteger: ogr.Feature.GetFieldAsInteger,
+        ogr.OFTInteger64: ogr.Feature.GetFieldAsInteger64,
+        ogr.OFTReal: ogr.Feature.GetFieldAsDouble,
+    }
+
+    def _ogr_column_reader(self, column):
+        """
+        Returns a function which takes a list of OGR features,
+        and returns a list of the values of the given column - one per feature.
+        """
+        name = column.name
+        if column.data_type == "geometry":
+            return lambda batch: [
+                Geometry.of(ogr_to_gpkg_geom(f.GetGeometryRef())) for f in batch
+            ]
+
+        if name == self.primary_key:
+            get_pk = self._get_primary_key_value
+            return lambda batch: [get_pk(f, name) for f in batch]
+
+        ld = self.ogrlayer.GetLayerDefn()
+        index = ld.GetFieldIndex(name)
+        field_type = ld.GetFieldDefn(index).GetType()
+        getter = self.OGR_TYPE_TO_FIELD_GETTER.get(field_type, ogr.Feature.GetField)
+        adapter = self.field_adapter_map[name]
+
+        def read_column(batch):
+            values = [
+                getter(f, index) if f.IsFieldSetAndNotNull(index) else None
+                for f in batch
+            ]
+            if adapter is not adapt_value_noop:
+                values = [adapter(v) for v in values]
+            return values
+
+        return read_column
+
+    def feature_batches(self, batch_size=None):
+        """
+        Overrides the super implementation for performance reasons - OGR features are read a batch
+        at a time, and each column is then converted for the whole batch at once, which avoids
+        building a dict and looking up the field and its type-adapter for every value.
+        """
+        # GDAL's Arrow stream interface would be faster still, but it requires GDAL >= 3.6.
+        batch_size = batch_size or self.FEATURE_BATCH_SIZE
+        column_readers = [self._ogr_column_reader(c) for c in self.schema]
+        ogr_features = self._iter_ogr_features()
+        while True:
+            batch = list(itertools.islice(ogr_features, batch_size))
+            if not batch:
+                return
+            yield list(zip(*[read_column(batch) for read_column in column_readers]))
+
     @functools.lru_cache()
     def get_meta_item(self, name):
         if name in self._meta_overrides:
@@ -688,6 +765,131 @@ class PostgreSQLImportSource(OgrImportSource):
         # this will either be a URL or a key=value conn str
         return psycopg2.connect(conn_str)
 
+    # Postgres types that are read as strings, in the same format that OGR reads them
+    # (after being converted by the type-adapters in ogr_util).
+    PG_TYPES_READ_AS_STRING = {
+        1082: "DATE",
+        1083: "TIME",
+        1266: "TIMETZ",
+        1186: "INTERVAL",
+        114: "JSON",
+        3802: "JSONB",
+    }
+    PG_TIMESTAMP_TYPES = {1114: "TIMESTAMP", 1184: "TIMESTAMPTZ"}
+    PG_BOOLEAN_OID = 16
+    PG_BYTEA_OID = 17
+    PG_NUMERIC_OID = 1700
+
+    def _register_pg_types(self, conn):
+        """
+        Registers type-casters on the given connection, so that values are read in the same form
+        as when they are read using OGR.
+        """
+        from psycopg2.extensions import new_type, register_type
+
+        def _register(oids, name, adapt):
+            register_type(new_type(oids, name, lambda v, cur: adapt(v)), conn)
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT oid FROM pg_type WHERE typname='geometry';")
+            row = cur.fetchone()
+        if row:
+            _register(
+                (row[0],),
+                "GEOMETRY",
+                lambda v: Geometry.of(hexewkb_to_gpkg_geom(v)),
+            )
+
+        _register(tuple(self.PG_TYPES_READ_AS_STRING), "STRING", lambda v: v)
+        _register(
+            tuple(self.PG_TIMESTAMP_TYPES),
+            "TIMESTAMP",
+            lambda v: v.replace(" ", "T").replace("+00", "Z") if v else v,
+        )
+        # OGR reads booleans as integers.
+        _register(
+            (self.PG_BOOLEAN_OID,),
+            "BOOLEAN",
+            lambda v: int(v == "t") if v is not None else None,
+        )
+        _register(
+            (self.PG_BYTEA_OID,),
+            "BYTEA",
+            lambda v: bytes.fromhex(v[2:]) if v is not None else None,
+        )
+
+    def _pg_column_converter(self, column, type_code):
+        """
+        Returns a function for converting values of the given column to the column's type,
+        if the type psycopg2 reads them as doesn't match - otherwise None.
+        """
+        if type_code == self.PG_NUMERIC_OID:
+            convert = {"integer": int, "float": float}.get(column.data_type, str)
+            return lambda v: convert(v) if v is not None else None
+        return None
+
+    def feature_batches(self, batch_size=None):
+        """
+        Overrides the super implementation for performance reasons - features are read using psycopg2
+        from a named (server-side) cursor, instead of using OGR's PostgreSQL driver.
+        Only batch_size rows are fetched from the server at a time.
+        """
+        from psycopg2.sql import Identifier, SQL
+
+        batch_size = batch_size or self.FEATURE_BATCH_SIZE
+        columns = list(self.schema)
+        query = SQL("SELECT {} FROM {};").format(
+            SQL(", ").join(Identifier(c.name) for c in columns),
+            Identifier(*self.table.split(".", 1)),
+        )
+
+        conn = self.psycopg2_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET timezone='UTC';")
+            self._register_pg_types(conn)
+
+            with conn.cursor(name="sno_import") as cur:
+                cur.itersize = batch_size
+                cur.execute(query)
+                rows = cur.fetchmany(batch_size)
+                converters = [
+                    (i, self._pg_column_converter(c, d.type_code))
+                    for i, (c, d) in enumerate(zip(columns, cur.description))
+                ]
+                converters = [(i, conv) for i, conv in converters if conv]
+
+                while rows:
+                    if converters:
+                        rows = [list(row) for row in rows]
+                        for i, convert in converters:
+                            for row in rows:
+                                row[i] = convert(row[i])
+                    yield [tuple(row) for row in rows]
+                    rows = cur.fetchmany(batch_size)
+        finally:
+            conn.close()
+
+    @property
+    @functools.lru_cache(maxsize=1)
+    def estimated_feature_count(self):
+        # OGR counts rows with SELECT COUNT(*), which reads the whole table (or view).
+        # Postgres' own estimate is good enough for progress reporting.
+        conn = self.psycopg2_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT reltuples, relkind FROM pg_class WHERE oid = %s::regclass;",
+                    [self.table],
+                )
+                reltuples, relkind = cur.fetchone()
+        finally:
+            conn.close()
+        # Views have no statistics, and tables that have never been analyzed have reltuples <= 0.
+        if relkind not in ("r", "p", "m") or reltuples <= 0:
+            return None
+        return int(reltuples)
+
     def _get_primary_key_value(self, ogr_feature, name):
         try:
             return ogr_feature.GetField(name)
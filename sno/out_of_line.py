@@ -0,0 +1,98 @@
+from collections import namedtuple
+
+from .exceptions import InvalidOperation
+from .geometry import Geometry
+
+
+class OutOfLine(namedtuple("OutOfLine", ("geometry", "min_size"))):
+    """
+    Which values of a Dataset2 feature are stored out-of-line - each in a blob of its own, which the
+    feature blob refers to by OID - rather than inline in the feature blob itself. A large value that
+    rarely changes, such as a detailed geometry, is then only written again when it actually changes,
+    rather than every time any other attribute of the feature is edited.
+
+    If geometry is True, every geometry is stored out-of-line. If min_size is set, every geometry, text
+    or blob value of at least that many bytes (or characters, for text) is stored out-of-line.
+    """
+
+    NONE = None  # Set below - every value is stored inline.
+
+    def __new__(cls, geometry=False, min_size=None):
+        if min_size is not None and min_size < 1:
+            raise ValueError(f"Invalid minimum size: {min_size} - should be at least 1")
+        return super().__new__(cls, bool(geometry), min_size)
+
+    def __str__(self):
+        parts = []
+        if self.geometry:
+            parts.append("geometry")
+        if self.min_size is not None:
+            parts.append(str(self.min_size))
+        return ",".join(parts) or "none"
+
+    @property
+    def enabled(self):
+        return self.geometry or self.min_size is not None
+
+    def stores_out_of_line(self, value):
+        """Returns True if the given value should be stored out-of-line."""
+        if self.geometry and isinstance(value, Geometry):
+            return True
+        return (
+            self.min_size is not None
+            and isinstance(value, (bytes, str))
+            and len(value) >= self.min_size
+        )
+
+    def to_json(self):
+        return {"geometry": self.geometry, "minSize": self.min_size}
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(json_dict.get("geometry", False), json_dict.get("minSize"))
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Parses an out-of-line spec - either "none", "geometry", a minimum size eg "65536",
+        or both eg "geometry,65536". Returns an OutOfLine. Raises ValueError if the spec is invalid.
+        """
+        spec = spec.strip().lower()
+        if spec == "none":
+            return cls.NONE
+        geometry = False
+        min_size = None
+        for part in spec.split(","):
+            part = part.strip()
+            if part == "geometry" and not geometry:
+                geometry = True
+                continue
+            try:
+                if min_size is not None:
+                    raise ValueError()
+                min_size = int(part)
+            except ValueError:
+                raise ValueError(
+                    f"Invalid out-of-line spec: {spec} - should be 'none', 'geometry', MIN_SIZE or 'geometry,MIN_SIZE'"
+                )
+        return cls(geometry, min_size)
+
+    @classmethod
+    def from_config(cls, repo):
+        """
+        Returns the OutOfLine configured by sno.dataset.outOfLine, or None if it is not set -
+        in which case datasets use OutOfLine.NONE.
+        """
+        from .sno_repo import SnoConfigKeys
+
+        config = repo.config
+        key = SnoConfigKeys.SNO_DATASET_OUT_OF_LINE
+        if key not in config:
+            return None
+        try:
+            return cls.parse(config[key])
+        except ValueError as e:
+            raise InvalidOperation(f"Invalid value for {key}: {e}")
+
+
+OutOfLine.NONE = OutOfLine()
@@ -0,0 +1,181 @@
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+from pathlib import Path
+
+import pygit2
+
+
+# Pack object types - see https://git-scm.com/docs/pack-format
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+
+_TYPE_NAMES = {
+    OBJ_COMMIT: b"commit",
+    OBJ_TREE: b"tree",
+    OBJ_BLOB: b"blob",
+}
+
+PACK_SIGNATURE = b"PACK"
+PACK_VERSION = 2
+IDX_SIGNATURE = b"\377tOc"
+IDX_VERSION = 2
+
+# Offsets larger than this are stored in the 64-bit offset table of the index.
+MAX_SMALL_OFFSET = 0x7FFFFFFF
+
+
+def _tree_entry_sort_key(entry):
+    # Git sorts tree entries as if subtree names had a trailing slash.
+    name, mode, oid = entry
+    name = name.encode("utf8")
+    return name + b"/" if mode == pygit2.GIT_FILEMODE_TREE else name
+
+
+class PackWriter:
+    """
+    Writes git objects straight into a new packfile (plus its index) in the given repository,
+    without using git-fast-import or writing loose objects. Objects are not deltified.
+    Objects aren't visible to the repository until finish() is called.
+    """
+
+    def __init__(self, repo, compression_level=zlib.Z_DEFAULT_COMPRESSION):
+        self.repo = repo
+        self.pack_dir = Path(repo.path) / "objects" / "pack"
+        self.compression_level = compression_level
+
+        fd, tmp_path = tempfile.mkstemp(
+            prefix="tmp_pack_", suffix=".pack", dir=self.pack_dir
+        )
+        self.tmp_path = Path(tmp_path)
+        self.file = os.fdopen(fd, "w+b")
+        # The object count isn't known until the end - it is filled in by finish().
+        self.file.write(struct.pack(">4sII", PACK_SIGNATURE, PACK_VERSION, 0))
+        self.offset = self.file.tell()
+
+        # raw-oid -> (crc32, offset)
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_object(self, obj_type, data, oid=None):
+        """
+        Adds an object of the given type to the pack, and returns its pygit2.Oid.
+        If the object's oid is supplied, it is trusted, rather than calculated again.
+        """
+        if oid is not None:
+            raw_oid = oid.raw
+        else:
+            sha = hashlib.sha1(b"%s %d\0" % (_TYPE_NAMES[obj_type], len(data)))
+            sha.update(data)
+            raw_oid = sha.digest()
+        if raw_oid in self.entries:
+            return pygit2.Oid(raw=raw_oid)
+
+        # Object header: type and size, as a variable length integer.
+        size = len(data)
+        byte = (obj_type << 4) | (size & 0x0F)
+        size >>= 4
+        header = bytearray()
+        while size:
+            header.append(byte | 0x80)
+            byte = size & 0x7F
+            size >>= 7
+        header.append(byte)
+
+        compressed = zlib.compress(data, self.compression_level)
+        crc = zlib.crc32(compressed, zlib.crc32(header))
+        self.file.write(header)
+        self.file.write(compressed)
+
+        self.entries[raw_oid] = (crc, self.offset)
+        self.offset += len(header) + len(compressed)
+        return pygit2.Oid(raw=raw_oid)
+
+    def add_blob(self, data, oid=None):
+        return self.add_object(OBJ_BLOB, data, oid)
+
+    def add_tree(self, entries):
+        """
+        Adds a tree object to the pack, and returns its pygit2.Oid.
+        entries - an iterable of (name, filemode, pygit2.Oid) tuples, in any order.
+        """
+        data = b"".join(
+            b"%o %s\0%s" % (mode, name.encode("utf8"), oid.raw)
+            for name, mode, oid in sorted(entries, key=_tree_entry_sort_key)
+        )
+        return self.add_object(OBJ_TREE, data)
+
+    def finish(self):
+        """
+        Writes the pack trailer and the pack index, and moves them into the repository.
+        Returns the pack name, or None if the pack was empty - in which case nothing is written.
+        """
+        if not self.entries:
+            self.abort()
+            return None
+
+        # Fill in the object count, then checksum the whole pack.
+        self.file.seek(0)
+        self.file.write(struct.pack(">4sII", PACK_SIGNATURE, PACK_VERSION, len(self)))
+        self.file.seek(0)
+        pack_sha = hashlib.sha1()
+        for chunk in iter(lambda: self.file.read(1024 * 1024), b""):
+            pack_sha.update(chunk)
+        pack_checksum = pack_sha.digest()
+        self.file.write(pack_checksum)
+        self.file.close()
+
+        pack_name = f"pack-{pack_checksum.hex()}"
+        tmp_idx_path = self.tmp_path.with_suffix(".idx")
+        with open(tmp_idx_path, "wb") as idx_file:
+            idx_file.write(self._index_data(pack_checksum))
+
+        # The pack must be in place before the index, since the index is what makes the pack visible.
+        os.replace(self.tmp_path, self.pack_dir / f"{pack_name}.pack")
+        os.replace(tmp_idx_path, self.pack_dir / f"{pack_name}.idx")
+        return pack_name
+
+    def abort(self):
+        """Discards the pack - none of the objects that were added are written to the repository."""
+        self.file.close()
+        self.tmp_path.unlink()
+
+    def _index_data(self, pack_checksum):
+        raw_oids = sorted(self.entries)
+
+        fanout = [0] * 256
+        for raw_oid in raw_oids:
+            fanout[raw_oid[0]] += 1
+        for i in range(1, 256):
+            fanout[i] += fanout[i - 1]
+
+        crcs = []
+        offsets = []
+        large_offsets = []
+        for raw_oid in raw_oids:
+            crc, offset = self.entries[raw_oid]
+            crcs.append(crc)
+            if offset > MAX_SMALL_OFFSET:
+                offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+            else:
+                offsets.append(offset)
+
+        count = len(raw_oids)
+        data = b"".join(
+            [
+                struct.pack(">4sI", IDX_SIGNATURE, IDX_VERSION),
+                struct.pack(">256I", *fanout),
+                b"".join(raw_oids),
+                struct.pack(f">{count}I", *crcs),
+                struct.pack(f">{count}I", *offsets),
+                struct.pack(f">{len(large_offsets)}Q", *large_offsets),
+                pack_checksum,
+            ]
+        )
+        return data + hashlib.sha1(data).digest()
@@ -0,0 +1,121 @@
+from collections import namedtuple
+
+from .exceptions import InvalidOperation
+
+
+class PathStructure(namedtuple("PathStructure", ("levels", "branches"))):
+    """
+    How the features of a Dataset2 are sharded into trees. Each feature blob is stored `levels` trees
+    deep inside the feature tree, and each of those trees has up to `branches` subtrees. The subtree
+    names at each level are taken from successive hex digits of the hash of the feature's primary key.
+
+    More levels keep each tree small - which matters for huge datasets, since every commit rewrites
+    one whole tree at each level - but small datasets are better off with fewer, fuller trees.
+    """
+
+    # Set below - 2 levels of 256 branches, eg "feature/ab/cd/[filename]"
+    DEFAULT = None
+
+    # A path structure spec of "auto" means one should be chosen based on the number of features.
+    AUTO = "auto"
+
+    # Supported numbers of branches, and the number of hex digits of the hash used at each level.
+    HEX_DIGITS = {16: 1, 256: 2, 4096: 3}
+    MAX_LEVELS = 4
+
+    # Path structures are chosen automatically so that leaf trees hold around this many features or less.
+    MAX_AUTO_LEAF_SIZE = 512
+
+    def __new__(cls, levels, branches):
+        if branches not in cls.HEX_DIGITS:
+            valid = ", ".join(str(b) for b in cls.HEX_DIGITS)
+            raise ValueError(
+                f"Invalid branches: {branches} - should be one of: {valid}"
+            )
+        if not 1 <= levels <= cls.MAX_LEVELS:
+            raise ValueError(
+                f"Invalid levels: {levels} - should be between 1 and {cls.MAX_LEVELS}"
+            )
+        return super().__new__(cls, levels, branches)
+
+    def __str__(self):
+        return f"{self.levels}x{self.branches}"
+
+    @property
+    def hex_digits(self):
+        return self.HEX_DIGITS[self.branches]
+
+    def tree_names(self, pk_hash):
+        """Given the hex hash of a feature's primary key, returns the names of the trees it is stored in."""
+        n = self.hex_digits
+        return tuple(pk_hash[i * n : (i + 1) * n] for i in range(self.levels))
+
+    def to_json(self):
+        return {"levels": self.levels, "branches": self.branches}
+
+    @classmethod
+    def from_json(cls, json_dict):
+        return cls(json_dict["levels"], json_dict["branches"])
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Parses a path structure spec - either "auto", or "LEVELSxBRANCHES" eg "3x256".
+        Returns PathStructure.AUTO or a PathStructure. Raises ValueError if the spec is invalid.
+        """
+        spec = spec.strip().lower()
+        if spec == cls.AUTO:
+            return cls.AUTO
+        try:
+            levels, branches = (int(part) for part in spec.split("x"))
+        except ValueError:
+            raise ValueError(
+                f"Invalid path structure: {spec} - should be 'auto' or LEVELSxBRANCHES eg '3x256'"
+            )
+        return cls(levels, branches)
+
+    @classmethod
+    def for_feature_count(cls, feature_count):
+        """Returns a path structure suitable for a dataset with the given number of features."""
+        branches = 256
+        levels = 1
+        while (
+            levels < cls.MAX_LEVELS
+            and feature_count / (branches ** levels) > cls.MAX_AUTO_LEAF_SIZE
+        ):
+            levels += 1
+        return cls(levels, branches)
+
+    @classmethod
+    def resolve(cls, spec, feature_count):
+        """
+        Given a parsed path structure spec - a PathStructure, PathStructure.AUTO or None -
+        returns the PathStructure that a dataset with the given number of features should use.
+        """
+        if spec is None:
+            return cls.DEFAULT
+        if spec == cls.AUTO:
+            if feature_count is None:
+                return cls.DEFAULT
+            return cls.for_feature_count(feature_count)
+        return spec
+
+    @classmethod
+    def spec_from_config(cls, repo):
+        """
+        Returns the parsed path structure spec configured by sno.dataset.pathStructure,
+        or None if it is not set - in which case datasets use PathStructure.DEFAULT.
+        """
+        from .sno_repo import SnoConfigKeys
+
+        config = repo.config
+        key = SnoConfigKeys.SNO_DATASET_PATH_STRUCTURE
+        if key not in config:
+            return None
+        try:
+            return cls.parse(config[key])
+        except ValueError as e:
+            raise InvalidOperation(f"Invalid value for {key}: {e}")
+
+
+PathStructure.DEFAULT = PathStructure(2, 256)
@@ -1,109 +1,366 @@
+import http.server
+import json
 import logging
+import os
 import re
+import socketserver
+import stat
 import sys
 import time
+from urllib.parse import parse_qs, unquote, urlsplit
 
 import click
 
 from . import structure
-from .exceptions import NotFound
-from .output_util import dump_json_output
+from .attribute_filter import AttributeFilter
+from .exceptions import BaseException as SnoBaseException, NotFound
+from .geometry import Geometry
+from .output_util import ExtendedJsonEncoder, dump_json_output
+from .spatial_index import SpatialIndex
 
 
 L = logging.getLogger("sno.query")
 
+QUERY_COMMANDS = ("get", "geo-nearest", "geo-intersects", "geo-count", "where")
+
+DEFAULT_SERVE_ADDRESS = "127.0.0.1:8005"
+
+
+def _parse_coordinates(param, counts, usage):
+    try:
+        coordinates = [float(c) for c in re.split(r"[ ,]", param)]
+    except ValueError:
+        raise click.BadParameter(usage)
+    if len(coordinates) not in counts:
+        raise click.BadParameter(usage)
+    return coordinates
+
+
+class DatasetQuery:
+    """
+    Answers the queries supported by `sno query` - get, geo-nearest, geo-intersects, geo-count,
+    where - for a single dataset at the given ref. The dataset and its spatial index are kept open
+    between queries, and are reloaded by refresh() once the ref points to a different commit.
+    """
+
+    def __init__(self, repo, path, ref="HEAD", num_workers=1):
+        self.repo = repo
+        self.path = path
+        self.ref = ref
+        self.num_workers = num_workers
+        self.spatial_index = SpatialIndex(repo, path)
+        self.commit_id = None
+        self.dataset = None
+        self._index = None
+        self.refresh()
+
+    def refresh(self):
+        """Reloads the dataset if the ref has changed since it was loaded. Returns True if it has."""
+        rs = structure.RepositoryStructure.lookup(self.repo, self.ref)
+        if rs.id == self.commit_id:
+            return False
+
+        dataset = rs[self.path]
+        self.commit_id = rs.id
+        if self.dataset is not None and dataset.tree.id == self.dataset.tree.id:
+            return False
+
+        self.dataset = dataset
+        self.close()
+        return True
+
+    @property
+    def index(self):
+        """The spatial index, updated to match the dataset if need be."""
+        if self._index is None:
+            self._index = self.spatial_index.open(self.dataset)
+        return self._index
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def run(self, command, params):
+        """Runs the given query, and returns the results. Raises click.BadParameter if the params are invalid."""
+        dataset = self.dataset
+
+        if command == "get":
+            USAGE = "get PK"
+            if len(params) != 1:
+                raise click.BadParameter(USAGE)
+
+            return dataset.get_feature(params[0])
+
+        elif command == "geo-nearest":
+            USAGE = "geo-nearest X0,Y0[,X1,Y1] [LIMIT]"
+            if len(params) < 1 or len(params) > 2:
+                raise click.BadParameter(USAGE)
+            elif len(params) > 1:
+                try:
+                    limit = int(params[1])
+                except ValueError:
+                    raise click.BadParameter(USAGE)
+            else:
+                limit = 1
+
+            coordinates = _parse_coordinates(params[0], (2, 4), USAGE)
+            return [
+                dataset.get_feature(pk) for pk in self.index.nearest(coordinates, limit)
+            ]
+
+        elif command == "geo-intersects":
+            USAGE = "geo-intersects X0,Y0,X1,Y1"
+            if len(params) != 1:
+                raise click.BadParameter(USAGE)
+
+            coordinates = _parse_coordinates(params[0], (4,), USAGE)
+            return [
+                dataset.get_feature(pk) for pk in self.index.intersection(coordinates)
+            ]
+
+        elif command == "geo-count":
+            USAGE = "geo-count X0,Y0,X1,Y1"
+            if len(params) != 1:
+                raise click.BadParameter(USAGE)
+
+            coordinates = _parse_coordinates(params[0], (4,), USAGE)
+            return self.index.count(coordinates)
+
+        elif command == "where":
+            USAGE = "where EXPRESSION [X0,Y0,X1,Y1]"
+            if len(params) < 1 or len(params) > 2:
+                raise click.BadParameter(USAGE)
+
+            try:
+                attribute_filter = AttributeFilter(params[0], dataset.schema)
+            except ValueError as e:
+                raise click.BadParameter(f"{e}\n\n{USAGE}")
+
+            if len(params) > 1:
+                # Only the features in the bounding box need to be checked.
+                coordinates = _parse_coordinates(params[1], (4,), USAGE)
+                col_names = (dataset.primary_key,) + attribute_filter.col_names
+                candidates = dataset.get_feature_tuples(
+                    list(self.index.intersection(coordinates)), col_names
+                )
+                pks = attribute_filter.matching_pks(candidates)
+            else:
+                pks = attribute_filter.scan(self.repo, dataset, self.num_workers)
+
+            # Features are found in path order - or with several workers, in no particular order.
+            return [dataset.get_feature(pk) for pk in sorted(pks)]
+
+        else:
+            raise NotImplementedError(f"Unknown command: {command}")
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, Geometry):
+        return obj.to_wkb()
+    if isinstance(obj, tuple):
+        return list(obj)
+    return ExtendedJsonEncoder().default(obj)
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handles requests of the form GET /COMMAND/PARAM[/PARAM] - eg /geo-intersects/177,-38,177.1,-37.9
+    Responses are JSON, unless msgpack is asked for with ?format=msgpack or an Accept header of
+    application/msgpack. In either case, geometries are WKB - hex-encoded, in JSON.
+    """
+
+    server_version = "SnoQuery"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.split("/") if p]
+        response_format = parse_qs(url.query).get("format", [None])[-1]
+        if response_format is None:
+            use_msgpack = "msgpack" in self.headers.get("Accept", "")
+        else:
+            use_msgpack = response_format == "msgpack"
+
+        query = self.server.dataset_query
+        t0 = time.monotonic()
+        try:
+            if not parts or parts[0] not in QUERY_COMMANDS:
+                raise NotFound(f"Unknown command - expected one of {QUERY_COMMANDS}")
+            query.refresh()
+            results = query.run(parts[0], parts[1:])
+        except click.BadParameter as e:
+            return self._send_error(400, e.format_message(), use_msgpack)
+        except (NotFound, KeyError) as e:
+            return self._send_error(404, str(e), use_msgpack)
+        except SnoBaseException as e:
+            return self._send_error(500, str(e), use_msgpack)
+        except Exception as e:
+            L.exception("Error handling %s", self.path)
+            return self._send_error(500, str(e), use_msgpack)
+
+        L.debug("Results in %0.3fs", time.monotonic() - t0)
+        self._send(200, results, use_msgpack)
+
+    def _send_error(self, status, message, use_msgpack):
+        self._send(status, {"error": message}, use_msgpack)
+
+    def _send(self, status, data, use_msgpack):
+        if use_msgpack:
+            import msgpack
+
+            body = msgpack.packb(
+                data, use_bin_type=True, strict_types=True, default=_msgpack_default
+            )
+            content_type = "application/msgpack"
+        else:
+            body = json.dumps(data, cls=ExtendedJsonEncoder).encode("utf-8")
+            content_type = "application/json"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Clients of a Unix socket don't have an address.
+        return self.client_address[0] if self.client_address else "-"
+
+    def log_message(self, format, *args):
+        L.info("%s - %s", self.address_string(), format % args)
+
+
+# Queries are answered one at a time - neither pygit2 nor Rtree objects are safe to share between
+# threads - but since each is quick, and everything stays loaded between them, that isn't a problem.
+
+
+class QueryHTTPServer(http.server.HTTPServer):
+    def __init__(self, address, dataset_query):
+        self.dataset_query = dataset_query
+        super().__init__(address, QueryRequestHandler)
+
+
+class QueryUnixServer(socketserver.UnixStreamServer):
+    def __init__(self, socket_path, dataset_query):
+        self.dataset_query = dataset_query
+        super().__init__(socket_path, QueryRequestHandler)
+
+    def server_bind(self):
+        # Remove the socket left behind by a previous server, if there is one.
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+        super().server_bind()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def make_query_server(dataset_query, address):
+    """
+    Returns a server for answering queries of the given DatasetQuery over HTTP.
+    address is either [HOST:]PORT, or unix:SOCKET_PATH for a Unix domain socket.
+    """
+    if address.startswith("unix:"):
+        return QueryUnixServer(address[len("unix:") :], dataset_query)
+
+    host, _, port = address.rpartition(":")
+    try:
+        port = int(port)
+    except ValueError:
+        raise click.BadParameter(
+            f"Invalid address: {address} - should be [HOST:]PORT or unix:SOCKET_PATH"
+        )
+    return QueryHTTPServer((host or "127.0.0.1", port), dataset_query)
+
 
 @click.command("query", hidden=True)
 @click.pass_context
 @click.argument("path")
 @click.argument(
     "command",
-    type=click.Choice(("get", "geo-nearest", "geo-intersects", "geo-count", "index")),
+    type=click.Choice(QUERY_COMMANDS + ("index", "serve")),
     required=True,
 )
 @click.argument("params", nargs=-1, required=False)
-def query(ctx, path, command, params):
+@click.option(
+    "--ref",
+    default="HEAD",
+    help="The commit or branch to query. Defaults to HEAD.",
+)
+@click.option(
+    "--workers",
+    "num_workers",
+    default=1,
+    type=click.IntRange(min=1),
+    help=(
+        "Number of worker processes to use when building a spatial index, or scanning "
+        "features for `where`. Values greater than 1 can speed up large datasets."
+    ),
+)
+def query(ctx, path, command, params, ref, num_workers):
     """
     Find features in a Dataset
 
-    WARNING: Spatial indexing is a proof of concept.
-    Significantly, indexes don't update when the repo changes in any way.
+    The geo-* commands need a spatial index, which is built with `sno query PATH index`.
+    Once built, it is stored in the repository and updated to match HEAD whenever it is used.
+
+    `sno query PATH where EXPRESSION [X0,Y0,X1,Y1]` finds features whose attributes match an
+    SQL-like expression, eg "status = 'proposed' AND area > 1000". Only the columns it refers to
+    are decoded. If a bounding box is given, only the features in it are checked, using the
+    spatial index - otherwise every feature is, which can be split across processes with --workers.
+
+    `sno query PATH serve [[HOST:]PORT | unix:SOCKET_PATH]` answers queries over HTTP until
+    interrupted, keeping the dataset and its spatial index loaded in between. Each query is a
+    request for /COMMAND/PARAM[/PARAM] - eg /geo-count/177,-38,177.1,-37.9 - and the response is
+    JSON, or msgpack if requested with ?format=msgpack. Changes to the ref are picked up automatically.
     """
     repo = ctx.obj.repo
-    rs = structure.RepositoryStructure(repo)
-    dataset = rs[path]
 
     if command == "index":
         USAGE = "index"
 
+        dataset = structure.RepositoryStructure.lookup(repo, ref)[path]
         t0 = time.monotonic()
-        dataset.build_spatial_index(dataset.table_name)
+        feature_count = SpatialIndex(repo, path).build(dataset, num_workers=num_workers)
         t1 = time.monotonic()
-        L.debug("Indexed {dataset} in %0.3fs", t1 - t0)
+        click.echo(f"Indexed {feature_count} features in {t1-t0:.1f}s")
         return
 
-    try:
-        dataset.get_spatial_index(dataset.table_name)
-    except OSError:
-        raise NotFound("No spatial index found. Run `sno query {path} index`")
-
-    if command == "get":
-        USAGE = "get PK"
-        if len(params) != 1:
-            raise click.BadParameter(USAGE)
-
-        t0 = time.monotonic()
-        results = dataset.get_feature(params[0])
-        t1 = time.monotonic()
-
-    elif command == "geo-nearest":
-        USAGE = "geo-nearest X0,Y0[,X1,Y1] [LIMIT]"
-        if len(params) < 1 or len(params) > 2:
-            raise click.BadParameter(USAGE)
-        elif len(params) > 1:
-            limit = int(params[1])
-        else:
-            limit = 1
-
-        coordinates = [float(c) for c in re.split(r"[ ,]", params[0])]
-        if len(coordinates) not in (2, 4):
-            raise click.BadParameter(USAGE)
-
-        index = dataset.get_spatial_index(path)
-        t0 = time.monotonic()
-        results = [dataset.get_feature(pk) for pk in index.nearest(coordinates, limit)]
-        t1 = time.monotonic()
+    dataset_query = DatasetQuery(repo, path, ref=ref, num_workers=num_workers)
 
-    elif command == "geo-intersects":
-        USAGE = "geo-intersects X0,Y0,X1,Y1"
-        if len(params) != 1:
+    if command == "serve":
+        USAGE = "serve [[HOST:]PORT | unix:SOCKET_PATH]"
+        if len(params) > 1:
             raise click.BadParameter(USAGE)
 
-        coordinates = [float(c) for c in re.split(r"[ ,]", params[0])]
-        if len(coordinates) != 4:
-            raise click.BadParameter(USAGE)
-
-        index = dataset.get_spatial_index(path)
-        t0 = time.monotonic()
-        results = [dataset.get_feature(pk) for pk in index.intersection(coordinates)]
-        t1 = time.monotonic()
-
-    elif command == "geo-count":
-        USAGE = "geo-count X0,Y0,X1,Y1"
-        if len(params) != 1:
-            raise click.BadParameter(USAGE)
-
-        coordinates = [float(c) for c in re.split(r"[ ,]", params[0])]
-        if len(coordinates) != 4:
-            raise click.BadParameter(USAGE)
-
-        index = dataset.get_spatial_index(path)
-        t0 = time.monotonic()
-        results = index.count(coordinates)
-        t1 = time.monotonic()
+        address = params[0] if params else DEFAULT_SERVE_ADDRESS
+        try:
+            # Load the spatial index now, rather than on the first query.
+            dataset_query.index
+        except NotFound as e:
+            click.echo(f"Warning: {e.format_message()}", err=True)
+        server = make_query_server(dataset_query, address)
+        with server:
+            click.echo(f"Serving queries of {path} at {address} - Ctrl-C to stop")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                dataset_query.close()
+        return
 
-    else:
-        raise NotImplementedError(f"Unknown command: {command}")
+    t0 = time.monotonic()
+    results = dataset_query.run(command, params)
+    t1 = time.monotonic()
+    dataset_query.close()
 
     L.debug("Results in %0.3fs", t1 - t0)
     t2 = time.monotonic()
@@ -26,6 +26,8 @@ MERGE_MSG = SnoRepoFiles.MERGE_MSG
 # Sno-specific files:
 MERGE_INDEX = SnoRepoFiles.MERGE_INDEX
 MERGE_BRANCH = SnoRepoFiles.MERGE_BRANCH
+IMPORT_RESUME = SnoRepoFiles.IMPORT_RESUME
+DATASET_STATS = SnoRepoFiles.DATASET_STATS
 
 
 def repo_file_path(repo, filename):
@@ -9,12 +9,13 @@ from .core import walk_tree
 REPO_VERSION_BLOB_PATH = ".sno.repository.version"
 REPO_VERSION_CONFIG_PATH = "sno.repository.version"
 
-REPO_VERSIONS = (0, 1, 2)
+REPO_VERSIONS = (0, 1, 2, 3)
 DEFAULT_REPO_VERSION = 2
 
-# Only versions 1 and 2 (or "auto") are currently supported by any commands.
+# Only versions 1, 2 and 3 (or "auto") are currently supported by any commands.
 # If you have version 0, use sno upgrade 00-02
-REPO_VERSIONS_CHOICE = click.Choice(["1", "2"])
+# Version 3 is experimental - see docs/DATASETS_v3.md
+REPO_VERSIONS_CHOICE = click.Choice(["1", "2", "3"])
 REPO_VERSIONS_DEFAULT_CHOICE = str(DEFAULT_REPO_VERSION)
 
 
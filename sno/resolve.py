@@ -29,15 +29,16 @@ def ungeojson_file(file_path, dataset):
     return [ungeojson_feature(f, dataset) for f in features]
 
 
-def write_feature_to_dataset_entry(feature, dataset, repo):
+def write_feature_to_dataset_entries(feature, dataset, repo):
     """
-    Adds the given feature to the given dataset by writing a blob to the sno repo.
-    Returns the IndexEntry that refers to that blob - this IndexEntry still needs
-    to be written to the repo to complete the write.
+    Adds the given feature to the given dataset by writing blobs to the sno repo - the feature blob,
+    and any out-of-line value blobs. Returns the IndexEntrys that refer to those blobs - these IndexEntrys
+    still need to be written to the repo to complete the write.
     """
-    feature_path, feature_data = dataset.encode_feature(feature)
-    blob_id = repo.create_blob(feature_data)
-    return pygit2.IndexEntry(feature_path, blob_id, pygit2.GIT_FILEMODE_BLOB)
+    return [
+        pygit2.IndexEntry(path, repo.create_blob(data), pygit2.GIT_FILEMODE_BLOB)
+        for path, data in dataset.encode_feature_blobs(feature)
+    ]
 
 
 def load_geojson_resolve(file_path, dataset, repo):
@@ -46,8 +47,9 @@ def load_geojson_resolve(file_path, dataset, repo):
     returns pygit2.IndexEntrys containing those features when added to that dataset.
     """
     return [
-        write_feature_to_dataset_entry(f, dataset, repo)
+        entry
         for f in ungeojson_file(file_path, dataset)
+        for entry in write_feature_to_dataset_entries(f, dataset, repo)
     ]
 
 
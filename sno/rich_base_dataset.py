@@ -1,8 +1,8 @@
+import contextlib
 import functools
 
 import click
 import pygit2
-import time
 from osgeo import osr
 
 
@@ -13,7 +13,7 @@ from .exceptions import (
     PATCH_DOES_NOT_APPLY,
 )
 from .filter_util import UNFILTERED
-from .geometry import geom_envelope, make_crs
+from .geometry import make_crs
 from .schema import Schema
 
 from .base_dataset import BaseDataset
@@ -30,69 +30,6 @@ class RichBaseDataset(BaseDataset):
     For example, see Dataset0.
     """
 
-    RTREE_INDEX_EXTENSIONS = ("sno-idxd", "sno-idxi")
-
-    def build_spatial_index(self, path):
-        """
-        Internal proof-of-concept method for building a spatial index across the repository.
-
-        Uses Rtree (libspatialindex underneath): http://toblerity.org/rtree/index.html
-        """
-        import rtree
-
-        if not self.has_geometry:
-            raise ValueError("No geometry to index")
-
-        def _indexer():
-            t0 = time.monotonic()
-
-            c = 0
-            for (pk, geom) in self.feature_tuples(
-                [self.primary_key, self.geom_column_name]
-            ):
-                c += 1
-                if geom is None:
-                    continue
-
-                e = geom_envelope(geom)
-                yield (pk, e, None)
-
-                if c % 50000 == 0:
-                    print(f"  {c} features... @{time.monotonic()-t0:.1f}s")
-
-        p = rtree.index.Property()
-        p.dat_extension = self.RTREE_INDEX_EXTENSIONS[0]
-        p.idx_extension = self.RTREE_INDEX_EXTENSIONS[1]
-        p.leaf_capacity = 1000
-        p.fill_factor = 0.9
-        p.overwrite = True
-        p.dimensionality = 2
-
-        t0 = time.monotonic()
-        idx = rtree.index.Index(path, _indexer(), properties=p, interleaved=False)
-        t1 = time.monotonic()
-        b = idx.bounds
-        c = idx.count(b)
-        del idx
-        t2 = time.monotonic()
-        print(f"Indexed {c} features ({b}) in {t1-t0:.1f}s; flushed in {t2-t1:.1f}s")
-
-    def get_spatial_index(self, path):
-        """
-        Retrieve a spatial index built with build_spatial_index().
-
-        Query with .nearest(coords), .intersection(coords), .count(coords)
-        http://toblerity.org/rtree/index.html
-        """
-        import rtree
-
-        p = rtree.index.Property()
-        p.dat_extension = self.RTREE_INDEX_EXTENSIONS[0]
-        p.idx_extension = self.RTREE_INDEX_EXTENSIONS[1]
-
-        idx = rtree.index.Index(path, properties=p)
-        return idx
-
     @functools.lru_cache()
     def get_geometry_transform(self, target_crs):
         """
@@ -181,14 +118,21 @@ class RichBaseDataset(BaseDataset):
         else:
             old, new = self, other
 
+        # Blob IDs of features that have only been inserted or only deleted so far - see below.
+        half_delta_blob_ids = {}
+
+        # Out-of-line values are diffed as part of the feature they belong to, since the feature blob
+        # refers to each value blob by OID, and so changes whenever any of them changes.
+        non_feature_paths = tuple(p for p in (self.META_PATH, self.VALUE_PATH) if p)
+
         for d in diff_index.deltas:
             self.L.debug(
                 "diff(): %s %s %s", d.status_char(), d.old_file.path, d.new_file.path
             )
 
-            if d.old_file and d.old_file.path.startswith(self.META_PATH):
+            if d.old_file and d.old_file.path.startswith(non_feature_paths):
                 continue
-            elif d.new_file and d.new_file.path.startswith(self.META_PATH):
+            elif d.new_file and d.new_file.path.startswith(non_feature_paths):
                 continue
 
             if d.status in self._INSERT_UPDATE_DELETE:
@@ -244,7 +188,23 @@ class RichBaseDataset(BaseDataset):
                 else:
                     new_half_delta = None
 
-                result.add_delta(Delta(old_half_delta, new_half_delta))
+                delta = Delta(old_half_delta, new_half_delta)
+                blob_id = d.new_file.id if new_half_delta else d.old_file.id
+                existing = result.get(delta.key)
+                if existing is not None:
+                    # The same feature was deleted from one path and inserted at another -
+                    # which happens when the dataset's feature tree has been resharded.
+                    if half_delta_blob_ids.pop(delta.key, None) == blob_id:
+                        del result[delta.key]
+                    elif existing.type == "delete":
+                        result.add_delta(Delta(existing.old, delta.new))
+                    else:
+                        result.add_delta(Delta(delta.old, existing.new))
+                    continue
+
+                if d.status != pygit2.GIT_DELTA_MODIFIED:
+                    half_delta_blob_ids[delta.key] = blob_id
+                result.add_delta(delta)
 
             else:
                 # GIT_DELTA_RENAMED
@@ -315,10 +275,24 @@ class RichBaseDataset(BaseDataset):
         geom_columns = (schema or self.schema).geometry_columns
         geom_column_name = geom_columns[0].name if geom_columns else None
 
-        # Applying diffs works even if there is no tree yet created for the dataset,
-        # as is the case when the dataset is first being created right now.
-        tree = self.tree or ()
+        with self._feature_writer(tree_builder) as feature_writer:
+            self._apply_feature_deltas(
+                feature_diff,
+                feature_writer,
+                encode_kwargs,
+                geom_column_name,
+                allow_missing_old_values=allow_missing_old_values,
+            )
 
+    def _apply_feature_deltas(
+        self,
+        feature_diff,
+        feature_writer,
+        encode_kwargs,
+        geom_column_name,
+        *,
+        allow_missing_old_values,
+    ):
         has_conflicts = False
         for delta in feature_diff.values():
             old_key = delta.old_key
@@ -331,7 +305,7 @@ class RichBaseDataset(BaseDataset):
             )
 
             # Conflict detection
-            if delta.type == "delete" and old_path not in tree:
+            if delta.type == "delete" and not self._feature_exists_at(old_path):
                 has_conflicts = True
                 click.echo(
                     f"{self.path}: Trying to delete nonexistent feature: {old_key}",
@@ -342,7 +316,7 @@ class RichBaseDataset(BaseDataset):
             if (
                 delta.type == "insert"
                 and (not allow_missing_old_values)
-                and new_path in tree
+                and self._feature_exists_at(new_path)
             ):
                 has_conflicts = True
                 click.echo(
@@ -351,7 +325,7 @@ class RichBaseDataset(BaseDataset):
                 )
                 continue
 
-            if delta.type == "update" and old_path not in tree:
+            if delta.type == "update" and not self._feature_exists_at(old_path):
                 has_conflicts = True
                 click.echo(
                     f"{self.path}: Trying to update nonexistent feature: {old_key}",
@@ -370,13 +344,9 @@ class RichBaseDataset(BaseDataset):
                 continue
 
             # Actually write the feature diff:
-            if old_path and old_path != new_path:
-                tree_builder.remove(old_path)
-            if delta.new_value:
-                path, data = self.encode_feature(
-                    delta.new.value, relative=True, **encode_kwargs
-                )
-                tree_builder.insert(path, data)
+            self._write_feature(
+                feature_writer, old_path, new_path, delta.new_value, encode_kwargs
+            )
 
         if has_conflicts:
             raise InvalidOperation(
@@ -384,6 +354,70 @@ class RichBaseDataset(BaseDataset):
                 exit_code=PATCH_DOES_NOT_APPLY,
             )
 
+    def encode_feature_blobs(self, feature, **kwargs):
+        """
+        Returns a list of (path, data) tuples for every blob that *should be written* to write this feature.
+        By default, this is just the feature blob itself - see encode_feature.
+        """
+        return [self.encode_feature(feature, **kwargs)]
+
+    def _write_feature(
+        self, feature_writer, old_path, new_path, new_feature, encode_kwargs
+    ):
+        """
+        Writes the new version of a feature that was at old_path - or removes it, if new_feature is None -
+        using the given feature_writer. Paths are relative to this dataset.
+        """
+        if old_path and old_path != new_path:
+            feature_writer.remove(old_path)
+        if new_feature:
+            path, data = self.encode_feature(
+                new_feature, relative=True, **encode_kwargs
+            )
+            feature_writer.insert(path, data)
+
+    def _feature_exists_at(self, rel_path):
+        """Returns True if there is a feature at the given path, relative to this dataset."""
+        # Applying diffs works even if there is no tree yet created for the dataset,
+        # as is the case when the dataset is first being created right now.
+        return self.tree is not None and rel_path in self.tree
+
+    def _feature_writer(self, tree_builder):
+        """
+        Returns a context manager for an object with insert(path, data) and remove(path) methods,
+        which apply_feature_diff uses to write features to the given tree_builder.
+        By default, this is just the tree_builder itself.
+        """
+        return contextlib.nullcontext(tree_builder)
+
+    def diff_feature_oids(self, other):
+        """
+        Compares the features of this dataset to those of another version of the same dataset,
+        without reading any features. Returns a tuple (deleted_pks, changed_pk_oids) - the primary keys
+        of the features that are only in this dataset, and (pk, blob-OID) pairs for the features that
+        are new or different in the other dataset, which can be passed to other.get_feature_tuples_by_oid.
+        """
+        feature_diff_index = self.feature_tree.diff_to_tree(other.feature_tree)
+
+        deleted_pks = []
+        changed_pk_oids = []
+        for d in feature_diff_index.deltas:
+            if d.old_file and d.old_file.path.startswith(self.META_PATH):
+                continue
+            if d.new_file and d.new_file.path.startswith(self.META_PATH):
+                continue
+
+            if d.status == pygit2.GIT_DELTA_DELETED:
+                deleted_pks.append(self.decode_path_to_1pk(d.old_file.path))
+            elif d.status in self._INSERT_UPDATE:
+                new_pk = other.decode_path_to_1pk(d.new_file.path)
+                changed_pk_oids.append((new_pk, d.new_file.id))
+            else:
+                # RENAMED, COPIED, IGNORED, TYPECHANGE, UNMODIFIED, UNREADABLE, UNTRACKED
+                raise NotImplementedError(f"Delta status: {d.status_char()}")
+
+        return deleted_pks, changed_pk_oids
+
     def _features_equal(self, lhs, rhs, geom_column_name):
         # FIXME: actually compare the geometries here.
         # Turns out this is quite hard - geometries are hard to compare sanely.
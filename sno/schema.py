@@ -1,5 +1,6 @@
 from collections import namedtuple
 import functools
+from operator import itemgetter
 import uuid
 
 from .geometry import Geometry
@@ -234,6 +235,13 @@ class Schema:
     def __contains__(self, id):
         return any(c.id == id for c in self.columns)
 
+    def column_by_name(self, name):
+        """Return the ColumnSchema with the given name."""
+        try:
+            return next(c for c in self.columns if c.name == name)
+        except StopIteration:
+            raise KeyError(f"No such column: {name}")
+
     @classmethod
     def from_column_dicts(cls, column_dicts):
         columns = [ColumnSchema.from_dict(d) for d in column_dicts]
@@ -263,6 +271,51 @@ class Schema:
         cols = ",\n".join(repr(c) for c in self.columns)
         return f"Schema([{cols}])"
 
+    @functools.lru_cache(maxsize=256)
+    def feature_decoder(self, legend, keys=True, col_names=None):
+        """
+        Returns a function which takes the (pk_values, non_pk_values) of a feature that was
+        written using the given legend, and returns that feature according to this schema -
+        either as a dict keyed by column name (if keys=True) or a tuple in schema order.
+        Equivalent to legend.value_tuples_to_raw_dict followed by feature_from_raw_dict,
+        but the position of each column's value is worked out once, rather than per feature.
+        If col_names (a tuple) is supplied, only those columns are returned, in that order.
+        Decoders are cached, so there is only one per (schema, legend, keys, col_names) combination.
+        """
+        columns = self.columns
+        if col_names is not None:
+            columns = [self.column_by_name(name) for name in col_names]
+
+        legend_column_ids = legend.pk_columns + legend.non_pk_columns
+        positions = {column_id: i for i, column_id in enumerate(legend_column_ids)}
+        # Columns that aren't in the legend are read from a padding value of None at the end.
+        missing = len(legend_column_ids)
+        indices = [positions.get(c.id, missing) for c in columns]
+        padding = [None] if missing in indices else []
+
+        if len(indices) == 1:
+            index = indices[0]
+            get_values = lambda values: (values[index],)
+        elif not indices:
+            get_values = lambda values: ()
+        else:
+            get_values = itemgetter(*indices)
+
+        if keys:
+            names = [c.name for c in columns]
+
+            def decode(pk_values, non_pk_values):
+                values = list(pk_values) + list(non_pk_values) + padding
+                return dict(zip(names, get_values(values)))
+
+        else:
+
+            def decode(pk_values, non_pk_values):
+                values = list(pk_values) + list(non_pk_values) + padding
+                return get_values(values)
+
+        return decode
+
     def feature_from_raw_dict(self, raw_dict, keys=True):
         """
         Takes a "raw" feature dict - values keyed by column ID.
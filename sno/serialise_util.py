@@ -3,8 +3,10 @@ import hashlib
 import json
 import logging
 import struct
+from collections import namedtuple
 
 import msgpack
+import pygit2
 
 from sno.geometry import Geometry
 
@@ -13,11 +15,43 @@ L = logging.getLogger("sno.serialise_util")
 
 # Extension code for Geometry objects.
 _EXTENSION_G = ord("G")
+# Extension code for ValueRef objects.
+_EXTENSION_R = ord("R")
+
+
+class ValueRef(namedtuple("ValueRef", ("blob_id", "is_geometry"))):
+    """
+    A reference to a value that is stored out-of-line, in a blob of its own - blob_id is its hex OID.
+    Whether the value is a geometry is recorded too, so that it can be skipped without being read.
+    """
+
+    def to_ext_data(self):
+        return (b"G" if self.is_geometry else b"V") + bytes.fromhex(self.blob_id)
+
+    @classmethod
+    def from_ext_data(cls, data):
+        return cls(data[1:].hex(), data[:1] == b"G")
+
+
+class HashedBlob(bytes):
+    """
+    The data of a blob whose git OID is already known, so that it needn't be hashed again when it
+    is written - see fast_import.write_blobs_to_stream. Otherwise it is just bytes.
+    """
+
+    @classmethod
+    def of(cls, data, blob_id=None):
+        """Returns the given data as a HashedBlob - hashing it, unless its blob_id is supplied."""
+        result = cls(data)
+        result.id = blob_id if blob_id is not None else pygit2.hash(data)
+        return result
 
 
 def _msg_pack_default(obj):
     if isinstance(obj, Geometry):
         return msgpack.ExtType(_EXTENSION_G, bytes(obj))
+    if isinstance(obj, ValueRef):
+        return msgpack.ExtType(_EXTENSION_R, obj.to_ext_data())
     if isinstance(obj, tuple):
         return list(obj)
     return obj
@@ -26,6 +60,8 @@ def _msg_pack_default(obj):
 def _msg_unpack_ext_hook(code, data):
     if code == _EXTENSION_G:
         return Geometry.of(data)
+    elif code == _EXTENSION_R:
+        return ValueRef.from_ext_data(data)
     else:
         L.warn("Unexpected msgpack extension: %d", code)
         return msgpack.ExtType(code, data)
@@ -41,11 +77,24 @@ def msg_pack(data):
     )
 
 
-def msg_unpack(bytestring_or_memoryview):
-    """bytes/memoryview -> data (any type)"""
-    return msgpack.unpackb(
-        bytestring_or_memoryview, raw=False, ext_hook=_msg_unpack_ext_hook
+def _msg_unpack_ext_hook_skip_geometry(code, data):
+    if code == _EXTENSION_G:
+        return None
+    if code == _EXTENSION_R and data[:1] == b"G":
+        return None
+    return _msg_unpack_ext_hook(code, data)
+
+
+def msg_unpack(bytestring_or_memoryview, skip_geometry=False):
+    """
+    bytes/memoryview -> data (any type)
+    If skip_geometry is True, any geometries are unpacked as None - for when they aren't needed.
+    Values that are stored out-of-line are unpacked as ValueRef objects - see Dataset2.
+    """
+    ext_hook = (
+        _msg_unpack_ext_hook_skip_geometry if skip_geometry else _msg_unpack_ext_hook
     )
+    return msgpack.unpackb(bytestring_or_memoryview, raw=False, ext_hook=ext_hook)
 
 
 # json_pack and json_unpack have the same signature and capabilities as msg_pack and msg_unpack,
@@ -35,6 +35,9 @@ class SnoRepoFiles:
     # Sno-specific files:
     MERGE_INDEX = "MERGE_INDEX"
     MERGE_BRANCH = "MERGE_BRANCH"
+    IMPORT_RESUME = "IMPORT_RESUME"
+    DATASET_STATS = "DATASET_STATS"
+    SPATIAL_INDEX = "spatial-index"
 
 
 class SnoConfigKeys:
@@ -45,8 +48,15 @@ class SnoConfigKeys:
 
     SNO_REPOSITORY_VERSION = "sno.repository.version"
     SNO_WORKINGCOPY_PATH = "sno.workingcopy.path"
+    # CRS;GEOMETRY - see SpatialFilter
+    SNO_WORKINGCOPY_SPATIAL_FILTER = "sno.workingcopy.spatialFilter"
     SNO_WORKINGCOPY_BARE = "sno.workingcopy.bare"  # Older sno repos use this custom variable instead of core.bare
     CORE_BARE = "core.bare"  # Newer sno repos use the standard "core.bare" variable.
+    # "git-fast-import" (the default) or "native"
+    SNO_IMPORT_BACKEND = "sno.import.backend"
+    # "2x256" (the default), "auto", or LEVELSxBRANCHES
+    SNO_DATASET_PATH_STRUCTURE = "sno.dataset.pathStructure"
+    SNO_DATASET_OUT_OF_LINE = "sno.dataset.outOfLine"  # "none" (the default), "geometry", MIN_SIZE, or "geometry,MIN_SIZE"
 
 
 def _append_checksum(data):
@@ -0,0 +1,210 @@
+import logging
+
+from osgeo import ogr, osr
+
+from .exceptions import InvalidOperation
+from .geometry import gpkg_geom_to_envelope, gpkg_geom_to_ogr, make_crs
+
+
+L = logging.getLogger("sno.spatial_filter")
+
+
+class SpatialFilter:
+    """
+    Restricts which features are written to the working copy, to those whose geometry intersects
+    a given polygon. Features with no geometry, and every feature of a dataset without a geometry
+    column, always match. The filter is specified as CRS;GEOMETRY - where CRS is eg "EPSG:4326"
+    and GEOMETRY is either a polygon in WKT or a bounding box MIN_X,MIN_Y,MAX_X,MAX_Y - and is stored
+    in the repo config at sno.workingcopy.spatialFilter.
+    """
+
+    def __init__(self, crs_spec, geometry_spec):
+        self.crs_spec = crs_spec.strip()
+        geometry_spec = geometry_spec.strip()
+        try:
+            self.crs = make_crs(self.crs_spec)
+        except RuntimeError as e:
+            raise ValueError(f"Invalid CRS in spatial filter: {self.crs_spec} ({e})")
+
+        self.geometry = self._parse_geometry(geometry_spec)
+        self.is_rectangle = self._parse_bbox(geometry_spec) is not None
+
+    @staticmethod
+    def _parse_bbox(geometry_spec):
+        parts = geometry_spec.split(",")
+        if len(parts) != 4:
+            return None
+        try:
+            min_x, min_y, max_x, max_y = (float(p) for p in parts)
+        except ValueError:
+            return None
+        return min_x, min_y, max_x, max_y
+
+    @classmethod
+    def _parse_geometry(cls, geometry_spec):
+        bbox = cls._parse_bbox(geometry_spec)
+        if bbox is not None:
+            min_x, min_y, max_x, max_y = bbox
+            if min_x > max_x or min_y > max_y:
+                raise ValueError(
+                    f"Invalid bounding box in spatial filter: {geometry_spec}"
+                )
+            geometry_spec = (
+                f"POLYGON(({min_x} {min_y},{max_x} {min_y},{max_x} {max_y},"
+                f"{min_x} {max_y},{min_x} {min_y}))"
+            )
+
+        geometry = ogr.CreateGeometryFromWkt(geometry_spec)
+        if geometry is None or ogr.GT_Flatten(geometry.GetGeometryType()) not in (
+            ogr.wkbPolygon,
+            ogr.wkbMultiPolygon,
+        ):
+            raise ValueError(
+                "Spatial filter geometry should be a polygon or multipolygon in WKT, "
+                "or a bounding box MIN_X,MIN_Y,MAX_X,MAX_Y"
+            )
+        if geometry.IsEmpty():
+            raise ValueError("Spatial filter geometry is empty")
+        return geometry
+
+    @classmethod
+    def parse(cls, spec):
+        """Parses a spatial filter spec CRS;GEOMETRY. Raises ValueError if it is invalid."""
+        crs_spec, sep, geometry_spec = spec.partition(";")
+        if not sep:
+            raise ValueError(
+                f"Invalid spatial filter: {spec} - should be CRS;GEOMETRY eg EPSG:4326;174,-42,175,-41"
+            )
+        return cls(crs_spec, geometry_spec)
+
+    def __str__(self):
+        return f"{self.crs_spec};{self.geometry.ExportToWkt()}"
+
+    def __eq__(self, other):
+        return isinstance(other, SpatialFilter) and str(self) == str(other)
+
+    @classmethod
+    def from_config(cls, repo):
+        """Returns the SpatialFilter configured by sno.workingcopy.spatialFilter, or None if it is not set."""
+        from .sno_repo import SnoConfigKeys
+
+        config = repo.config
+        key = SnoConfigKeys.SNO_WORKINGCOPY_SPATIAL_FILTER
+        if key not in config:
+            return None
+        try:
+            return cls.parse(config[key])
+        except ValueError as e:
+            raise InvalidOperation(f"Invalid value for {key}: {e}")
+
+    @staticmethod
+    def write_config(repo, spatial_filter):
+        """Stores the given SpatialFilter in the repo config - or removes it, if it is None."""
+        from .sno_repo import SnoConfigKeys
+
+        key = SnoConfigKeys.SNO_WORKINGCOPY_SPATIAL_FILTER
+        if spatial_filter is None:
+            repo.del_config(key)
+        else:
+            repo.config[key] = str(spatial_filter)
+
+    def for_dataset(self, dataset):
+        """
+        Returns a DatasetSpatialFilter for matching features of the given dataset - with the filter
+        geometry reprojected into the dataset's CRS, if it has one.
+        """
+        if not dataset.has_geometry:
+            return DatasetSpatialFilter.MATCH_ALL
+
+        geometry = self.geometry.Clone()
+        is_rectangle = self.is_rectangle
+        try:
+            crs_definition = dataset.get_crs_definition()
+        except (KeyError, ValueError):
+            crs_definition = None
+        if crs_definition is None:
+            L.warning(
+                "Dataset %s has no single CRS - using the spatial filter without reprojecting it",
+                dataset.path,
+            )
+        else:
+            try:
+                dataset_crs = make_crs(crs_definition)
+                if not dataset_crs.IsSame(self.crs):
+                    transform = osr.CoordinateTransformation(self.crs, dataset_crs)
+                    # Add points along each edge, so that it stays close to the original shape when it is
+                    # reprojected - which matters most for bounding boxes, with only four corners.
+                    min_x, max_x, min_y, max_y = geometry.GetEnvelope()
+                    geometry.Segmentize(max(max_x - min_x, max_y - min_y) / 100 or 1)
+                    geometry.Transform(transform)
+                    # Once reprojected, the filter is no longer a rectangle.
+                    is_rectangle = False
+            except RuntimeError as e:
+                raise InvalidOperation(
+                    f"Can't reproject the spatial filter into the CRS of dataset {dataset.path!r}: {e}"
+                )
+
+        return DatasetSpatialFilter(dataset.geom_column_name, geometry, is_rectangle)
+
+
+class DatasetSpatialFilter:
+    """A SpatialFilter, in the CRS of a particular dataset."""
+
+    MATCH_ALL = None  # Set below.
+
+    def __init__(self, geom_column_name, geometry, is_rectangle=False):
+        self.geom_column_name = geom_column_name
+        self.geometry = geometry
+        # The envelope of the filter, as (min_x, max_x, min_y, max_y).
+        self.envelope = geometry.GetEnvelope() if geometry is not None else None
+        self.is_rectangle = is_rectangle
+
+    @property
+    def match_all(self):
+        return self.geometry is None
+
+    def matches(self, gpkg_geom):
+        """
+        Returns True if the given geometry - a GPKG geometry, or None - matches the filter.
+        Geometries whose envelope doesn't intersect that of the filter are ruled out without being
+        parsed by OGR.
+        """
+        if self.geometry is None or gpkg_geom is None:
+            return True
+        envelope = gpkg_geom_to_envelope(gpkg_geom)
+        if envelope is None:
+            return True
+
+        f_min_x, f_max_x, f_min_y, f_max_y = self.envelope
+        min_x, max_x, min_y, max_y = envelope
+        if min_x > f_max_x or max_x < f_min_x or min_y > f_max_y or max_y < f_min_y:
+            return False
+        # A geometry entirely within a rectangular filter must match it - otherwise, intersecting the
+        # envelope of the filter doesn't mean intersecting the filter itself.
+        if (
+            self.is_rectangle
+            and min_x >= f_min_x
+            and max_x <= f_max_x
+            and min_y >= f_min_y
+            and max_y <= f_max_y
+        ):
+            return True
+        return self.geometry.Intersects(gpkg_geom_to_ogr(gpkg_geom))
+
+    def matches_feature(self, feature):
+        """Returns True if the given feature - a dict - matches the filter."""
+        if self.geometry is None:
+            return True
+        return self.matches(feature[self.geom_column_name])
+
+    def filter_feature_tuples(self, feature_tuples, geom_index):
+        """Yields only those feature tuples that match the filter. geom_index is the index of the geometry in each tuple."""
+        if self.geometry is None:
+            yield from feature_tuples
+            return
+        for feature in feature_tuples:
+            if self.matches(feature[geom_index]):
+                yield feature
+
+
+DatasetSpatialFilter.MATCH_ALL = DatasetSpatialFilter(None, None)
@@ -0,0 +1,280 @@
+import hashlib
+import itertools
+import json
+import logging
+import time
+from pathlib import Path
+
+from .exceptions import InvalidOperation, NotFound, NotYetImplemented
+from .geometry import gpkg_geom_to_envelope
+from .sno_repo import SnoRepoFiles
+
+
+L = logging.getLogger("sno.spatial_index")
+
+
+def _envelopes_of(features):
+    """Given (pk, geometry) tuples, returns a list of (pk, envelope) for those with a non-empty geometry."""
+    result = []
+    for pk, geom in features:
+        envelope = gpkg_geom_to_envelope(geom)
+        if envelope is not None:
+            result.append((pk, envelope))
+    return result
+
+
+def _read_shard_envelopes(dataset, shard):
+    """Returns a tuple (feature_count, [(pk, envelope), ...]) for the features in the given shard."""
+    col_names = [dataset.primary_key, dataset.geom_column_name]
+    features = list(dataset.decode_shard(shard, keys=False, col_names=col_names))
+    return len(features), _envelopes_of(features)
+
+
+class SpatialIndex:
+    """
+    A spatial index of the envelope of every feature in a dataset, for use by `sno query`.
+    Uses Rtree (libspatialindex underneath): http://toblerity.org/rtree/index.html
+
+    Each dataset path has one index, stored in the SPATIAL_INDEX directory in the sno repository.
+    Alongside it is a small JSON file recording the OID of the dataset tree that was indexed.
+    When the dataset changes - after a commit, pull, merge, or checkout of some other branch - the
+    index is brought up to date by diffing that tree against the current one, and applying each
+    changed feature as a delete and an insert, rather than by reading every feature again - and
+    only the primary key and geometry of each changed feature are decoded.
+    Only datasets with a single integer primary key are supported, since Rtree IDs are integers.
+    """
+
+    EXTENSIONS = ("sno-idxd", "sno-idxi")
+
+    # If more than this fraction of the features have changed, the index is rebuilt instead.
+    MAX_UPDATE_FRACTION = 0.5
+
+    # How often to log progress while building an index.
+    PROGRESS_INTERVAL = 50000
+
+    def __init__(self, repo, dataset_path):
+        self.repo = repo
+        self.dataset_path = dataset_path
+        # Dataset paths can contain slashes, so they're not used directly as filenames.
+        name = hashlib.sha1(dataset_path.encode("utf-8")).hexdigest()
+        self.base_path = Path(repo.path) / SnoRepoFiles.SPATIAL_INDEX / name
+        self.state_path = self.base_path.with_suffix(".json")
+
+    def _read_state(self):
+        try:
+            return json.loads(self.state_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            L.warning("Ignoring invalid spatial index state: %s", self.state_path)
+            return None
+
+    def _write_state(self, tree_id, feature_count):
+        """
+        Records which version of the dataset has been indexed. A tree_id of None means the index
+        is being modified, so that if that is interrupted, the index is rebuilt next time.
+        """
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            "datasetPath": self.dataset_path,
+            "treeId": tree_id,
+            "featureCount": feature_count,
+        }
+        self.state_path.write_text(json.dumps(state), encoding="utf-8")
+
+    def _properties(self, overwrite=False):
+        import rtree
+
+        p = rtree.index.Property()
+        p.dat_extension, p.idx_extension = self.EXTENSIONS
+        p.overwrite = overwrite
+        p.dimensionality = 2
+        if overwrite:
+            p.leaf_capacity = 1000
+            p.fill_factor = 0.9
+        return p
+
+    def _check_supported(self, dataset):
+        if not dataset.has_geometry:
+            raise InvalidOperation(
+                f"Dataset {self.dataset_path} has no geometry to index"
+            )
+        pk_columns = dataset.schema.pk_columns
+        if len(pk_columns) != 1 or pk_columns[0].data_type != "integer":
+            raise NotYetImplemented(
+                "Sorry, spatial indexing is only supported for datasets with a single integer primary key"
+            )
+
+    def build(self, dataset, num_workers=1):
+        """
+        Indexes every feature in the given dataset, replacing any existing index.
+        If num_workers is more than 1, the features are read by that many worker processes,
+        each reading a different tree of feature blobs (or bucket, for Datasets V3) at a time.
+        Returns the number of features in the dataset.
+        """
+        import rtree
+
+        self._check_supported(dataset)
+        self._write_state(None, None)
+
+        t0 = time.monotonic()
+        feature_count = 0
+
+        def _envelopes():
+            nonlocal feature_count
+            for count, envelopes in self._read_envelopes(dataset, num_workers):
+                progress = (feature_count + count) // self.PROGRESS_INTERVAL
+                if progress > feature_count // self.PROGRESS_INTERVAL:
+                    L.info(
+                        "  %d features... @%.1fs",
+                        progress * self.PROGRESS_INTERVAL,
+                        time.monotonic() - t0,
+                    )
+                feature_count += count
+                for pk, envelope in envelopes:
+                    yield (pk, envelope, None)
+
+        # The envelopes are streamed to Rtree, which bulk-loads them using Sort-Tile-Recursive -
+        # much quicker than inserting them one at a time, and gives a better balanced index.
+        # Rtree can't bulk-load from an empty stream.
+        envelopes = _envelopes()
+        first = next(envelopes, None)
+        args = (itertools.chain([first], envelopes),) if first is not None else ()
+        idx = rtree.index.Index(
+            str(self.base_path),
+            *args,
+            properties=self._properties(overwrite=True),
+            interleaved=False,
+        )
+        idx.close()
+
+        self._write_state(dataset.tree.hex, feature_count)
+        L.info(
+            "Indexed %d features in %s in %.1fs",
+            feature_count,
+            self.dataset_path,
+            time.monotonic() - t0,
+        )
+        return feature_count
+
+    def _read_envelopes(self, dataset, num_workers):
+        """
+        Yields a tuple (feature_count, [(pk, envelope), ...]) for each batch of features in
+        the dataset. Features without a geometry are counted, but have no envelope.
+        """
+        if dataset.VERSION < 2:
+            # Datasets V1 aren't sharded in a way that can be read in parallel.
+            features = iter(
+                dataset.feature_tuples([dataset.primary_key, dataset.geom_column_name])
+            )
+            batches = iter(lambda: list(itertools.islice(features, 1000)), [])
+            for batch in batches:
+                yield len(batch), _envelopes_of(batch)
+            return
+
+        # The order doesn't matter, since the envelopes are sorted when they are bulk-loaded.
+        yield from dataset.map_feature_shards(
+            self.repo, _read_shard_envelopes, num_workers=num_workers
+        )
+
+    def _get_indexed_dataset(self, dataset, state):
+        """
+        Returns the version of the given dataset that is currently indexed, or None if there isn't
+        one that can be updated incrementally.
+        """
+        tree_id = state.get("treeId") if state else None
+        if tree_id is None:
+            return None
+        try:
+            tree = self.repo[tree_id]
+        except KeyError:
+            # Eg, it was only ever in a commit that has since been garbage collected.
+            return None
+        indexed_dataset = dataset.__class__(tree, dataset.path)
+        if indexed_dataset.schema != dataset.schema:
+            return None
+        return indexed_dataset
+
+    def update(self, dataset):
+        """
+        Brings the index up to date with the given dataset, by applying the diff from whichever
+        version of the dataset is currently indexed. The index is rebuilt instead if there is no
+        usable indexed version, or if too many features have changed for that to be worthwhile.
+        Returns True if the index was updated incrementally, or False if it was rebuilt.
+        """
+        import rtree
+
+        state = self._read_state()
+        indexed_dataset = self._get_indexed_dataset(dataset, state)
+        if indexed_dataset is None:
+            self.build(dataset)
+            return False
+        if indexed_dataset.tree.id == dataset.tree.id:
+            return True
+
+        self._check_supported(dataset)
+        feature_count = state["featureCount"]
+        # The diff is found by comparing blob OIDs, without decoding any features.
+        deleted_pks, changed_pk_oids = indexed_dataset.diff_feature_oids(dataset)
+        change_count = len(deleted_pks) + len(changed_pk_oids)
+        if change_count > feature_count * self.MAX_UPDATE_FRACTION:
+            self.build(dataset)
+            return False
+
+        t0 = time.monotonic()
+        col_names = [dataset.primary_key, dataset.geom_column_name]
+        # Entries are removed from an Rtree by ID and envelope, so the old envelope of every deleted
+        # or updated feature is needed. Features that have just been inserted aren't found.
+        old_pks = deleted_pks + [pk for pk, oid in changed_pk_oids]
+        old_features = indexed_dataset.get_feature_tuples(
+            old_pks, col_names, ignore_missing=True
+        )
+        new_features = dataset.get_feature_tuples_by_oid(
+            self.repo, changed_pk_oids, col_names
+        )
+
+        self._write_state(None, None)
+        idx = rtree.index.Index(
+            str(self.base_path), properties=self._properties(), interleaved=False
+        )
+        for pk, geom in old_features:
+            feature_count -= 1
+            envelope = gpkg_geom_to_envelope(geom)
+            if envelope is not None:
+                idx.delete(pk, envelope)
+        for pk, geom in new_features:
+            feature_count += 1
+            envelope = gpkg_geom_to_envelope(geom)
+            if envelope is not None:
+                idx.insert(pk, envelope)
+        idx.close()
+
+        self._write_state(dataset.tree.hex, feature_count)
+        L.info(
+            "Updated spatial index of %s with %d changes in %.3fs",
+            self.dataset_path,
+            change_count,
+            time.monotonic() - t0,
+        )
+        return True
+
+    def open(self, dataset):
+        """
+        Returns the index as an rtree.index.Index, first updating it to match the given dataset
+        if it has changed since it was indexed. Raises NotFound if it has never been built.
+        Query it with .nearest(coords), .intersection(coords), .count(coords) - where coords are
+        interleaved, ie (minx, miny, maxx, maxy) - http://toblerity.org/rtree/index.html
+        Note that the index is built and updated with interleaved=False, using envelopes in the
+        (minx, maxx, miny, maxy) order that gpkg_geom_to_envelope returns - but the coordinates are
+        stored the same way either way, so only the order in which they are passed differs.
+        """
+        import rtree
+
+        state = self._read_state()
+        if state is None:
+            raise NotFound(
+                f"No spatial index found. Run `sno query {self.dataset_path} index`"
+            )
+        if state["treeId"] != dataset.tree.hex:
+            self.update(dataset)
+        return rtree.index.Index(str(self.base_path), properties=self._properties())
@@ -6,8 +6,9 @@ from pathlib import Path
 
 
 from sno import checkout, context
+from sno.dataset2 import Dataset2
 from sno.exceptions import InvalidOperation, NotFound
-from sno.fast_import import fast_import_tables, ReplaceExisting
+from sno.fast_import import fast_import_tables, ReplaceExisting, WrittenBlobs
 from sno.sno_repo import SnoRepo
 from sno.structure import RepositoryStructure
 from sno.repository_version import get_repo_version
@@ -15,6 +16,8 @@ from sno.timestamps import minutes_to_tz_offset
 
 
 UPGRADED_REPO_VERSION = 2
+# Datasets V3 are experimental, so repositories are only upgraded to V3 if that is requested.
+UPGRADEABLE_REPO_VERSIONS = (2, 3)
 
 
 def dataset_class_for_version(version):
@@ -26,6 +29,9 @@ def dataset_class_for_version(version):
         return UpgradeDataset0
     elif version == 1:
         return UpgradeDataset1
+    elif version == 2:
+        # Datasets V2 can be read as they are, when upgrading to V3.
+        return Dataset2
 
     raise ValueError(
         f"No upgradeable Dataset implementation found for version={version}"
@@ -36,7 +42,16 @@ def dataset_class_for_version(version):
 @click.pass_context
 @click.argument("source", type=click.Path(exists=True, file_okay=False), required=True)
 @click.argument("dest", type=click.Path(exists=False, writable=True), required=True)
-def upgrade(ctx, source, dest):
+@click.option(
+    "--repo-version",
+    type=click.Choice([str(v) for v in UPGRADEABLE_REPO_VERSIONS]),
+    default=str(UPGRADED_REPO_VERSION),
+    help=(
+        "Repository version to upgrade to. Version 3 - which packs features into buckets - "
+        "is experimental, see docs/DATASETS_v3.md"
+    ),
+)
+def upgrade(ctx, source, dest, repo_version):
     """
     Upgrade a repository for an earlier version of Sno to be compatible with the latest version.
     The current repository structure of Sno is known as Datasets V2, which is used from Sno 0.5 onwards.
@@ -44,6 +59,7 @@ def upgrade(ctx, source, dest):
     Usage:
     sno upgrade SOURCE DEST
     """
+    repo_version = int(repo_version)
     source = Path(source)
     dest = Path(dest)
 
@@ -58,14 +74,14 @@ def upgrade(ctx, source, dest):
         )
 
     source_version = get_repo_version(source_repo)
-    if source_version == 2:
+    if source_version >= repo_version:
         raise InvalidOperation(
-            "Cannot upgrade: source repository is already at latest version (Datasets V2)"
+            f"Cannot upgrade: source repository is already at version {source_version} (Datasets V{source_version})"
         )
 
-    if source_version not in (0, 1):
+    if source_version not in (0, 1, 2):
         raise InvalidOperation(
-            "Unrecognised source repository version: {source_version}"
+            f"Unrecognised source repository version: {source_version}"
         )
 
     source_dataset_class = dataset_class_for_version(source_version)
@@ -73,9 +89,7 @@ def upgrade(ctx, source, dest):
     # action!
     click.secho(f"Initialising {dest} ...", bold=True)
     dest.mkdir()
-    dest_repo = SnoRepo.init_repository(
-        dest, UPGRADED_REPO_VERSION, wc_path=None, bare=True
-    )
+    dest_repo = SnoRepo.init_repository(dest, repo_version, wc_path=None, bare=True)
 
     # walk _all_ references
     source_walker = source_repo.walk(
@@ -85,6 +99,9 @@ def upgrade(ctx, source, dest):
         source_walker.push(ref.resolve().target)
 
     commit_map = {}
+    # Most features are unchanged from one commit to the next - remember which blobs have been
+    # written already, so that they can be referred to by ID instead of being written again.
+    written_blobs = WrittenBlobs()
 
     click.secho("\nWriting new commits ...", bold=True)
     for i, source_commit in enumerate(source_walker):
@@ -106,6 +123,7 @@ def upgrade(ctx, source, dest):
             dest_parents,
             dest_repo,
             commit_map,
+            written_blobs,
         )
 
     click.echo(f"{i+1} commits processed.")
@@ -150,6 +168,7 @@ def _upgrade_commit(
     dest_parents,
     dest_repo,
     commit_map,
+    written_blobs,
 ):
 
     sources = [
@@ -162,7 +181,6 @@ def _upgrade_commit(
         )
     ]
     dataset_count = len(sources)
-    feature_count = sum(s.feature_count for s in sources)
 
     s = source_commit
     author_time = f"{s.author.time} {minutes_to_tz_offset(s.author.offset)}"
@@ -176,17 +194,19 @@ def _upgrade_commit(
     )
     header += "".join(f"merge {p}\n" for p in dest_parents)
 
-    fast_import_tables(
+    feature_counts = fast_import_tables(
         dest_repo,
         sources,
         replace_existing=ReplaceExisting.ALL,
         quiet=True,
         header=header,
+        written_blobs=written_blobs,
         # We import every commit onto refs/heads/master, even though not all commits are related - this means
         # the master branch head will jump all over the place. git-fast-import only allows this with --force.
         extra_cmd_args=["--force"],
     )
 
+    feature_count = sum(feature_counts.values())
     dest_commit = dest_repo.head.peel(pygit2.Commit)
     commit_map[source_commit.hex] = dest_commit.hex
 
@@ -13,10 +13,12 @@ from sno.exceptions import (
     NotYetImplemented,
     NotFound,
     NO_WORKING_COPY,
+    SPATIAL_FILTER_CONFLICT,
 )
 from sno.filter_util import UNFILTERED
 from sno.repository_version import get_repo_version
 from sno.schema import Schema
+from sno.spatial_filter import DatasetSpatialFilter, SpatialFilter
 from sno.structure import RepositoryStructure
 
 
@@ -40,10 +42,16 @@ class Mismatch(ValueError):
         return f"Working Copy is tree {self.working_copy_tree_id}; expecting {self.expected_tree_id}"
 
 
+# The spatial filter of a working copy is read from the config, unless one has been set on it.
+_SPATIAL_FILTER_FROM_CONFIG = object()
+
+
 class WorkingCopy:
     SNO_WORKINGCOPY_PATH = "sno.workingcopy.path"
 
-    VALID_VERSIONS = (1, 2)
+    _spatial_filter = _SPATIAL_FILTER_FROM_CONFIG
+
+    VALID_VERSIONS = (1, 2, 3)
 
     TRACKING_NAME = "track"
     STATE_NAME = "state"
@@ -231,6 +239,91 @@ class WorkingCopy:
                 return
             yield chunk
 
+    @property
+    def spatial_filter(self):
+        """
+        The SpatialFilter that restricts which features are written to this working copy,
+        or None if every feature is written. Read from the repo config, unless it has been set
+        on this working copy - as it is while the working copy is rewritten with a new spatial filter,
+        which is only stored in the config once that has succeeded.
+        """
+        if self._spatial_filter is not _SPATIAL_FILTER_FROM_CONFIG:
+            return self._spatial_filter
+        return SpatialFilter.from_config(self.repo)
+
+    @spatial_filter.setter
+    def spatial_filter(self, spatial_filter):
+        self._spatial_filter = spatial_filter
+
+    def _dataset_spatial_filter(self, dataset):
+        """Returns the spatial filter for the given dataset - see SpatialFilter.for_dataset."""
+        spatial_filter = self.spatial_filter
+        if spatial_filter is None:
+            return DatasetSpatialFilter.MATCH_ALL
+        return spatial_filter.for_dataset(dataset)
+
+    def _matching_pks(self, ds_filter, pk_geom_tuples):
+        """Given (pk, geometry) tuples, returns the primary keys of those that match ds_filter."""
+        return [pk for pk, geom in pk_geom_tuples if ds_filter.matches(geom)]
+
+    def _get_all_feature_pks(self, dataset):
+        """
+        Returns the primary keys of every feature in the dataset that matches the spatial filter,
+        or None if every feature matches. Only the primary key and geometry of each feature are decoded.
+        """
+        ds_filter = self._dataset_spatial_filter(dataset)
+        if ds_filter.match_all:
+            return None
+        pk_geom_tuples = dataset.feature_tuples(
+            [dataset.primary_key, dataset.geom_column_name]
+        )
+        return self._matching_pks(ds_filter, pk_geom_tuples)
+
+    def _get_all_feature_tuples(self, dataset, col_names, matching_pks=None):
+        """
+        Returns every feature in the dataset that matches the spatial filter, as tuples ordered by col_names.
+        If the result of _get_all_feature_pks is already known, it can be supplied as matching_pks.
+        """
+        if matching_pks is None:
+            matching_pks = self._get_all_feature_pks(dataset)
+        if matching_pks is None:
+            return dataset.feature_tuples(col_names)
+        return dataset.get_feature_tuples(matching_pks, col_names)
+
+    def _get_feature_tuples(
+        self, dataset, pk_iter, col_names, *, blob_oids=None, ignore_missing=False
+    ):
+        """
+        Returns the features with the given primary keys, as tuples ordered by col_names.
+        If the OIDs of the features' blobs are already known - for instance, from a diff - they can be
+        supplied as blob_oids, in the same order as pk_iter, so that no paths need be looked up.
+        Features that don't match the spatial filter are left out - only the primary key and geometry
+        of each feature are decoded to find out which those are.
+        """
+        ds_filter = self._dataset_spatial_filter(dataset)
+        if blob_oids is not None:
+            pk_oids = list(zip(pk_iter, blob_oids))
+            if not ds_filter.match_all:
+                pk_geom_tuples = dataset.get_feature_tuples_by_oid(
+                    self.repo, pk_oids, [dataset.primary_key, dataset.geom_column_name]
+                )
+                matching_pks = set(self._matching_pks(ds_filter, pk_geom_tuples))
+                pk_oids = [(pk, oid) for pk, oid in pk_oids if pk in matching_pks]
+            return dataset.get_feature_tuples_by_oid(self.repo, pk_oids, col_names)
+
+        if not ds_filter.match_all:
+            pk_geom_tuples = dataset.get_feature_tuples(
+                pk_iter,
+                [dataset.primary_key, dataset.geom_column_name],
+                ignore_missing=ignore_missing,
+            )
+            pk_iter = self._matching_pks(ds_filter, pk_geom_tuples)
+            # Only features that were found are left.
+            ignore_missing = False
+        return dataset.get_feature_tuples(
+            pk_iter, col_names, ignore_missing=ignore_missing
+        )
+
     def check_not_dirty(self, help_message=None):
         """Checks the working copy has no changes in it. Otherwise, raises InvalidOperation"""
         if not help_message:
@@ -321,6 +414,7 @@ class WorkingCopy:
         self, dataset, feature_filter, find_renames, raise_if_dirty=False
     ):
         pk_field = dataset.schema.pk_columns[0].name
+        ds_filter = self._dataset_spatial_filter(dataset)
 
         with self.session() as db:
             dbcur = db.cursor()
@@ -346,6 +440,20 @@ class WorkingCopy:
                 except KeyError:
                     repo_obj = None
 
+                if repo_obj is not None and not ds_filter.matches_feature(repo_obj):
+                    # This feature is outside the spatial filter, so it was never written to the
+                    # working copy - the row with the same primary key must have been inserted.
+                    if db_obj is None:
+                        # Inserted and then deleted again, so there's nothing to commit.
+                        continue
+                    if raise_if_dirty:
+                        raise WorkingCopyDirty()
+                    raise InvalidOperation(
+                        f"Feature {track_pk} in {dataset.path} was inserted with the same primary key "
+                        "as a feature outside the spatial filter - change its primary key before committing",
+                        exit_code=SPATIAL_FILTER_CONFLICT,
+                    )
+
                 if repo_obj == db_obj:
                     # DB was changed and then changed back - eg INSERT then DELETE.
                     # TODO - maybe delete track_pk from tracking table?
@@ -443,6 +551,34 @@ class WorkingCopy:
                 update_delta = delete_delta + insert_delta
                 feature_diff.add_delta(update_delta)
 
+    def delete_features_outside_spatial_filter(self, repo_diff):
+        """
+        Deletes the features in the given diff - which has just been committed - from the working copy,
+        if they were changed so that they no longer match the spatial filter. That way, the working copy
+        only has the features of the commit it is based on that match the filter, so that any other row
+        can be recognised as a new insert - see diff_db_to_tree_feature.
+        """
+        if self.spatial_filter is None:
+            return
+
+        repo_structure = RepositoryStructure.lookup(self.repo, self.get_db_tree())
+        with self.session() as db:
+            dbcur = db.cursor()
+            for dataset_path, ds_diff in repo_diff.items():
+                dataset = repo_structure[dataset_path]
+                ds_filter = self._dataset_spatial_filter(dataset)
+                if ds_filter.match_all:
+                    continue
+                delete_pks = [
+                    delta.new_key
+                    for delta in ds_diff.get("feature", {}).values()
+                    if delta.new is not None
+                    and not ds_filter.matches_feature(delta.new_value)
+                ]
+                if delete_pks:
+                    with self._suspend_triggers(dbcur, dataset):
+                        self.delete_features(dbcur, dataset, delete_pks)
+
     def update_state_table_tree(self, tree):
         """Write the given tree to the state table."""
         tree_id = tree.id.hex if isinstance(tree, pygit2.Tree) else tree
@@ -638,30 +774,23 @@ class WorkingCopy:
         dbcur - database cursor.
         track_changes_as_dirty - whether to track these changes as working-copy edits in the tracking table.
         """
-        feature_diff_index = base_ds.feature_tree.diff_to_tree(target_ds.feature_tree)
-        if not feature_diff_index:
+        delete_pks, insert_and_update_pk_oids = base_ds.diff_feature_oids(target_ds)
+        if not delete_pks and not insert_and_update_pk_oids:
             return
 
-        L.debug("Applying feature diff: about %s changes", len(feature_diff_index))
-
-        delete_pks = []
-        insert_and_update_pks = []
-
-        for d in feature_diff_index.deltas:
-            if d.old_file and d.old_file.path.startswith(base_ds.META_PATH):
-                continue
-            if d.new_file and d.new_file.path.startswith(base_ds.META_PATH):
-                continue
+        L.debug(
+            "Applying feature diff: %s deletes, %s inserts/updates",
+            len(delete_pks),
+            len(insert_and_update_pk_oids),
+        )
+        # The changed features are read straight from the blob OIDs in the diff.
+        insert_and_update_pks = [pk for pk, oid in insert_and_update_pk_oids]
+        insert_and_update_oids = [oid for pk, oid in insert_and_update_pk_oids]
 
-            if d.status == pygit2.GIT_DELTA_DELETED:
-                delete_pks.append(base_ds.decode_path_to_1pk(d.old_file.path))
-            elif d.status in (pygit2.GIT_DELTA_ADDED, pygit2.GIT_DELTA_MODIFIED):
-                insert_and_update_pks.append(
-                    target_ds.decode_path_to_1pk(d.new_file.path)
-                )
-            else:
-                # RENAMED, COPIED, IGNORED, TYPECHANGE, UNMODIFIED, UNREADABLE, UNTRACKED
-                raise NotImplementedError(f"Delta status: {d.status_char()}")
+        if not self._dataset_spatial_filter(target_ds).match_all:
+            # Features that have been updated so they no longer match the spatial filter aren't rewritten,
+            # so the old versions have to be deleted.
+            delete_pks = delete_pks + insert_and_update_pks
 
         if not track_changes_as_dirty:
             # We don't want to track these changes as working copy edits - they will be part of the new WC base.
@@ -672,7 +801,12 @@ class WorkingCopy:
 
         with ctx:
             self.delete_features(dbcur, base_ds, delete_pks)
-            self.write_features(dbcur, target_ds, insert_and_update_pks)
+            self.write_features(
+                dbcur,
+                target_ds,
+                insert_and_update_pks,
+                blob_oids=insert_and_update_oids,
+            )
 
     def _is_meta_update_supported(self, dataset_version, meta_diff):
         """
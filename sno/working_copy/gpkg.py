@@ -12,6 +12,7 @@ from osgeo import gdal
 
 from .base import WorkingCopy
 from sno import crs_util, gpkg, gpkg_adapter
+from sno.dataset_stats import DatasetStatsCache
 from sno.db_util import changes_rowcount
 from sno.filter_util import UNFILTERED
 from sno.geometry import Geometry, normalise_gpkg_geom
@@ -608,6 +609,7 @@ class WorkingCopy_GPKG(WorkingCopy):
             change_time = datetime.utcnow()
 
         L = logging.getLogger(f"{self.__class__.__qualname__}.write_full")
+        stats_cache = DatasetStatsCache(self.repo)
         with self.session(bulk=(0 if safe else 2)) as db:
             for dataset in datasets:
                 table = dataset.table_name
@@ -638,8 +640,15 @@ class WorkingCopy_GPKG(WorkingCopy):
                 t0p = t0
 
                 CHUNK_SIZE = 10000
-                total_features = dataset.feature_count
-                for rows in self._chunk(dataset.feature_tuples(col_names), CHUNK_SIZE):
+                matching_pks = self._get_all_feature_pks(dataset)
+                if matching_pks is not None:
+                    total_features = len(matching_pks)
+                else:
+                    total_features = stats_cache.feature_count(dataset)
+                feature_tuples = self._get_all_feature_tuples(
+                    dataset, col_names, matching_pks
+                )
+                for rows in self._chunk(feature_tuples, CHUNK_SIZE):
                     dbcur.executemany(sql_insert_features, rows)
                     feat_progress += len(rows)
 
@@ -680,7 +689,9 @@ class WorkingCopy_GPKG(WorkingCopy):
                 ("*", "tree", target_tree_or_commit.peel(pygit2.Tree).hex),
             )
 
-    def write_features(self, dbcur, dataset, pk_iter, *, ignore_missing=False):
+    def write_features(
+        self, dbcur, dataset, pk_iter, *, blob_oids=None, ignore_missing=False
+    ):
         cols, pk_field = self._get_columns(dataset)
         col_names = cols.keys()
 
@@ -694,8 +705,12 @@ class WorkingCopy_GPKG(WorkingCopy):
         feat_count = 0
         CHUNK_SIZE = 10000
         for rows in self._chunk(
-            dataset.get_feature_tuples(
-                pk_iter, col_names, ignore_missing=ignore_missing
+            self._get_feature_tuples(
+                dataset,
+                pk_iter,
+                col_names,
+                blob_oids=blob_oids,
+                ignore_missing=ignore_missing,
             ),
             CHUNK_SIZE,
         ):
@@ -568,7 +568,9 @@ class WorkingCopy_Postgis(WorkingCopy):
                 t0p = t0
 
                 CHUNK_SIZE = 10000
-                for rows in self._chunk(dataset.feature_tuples(col_names), CHUNK_SIZE):
+                for rows in self._chunk(
+                    self._get_all_feature_tuples(dataset, col_names), CHUNK_SIZE
+                ):
 
                     dbcur.executemany(sql_insert_features, rows)
                     feat_count += changes_rowcount(dbcur)
@@ -606,7 +608,9 @@ class WorkingCopy_Postgis(WorkingCopy):
                 ("*", "tree", commit.peel(pygit2.Tree).hex),
             )
 
-    def write_features(self, dbcur, dataset, pk_iter, *, ignore_missing=False):
+    def write_features(
+        self, dbcur, dataset, pk_iter, *, blob_oids=None, ignore_missing=False
+    ):
         pk_field = dataset.primary_key
         col_names = [col.name for col in dataset.schema]
 
@@ -630,8 +634,12 @@ class WorkingCopy_Postgis(WorkingCopy):
         feat_count = 0
         CHUNK_SIZE = 10000
         for rows in self._chunk(
-            dataset.get_feature_tuples(
-                pk_iter, col_names, ignore_missing=ignore_missing
+            self._get_feature_tuples(
+                dataset,
+                pk_iter,
+                col_names,
+                blob_oids=blob_oids,
+                ignore_missing=ignore_missing,
             ),
             CHUNK_SIZE,
         ):
@@ -2,8 +2,14 @@ import pytest
 
 
 from sno.sno_repo import SnoRepo
+from sno.spatial_filter import SpatialFilter
 from sno.structs import CommitWithReference
-from sno.exceptions import NO_BRANCH, NO_COMMIT
+from sno.structure import RepositoryStructure
+from sno.working_copy.gpkg import WorkingCopy_GPKG
+from sno.exceptions import NO_BRANCH, NO_COMMIT, SPATIAL_FILTER_CONFLICT
+
+
+H = pytest.helpers.helpers()
 
 
 @pytest.mark.parametrize(
@@ -90,3 +96,92 @@ def test_checkout_branches(data_archive, cli_runner, chdir, tmp_path, working_co
             r = cli_runner.invoke(["branch"])
             assert r.exit_code == 0, r.stderr
             assert r.stdout.splitlines() == ["  four", "  one", "* two"]
+
+
+def test_checkout_spatial_filter(data_working_copy, geopackage, cli_runner):
+    # The same box as test_query_cli_geo_count, which has 6 features in it.
+    spatial_filter = "EPSG:4326;177,-38,177.1,-37.9"
+
+    with data_working_copy("points2") as (repo_dir, wc_path):
+        db = geopackage(wc_path)
+        total_count = H.row_count(db, H.POINTS.LAYER)
+
+        r = cli_runner.invoke(["checkout", f"--spatial-filter={spatial_filter}"])
+        assert r.exit_code == 0, r.stderr
+        assert H.row_count(db, H.POINTS.LAYER) == 6
+        repo = SnoRepo(repo_dir)
+        assert repo.config["sno.workingcopy.spatialFilter"].startswith("EPSG:4326;")
+
+        # The features outside the spatial filter aren't shown as deleted.
+        r = cli_runner.invoke(["diff", "--exit-code"])
+        assert r.exit_code == 0, r.stderr
+
+        # Feature 1 is outside the spatial filter - inserting another feature with the
+        # same primary key would overwrite it.
+        record = {**H.POINTS.RECORD, "fid": 1}
+        with db:
+            cur = db.cursor()
+            cur.execute(f"SELECT COUNT(*) FROM {H.POINTS.LAYER} WHERE fid=1;")
+            assert cur.fetchone()[0] == 0
+            cur.execute(H.POINTS.INSERT, record)
+        r = cli_runner.invoke(["commit", "-m", "conflict"])
+        assert r.exit_code == SPATIAL_FILTER_CONFLICT, r.stderr
+
+        with db:
+            db.cursor().execute(f"DELETE FROM {H.POINTS.LAYER} WHERE fid=1;")
+        r = cli_runner.invoke(["diff", "--exit-code"])
+        assert r.exit_code == 0, r.stderr
+
+        # A new feature outside the spatial filter can be committed, but is then removed.
+        with db:
+            db.cursor().execute(H.POINTS.INSERT, H.POINTS.RECORD)
+        r = cli_runner.invoke(["commit", "-m", "outside"])
+        assert r.exit_code == 0, r.stderr
+        assert H.row_count(db, H.POINTS.LAYER) == 6
+        r = cli_runner.invoke(["diff", "--exit-code"])
+        assert r.exit_code == 0, r.stderr
+
+        r = cli_runner.invoke(["checkout", "--spatial-filter=none"])
+        assert r.exit_code == 0, r.stderr
+        assert H.row_count(db, H.POINTS.LAYER) == total_count + 1
+        assert "sno.workingcopy.spatialFilter" not in repo.config
+
+
+def test_checkout_spatial_filter_rewrite_fails(
+    data_working_copy, cli_runner, monkeypatch
+):
+    with data_working_copy("points2") as (repo_dir, wc_path):
+
+        def _write_full(self, *args, **kwargs):
+            raise RuntimeError("write_full failed")
+
+        monkeypatch.setattr(WorkingCopy_GPKG, "write_full", _write_full)
+        r = cli_runner.invoke(["checkout", "--spatial-filter=EPSG:4326;0,0,1,1"])
+        assert r.exit_code != 0
+        # The filter isn't stored, since the working copy wasn't rewritten with it.
+        assert "sno.workingcopy.spatialFilter" not in SnoRepo(repo_dir).config
+
+
+def test_spatial_filter_for_dataset(data_archive_readonly):
+    with data_archive_readonly("points2") as repo_dir:
+        dataset = RepositoryStructure(SnoRepo(repo_dir))[H.POINTS.LAYER]
+
+        # The dataset is already in the CRS of the filter, so the bounding box isn't reprojected.
+        spatial_filter = SpatialFilter.parse("EPSG:4326;177,-38,177.1,-37.9")
+        ds_filter = spatial_filter.for_dataset(dataset)
+        assert ds_filter.is_rectangle
+        assert ds_filter.envelope == (177, 177.1, -38, -37.9)
+
+        spatial_filter = SpatialFilter.parse(
+            "EPSG:2193;1900000,5700000,2000000,5800000"
+        )
+        ds_filter = spatial_filter.for_dataset(dataset)
+        assert not ds_filter.is_rectangle
+
+
+def test_spatial_filter_invalid(data_working_copy, cli_runner):
+    with data_working_copy("points2"):
+        r = cli_runner.invoke(["checkout", "--spatial-filter=177,-38,177.1,-37.9"])
+        assert r.exit_code == 2, r.stderr
+        r = cli_runner.invoke(["checkout", "--spatial-filter=EPSG:4326;POINT(1 2)"])
+        assert r.exit_code == 2, r.stderr
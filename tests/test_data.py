@@ -1,6 +1,15 @@
 import json
+from pathlib import Path
+
+import pygit2
 import pytest
 
+from sno.dataset_stats import DatasetStatsCache
+from sno.exceptions import NO_CHANGES
+from sno.path_structure import PathStructure
+from sno.sno_repo import SnoRepo
+from sno.structure import RepositoryStructure
+
 
 @pytest.mark.parametrize("output_format", ("text", "json"))
 @pytest.mark.parametrize(
@@ -55,6 +64,74 @@ def test_data_ls_with_ref(data_archive_readonly, cli_runner):
         assert output == {"sno.data.ls/v1": ["nz_pa_points_topo_150k"]}
 
 
+def test_data_ls_with_stats(data_archive, cli_runner):
+    with data_archive("points2"):
+        # The stats for HEAD^ are calculated by reading every feature,
+        # then those for HEAD are calculated from the stats for HEAD^ plus the diff.
+        r = cli_runner.invoke(["data", "ls", "-o", "json", "--with-stats", "HEAD^"])
+        assert r.exit_code == 0, r
+        r = cli_runner.invoke(["data", "ls", "-o", "json", "--with-stats"])
+        assert r.exit_code == 0, r
+        output = json.loads(r.stdout)
+        assert output["sno.data.ls/v1"] == ["nz_pa_points_topo_150k"]
+        stats = output["sno.data.stats/v1"]["nz_pa_points_topo_150k"]
+
+        repo = SnoRepo(".")
+        assert (Path(repo.path) / "DATASET_STATS").exists()
+        dataset = RepositoryStructure(repo)["nz_pa_points_topo_150k"]
+        assert stats == DatasetStatsCache._calculate_stats(dataset).to_json()
+        assert stats["featureCount"] == dataset.feature_count
+        assert stats["blobBytes"] > 0
+        min_x, max_x, min_y, max_y = stats["extent"]
+        assert min_x < max_x and min_y < max_y
+
+        r = cli_runner.invoke(["data", "ls", "--with-stats"])
+        assert r.exit_code == 0, r
+        assert r.stdout.splitlines()[:2] == [
+            "nz_pa_points_topo_150k",
+            f"    Features: {dataset.feature_count:,d}",
+        ]
+
+
+def test_data_reshard(data_archive, cli_runner):
+    with data_archive("points2"):
+        repo = SnoRepo(".")
+        orig_tree = repo.head.peel(pygit2.Tree)
+        dataset = RepositoryStructure(repo)["nz_pa_points_topo_150k"]
+        assert dataset.path_structure == PathStructure.DEFAULT
+        pk = dataset.primary_key
+        orig_features = {f[pk]: f for f in dataset.features()}
+
+        r = cli_runner.invoke(["data", "reshard", "--path-structure", "3x16"])
+        assert r.exit_code == 0, r
+        assert r.stdout.splitlines()[-1] == "Resharded nz_pa_points_topo_150k/ to 3x16"
+
+        dataset = RepositoryStructure(repo)["nz_pa_points_topo_150k"]
+        assert dataset.path_structure == PathStructure(3, 16)
+        feature_path = dataset.encode_1pk_to_path(1, relative=True)
+        assert feature_path.count("/") == 2 + 3
+        assert dataset.get_feature([1]) == orig_features[1]
+        assert {f[pk]: f for f in dataset.features()} == orig_features
+
+        # Only the feature paths have changed - the features and the working copy are unchanged.
+        r = cli_runner.invoke(["diff", "--exit-code", "HEAD^...HEAD"])
+        assert r.exit_code == 0, r
+        r = cli_runner.invoke(["status"])
+        assert r.exit_code == 0, r
+        assert "Nothing to commit, working copy clean" in r.stdout
+
+        r = cli_runner.invoke(["data", "reshard", "--path-structure", "3x16"])
+        assert r.exit_code == NO_CHANGES, r
+
+        # Resharding back to the default path structure gives back the original tree.
+        r = cli_runner.invoke(["data", "reshard", "--path-structure", "2x256"])
+        assert r.exit_code == 0, r
+        assert repo.head.peel(pygit2.Tree).id == orig_tree.id
+
+        r = cli_runner.invoke(["data", "reshard", "--path-structure", "5x256"])
+        assert r.exit_code == 2, r
+
+
 @pytest.mark.parametrize("output_format", ("text", "json"))
 @pytest.mark.parametrize(
     "archive_name",
@@ -1,4 +1,9 @@
+from types import SimpleNamespace
+
+import pygit2
+
 from sno.dataset2 import Dataset2
+from sno.feature_cache import FeatureCache
 from sno.schema import Legend, ColumnSchema, Schema
 
 
@@ -58,6 +63,10 @@ class MemoryBlob(bytes):
     def type_str(self):
         return "blob"
 
+    @property
+    def id(self):
+        return pygit2.hash(self)
+
 
 def test_legend_roundtrip():
     orig = Legend(["a", "b", "c"], ["d", "e", "f"])
@@ -276,3 +285,101 @@ def test_schema_change_roundtrip(gen_uuid):
         "first_name": "Joe",
         "middle_names": None,
     }
+
+
+def test_feature_decoder(gen_uuid):
+    old_schema = Schema(
+        [
+            ColumnSchema(gen_uuid(), "ID", "integer", 0),
+            ColumnSchema(gen_uuid(), "given_name", "text", None),
+            ColumnSchema(gen_uuid(), "surname", "text", None),
+            ColumnSchema(gen_uuid(), "date_of_birth", "date", None),
+        ]
+    )
+    new_schema = Schema(
+        [
+            ColumnSchema(old_schema[0].id, "personnel_id", "integer", 0),
+            ColumnSchema(gen_uuid(), "tax_file_number", "text", None),
+            ColumnSchema(old_schema[2].id, "last_name", "text", None),
+            ColumnSchema(old_schema[1].id, "first_name", "text", None),
+        ]
+    )
+    legend = old_schema.legend
+    pk_values, non_pk_values = (7,), ("Joe", "Bloggs", "1970-01-01")
+    raw_dict = legend.value_tuples_to_raw_dict(pk_values, non_pk_values)
+
+    for schema in (old_schema, new_schema):
+        for keys in (True, False):
+            decode = schema.feature_decoder(legend, keys=keys)
+            # Decoders are cached.
+            assert schema.feature_decoder(legend, keys=keys) is decode
+            assert decode(pk_values, non_pk_values) == schema.feature_from_raw_dict(
+                raw_dict, keys=keys
+            )
+
+    decode = new_schema.feature_decoder(legend, keys=False)
+    assert decode(pk_values, non_pk_values) == (7, None, "Bloggs", "Joe")
+
+    # A schema with a single column still decodes features as tuples.
+    pk_only_schema = Schema([old_schema[0]])
+    decode = pk_only_schema.feature_decoder(legend, keys=False)
+    assert decode(pk_values, non_pk_values) == (7,)
+
+
+def test_import_unchanged_features(gen_uuid):
+    schema = Schema(
+        [
+            ColumnSchema(gen_uuid(), "id", "integer", 0, size=64),
+            ColumnSchema(gen_uuid(), "name", "text", None),
+        ]
+    )
+    old_features = [{"id": 1, "name": "one"}, {"id": 2, "name": "two"}]
+    tree = MemoryTree(
+        dict(
+            [
+                EMPTY_DATASET.encode_schema(schema),
+                EMPTY_DATASET.encode_legend(schema.legend),
+                *(EMPTY_DATASET.encode_feature(f, schema) for f in old_features),
+            ]
+        )
+    )
+    replacing_dataset = Dataset2(tree / DATASET_PATH, DATASET_PATH)
+
+    new_features = [
+        {"id": 1, "name": "one"},
+        {"id": 2, "name": "TWO"},
+        {"id": 3, "name": "three"},
+    ]
+    source = SimpleNamespace(schema=schema)
+    result = list(
+        EMPTY_DATASET.import_iter_feature_blobs(
+            new_features, source, replacing_dataset=replacing_dataset
+        )
+    )
+
+    expected = [EMPTY_DATASET.encode_feature(f, schema) for f in new_features]
+    assert [path for path, data in result] == [path for path, data in expected]
+    # The unchanged feature is referred to by the OID of the existing blob.
+    assert result[0][1] == pygit2.hash(expected[0][1])
+    assert isinstance(result[0][1], pygit2.Oid)
+    # Changed and new features are written in full.
+    assert result[1:] == expected[1:]
+
+
+def test_feature_cache():
+    cache = FeatureCache(max_size=3 * (FeatureCache.ENTRY_OVERHEAD + 100))
+    feature = (1, "x" * (100 - FeatureCache.VALUE_OVERHEAD * 2))
+    for key in "abc":
+        cache.put(key, feature)
+    assert len(cache) == 3
+    assert cache.get("a") == feature
+    # "b" is now the least recently used.
+    cache.put("d", feature)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == [feature] * 3
+    assert (cache.hits, cache.misses, cache.evictions) == (4, 1, 1)
+
+    # Features that are too large to cache at all are not cached.
+    cache.put("e", ("x" * cache.max_size,))
+    assert cache.get("e") is None
+    assert len(cache) == 3
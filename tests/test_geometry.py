@@ -4,6 +4,7 @@ import pytest
 from osgeo import ogr, osr
 
 from sno.geometry import (
+    gpkg_geom_to_envelope,
     gpkg_geom_to_hex_wkb,
     gpkg_geom_to_ogr,
     hex_wkb_to_gpkg_geom,
@@ -232,3 +233,36 @@ def test_gpkg_wkb_gpkg_roundtrip(
     gpkg_geom = hex_wkb_to_gpkg_geom(hex_wkb_2)
 
     assert gpkg_geom == input
+
+
+@pytest.mark.parametrize(
+    "wkt,expected",
+    [
+        ("POINT(1 2)", (1, 1, 2, 2)),
+        ("POINT(1 2 3)", (1, 1, 2, 2)),
+        ("POINT EMPTY", None),
+        ("MULTIPOINT EMPTY", None),
+        ("MULTIPOINT ((1 2),(3 -4))", (1, 3, -4, 2)),
+        ("LINESTRING Z (1 2 3,4 5 6)", (1, 4, 2, 5)),
+        ("POLYGON((0 0,0 5,5 0,0 0))", (0, 5, 0, 5)),
+        ("POINT M (1 2 3)", (1, 1, 2, 2)),
+        ("LINESTRING ZM (1 2 3 4,-4 5 6 7)", (-4, 1, 2, 5)),
+        (
+            "MULTIPOLYGON(((0 0,0 5,5 0,0 0)),((10 -1,10 1,11 1,10 -1)))",
+            (0, 11, -1, 5),
+        ),
+        ("GEOMETRYCOLLECTION(POINT(7 8),LINESTRING(1 2,3 4))", (1, 7, 2, 8)),
+        ("GEOMETRYCOLLECTION EMPTY", None),
+        ("CIRCULARSTRING(0 0,1 1,2 0)", (0, 2, 0, 1)),
+    ],
+)
+@pytest.mark.parametrize("little_endian", [False, True])
+@pytest.mark.parametrize("with_envelope", [False, True])
+def test_gpkg_geom_to_envelope(wkt, expected, little_endian, with_envelope):
+    ogr_geom = ogr.CreateGeometryFromWkt(wkt)
+    kwargs = {"_little_endian": little_endian, "_little_endian_wkb": little_endian}
+    if not with_envelope:
+        kwargs["_add_envelope_type"] = GPKG_ENVELOPE_NONE
+    gpkg_geom = ogr_to_gpkg_geom(ogr_geom, **kwargs)
+    assert gpkg_geom_to_envelope(gpkg_geom) == expected
+    assert gpkg_geom_to_envelope(None) is None
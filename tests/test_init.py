@@ -3,7 +3,9 @@ import shutil
 
 import pytest
 import pygit2
+from osgeo import gdal
 
+from sno.ogr_import_source import OgrImportSource
 from sno.sno_repo import SnoRepo
 from sno.structure import RepositoryStructure
 from sno.working_copy import WorkingCopy
@@ -531,6 +533,26 @@ def test_init_import_table_ogr_types(
         ]
 
 
+def test_ogr_feature_batches(data_archive_readonly):
+    with data_archive_readonly("gpkg-types") as data:
+        ogr_source = str(data / "types.gpkg")
+        # Read the GPKG using the generic OGR code, rather than GPKGImportSource.
+        source = OgrImportSource(
+            gdal.OpenEx(ogr_source, gdal.OF_VECTOR | gdal.OF_READONLY),
+            "types",
+            source=ogr_source,
+            ogr_source=ogr_source,
+        )
+        col_names = [c.name for c in source.schema]
+        with source:
+            expected = [tuple(f[n] for n in col_names) for f in source.features()]
+            batches = list(source.feature_batches(batch_size=2))
+
+        assert expected
+        assert all(1 <= len(batch) <= 2 for batch in batches)
+        assert [f for batch in batches for f in batch] == expected
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize(*GPKG_IMPORTS)
 @pytest.mark.parametrize(*V1_OR_V2)
@@ -1,10 +1,24 @@
 import contextlib
+import http.client
 import json
+import pickle
+import re
+import socket
+import threading
 from pathlib import Path
 
+import msgpack
+import pygit2
 import pytest
 
+from sno.attribute_filter import AttributeFilter
+from sno.exceptions import NOT_FOUND
 from sno.geometry import hex_wkb_to_ogr
+from sno.query import DatasetQuery, make_query_server
+from sno.schema import ColumnSchema, Schema
+from sno.sno_repo import SnoRepo
+from sno.spatial_index import SpatialIndex
+from sno.structure import RepositoryStructure
 
 
 H = pytest.helpers.helpers()
@@ -30,15 +44,57 @@ def indexed_dataset(data_archive, cli_runner):
     ],
 )
 def test_build_spatial_index(archive, table, data_archive, cli_runner):
-    with data_archive(archive) as repo_dir:
-        for p in Path(repo_dir).glob(f"{table}.sno-idx*"):
-            p.unlink()
-
+    with data_archive(archive):
         r = cli_runner.invoke(["query", table, "index"])
-        assert r.exit_code == 0
+        assert r.exit_code == 0, r
+
+        repo = SnoRepo(".")
+        spatial_index = SpatialIndex(repo, table)
+        assert spatial_index.base_path.parent == Path(repo.path) / "spatial-index"
+        for ext in SpatialIndex.EXTENSIONS:
+            assert spatial_index.base_path.with_suffix(f".{ext}").exists()
+        state = json.loads(spatial_index.state_path.read_text())
+        assert state["treeId"] == RepositoryStructure(repo)[table].tree.hex
+
+
+def test_spatial_index_not_built(data_archive_readonly, cli_runner):
+    with data_archive_readonly("points"):
+        r = cli_runner.invoke(
+            ["query", H.POINTS.LAYER, "geo-count", "177,-38,177.1,-37.9"]
+        )
+        assert r.exit_code == NOT_FOUND, r
+        assert "No spatial index found" in r.stderr
+
 
-        assert (Path(repo_dir) / f"{table}.sno-idxi").exists()
-        assert (Path(repo_dir) / f"{table}.sno-idxd").exists()
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_spatial_index_update(archive, data_archive):
+    with data_archive(archive):
+        repo = SnoRepo(".")
+        old_dataset = RepositoryStructure.lookup(repo, "HEAD^")[H.POINTS.LAYER]
+        dataset = RepositoryStructure(repo)[H.POINTS.LAYER]
+        assert old_dataset.tree.id != dataset.tree.id
+
+        spatial_index = SpatialIndex(repo, H.POINTS.LAYER)
+        spatial_index.build(old_dataset)
+        # The index is brought up to date with HEAD by applying the diff.
+        assert spatial_index.update(dataset)
+        coords = (177, -38, 177.1, -37.9)
+        index = spatial_index.open(dataset)
+        updated_results = sorted(index.intersection(coords))
+        updated_nearest = list(index.nearest((177, -38), 4))
+        index.close()
+
+        spatial_index.build(dataset)
+        index = spatial_index.open(dataset)
+        assert updated_results == sorted(index.intersection(coords))
+        assert updated_nearest == list(index.nearest((177, -38), 4))
+        index.close()
+
+        # Opening the index for a different version updates it to match.
+        index = spatial_index.open(old_dataset)
+        index.close()
+        state = json.loads(spatial_index.state_path.read_text())
+        assert state["treeId"] == old_dataset.tree.hex
 
 
 def test_query_cli_get(indexed_dataset, cli_runner):
@@ -112,3 +168,270 @@ def test_query_cli_geo_intersects(indexed_dataset, cli_runner):
             assert (
                 intersects
             ), f"No intersection found for idx {i}/{len(data)-1}: {json.dumps(o)}"
+
+
+@contextlib.contextmanager
+def _query_server(table, address):
+    dataset_query = DatasetQuery(SnoRepo("."), table)
+    server = make_query_server(dataset_query, address)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        dataset_query.close()
+
+
+def _http_get(server, url, headers={}):
+    if isinstance(server.server_address, str):
+        conn = http.client.HTTPConnection("localhost")
+        conn.sock = socket.socket(socket.AF_UNIX)
+        conn.sock.connect(server.server_address)
+    else:
+        conn = http.client.HTTPConnection(*server.server_address[:2])
+    try:
+        conn.request("GET", url, headers=headers)
+        response = conn.getresponse()
+        return response.status, response.getheader("Content-Type"), response.read()
+    finally:
+        conn.close()
+
+
+def test_query_serve(indexed_dataset):
+    with indexed_dataset("points", H.POINTS.LAYER):
+        with _query_server(H.POINTS.LAYER, "127.0.0.1:0") as server:
+            status, content_type, body = _http_get(server, "/get/1")
+            assert status == 200
+            assert content_type == "application/json"
+            assert json.loads(body)["geom"] == (
+                "010100000097F3EF201223664087D715268E0043C0"
+            )
+
+            status, _, body = _http_get(server, "/geo-count/177,-38,177.1,-37.9")
+            assert status == 200
+            assert json.loads(body) == 6
+
+            status, _, body = _http_get(server, "/geo-nearest/177,-38/4")
+            assert status == 200
+            nearest = json.loads(body)
+            assert len(nearest) == 4
+            assert nearest[0]["fid"] == 147
+
+            status, content_type, body = _http_get(
+                server,
+                "/geo-intersects/177,-38,177.1,-37.9",
+                headers={"Accept": "application/msgpack"},
+            )
+            assert status == 200
+            assert content_type == "application/msgpack"
+            features = msgpack.unpackb(body, raw=False)
+            assert len(features) == 6
+            for feature in features:
+                assert isinstance(feature["geom"], bytes)
+
+            status, _, body = _http_get(server, "/geo-count/177,-38?format=msgpack")
+            assert status == 400
+            error = msgpack.unpackb(body, raw=False)["error"]
+            assert "geo-count X0,Y0,X1,Y1" in error
+
+            status, _, body = _http_get(server, "/nonsense")
+            assert status == 404
+            assert "Unknown command" in json.loads(body)["error"]
+
+
+def test_query_serve_unix_socket(indexed_dataset, tmp_path):
+    socket_path = tmp_path / "query.sock"
+    with indexed_dataset("points", H.POINTS.LAYER):
+        with _query_server(H.POINTS.LAYER, f"unix:{socket_path}") as server:
+            status, _, body = _http_get(server, "/geo-count/177,-38,177.1,-37.9")
+            assert status == 200
+            assert json.loads(body) == 6
+    assert not socket_path.exists()
+
+
+def test_query_refresh(indexed_dataset):
+    with indexed_dataset("points2", H.POINTS.LAYER):
+        repo = SnoRepo(".")
+        dataset_query = DatasetQuery(repo, H.POINTS.LAYER)
+        coords = "177,-38,177.1,-37.9"
+        assert dataset_query.run("geo-count", [coords]) == 6
+        assert not dataset_query.refresh()
+
+        old_commit = repo.revparse_single("HEAD^")
+        old_dataset = RepositoryStructure(repo, commit=old_commit)[H.POINTS.LAYER]
+        repo.reset(old_commit.id, pygit2.GIT_RESET_SOFT)
+        assert dataset_query.refresh()
+        assert dataset_query.dataset.tree.id == old_dataset.tree.id
+
+        # The spatial index is updated to match.
+        index = SpatialIndex(repo, H.POINTS.LAYER).open(old_dataset)
+        expected = index.count([float(c) for c in coords.split(",")])
+        index.close()
+        assert dataset_query.run("geo-count", [coords]) == expected
+        dataset_query.close()
+
+
+@pytest.fixture
+def where_schema(gen_uuid):
+    return Schema(
+        [
+            ColumnSchema(gen_uuid(), "fid", "integer", 0, size=64),
+            ColumnSchema(gen_uuid(), "geom", "geometry", None),
+            ColumnSchema(gen_uuid(), "status", "text", None),
+            ColumnSchema(gen_uuid(), "area", "float", None),
+            ColumnSchema(gen_uuid(), "price", "numeric", None),
+            ColumnSchema(gen_uuid(), "active", "boolean", None),
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    "expression,feature,expected",
+    [
+        ("status = 'proposed'", {"status": "proposed"}, True),
+        ("status = 'proposed'", {"status": None}, False),
+        ("NOT status = 'proposed'", {"status": None}, False),
+        ("status IS NULL", {"status": None}, True),
+        ("status IS NOT NULL", {"status": None}, False),
+        ("status = 'x' AND area > 1000", {"status": "x", "area": 2e3}, True),
+        ("status = 'x' AND area > 1000", {"status": "x", "area": 999}, False),
+        ("status = 'x' OR area >= 1000", {"status": None, "area": 1000.0}, True),
+        (
+            "(status = 'x' OR status = 'y') AND NOT active = TRUE",
+            {"status": "y", "active": False},
+            True,
+        ),
+        ("status IN ('a', 'b')", {"status": "b"}, True),
+        ("status NOT IN ('a', 'b')", {"status": "c"}, True),
+        ("status LIKE 'pro%'", {"status": "proposed"}, True),
+        ("status NOT LIKE 'pro_'", {"status": "proposed"}, True),
+        ("status = 'it''s'", {"status": "it's"}, True),
+        ("price < 10.5", {"price": "10.49"}, True),
+        ('"area" <> -1', {"area": -1.0}, False),
+        ("active = TRUE", {"active": True}, True),
+        ("geom IS NULL", {"geom": None}, True),
+    ],
+)
+def test_attribute_filter(expression, feature, expected, where_schema):
+    attribute_filter = AttributeFilter(expression, where_schema)
+    values = tuple(feature.get(name) for name in attribute_filter.col_names)
+    assert list(attribute_filter.matching_pks([(1,) + values])) == (
+        [1] if expected else []
+    )
+
+
+def test_attribute_filter_pickle(where_schema):
+    # Attribute filters are sent to the worker processes of a parallel scan.
+    attribute_filter = AttributeFilter("status = 'x' OR area >= 1000", where_schema)
+    unpickled = pickle.loads(pickle.dumps(attribute_filter))
+    assert unpickled.col_names == attribute_filter.col_names
+    assert list(unpickled.matching_pks([(1, "x", 0.0), (2, "y", 5.0)])) == [1]
+
+
+@pytest.mark.parametrize(
+    "expression,message",
+    [
+        ("", "Empty expression"),
+        ("nonexistent = 1", "No such column"),
+        ("area = 'big'", "Can't compare float column 'area' with string"),
+        ("status > 1", "Can't compare text column 'status' with number"),
+        ("geom = 'x'", "Can't filter on geometry column"),
+        ("area LIKE '1%'", "Can't use LIKE"),
+        ("status = 'a' AND", "Expected name"),
+        ("(area > 1", "Expected )"),
+        ("area > 1 area", "Unexpected 'area'"),
+        ("area ~ 1", "Unexpected character"),
+    ],
+)
+def test_attribute_filter_invalid(expression, message, where_schema):
+    with pytest.raises(ValueError, match=re.escape(message)):
+        AttributeFilter(expression, where_schema)
+
+
+@pytest.mark.parametrize("archive", ["points", "points2"])
+def test_query_cli_where(archive, indexed_dataset, cli_runner):
+    with indexed_dataset(archive, H.POINTS.LAYER):
+        dataset = RepositoryStructure(SnoRepo("."))[H.POINTS.LAYER]
+        expected = sorted(
+            f["fid"]
+            for f in dataset.features()
+            if f["macronated"] == "N" and f["name"] is not None
+        )
+        assert expected
+
+        expression = "macronated = 'N' AND name IS NOT NULL"
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "where", expression])
+        assert r.exit_code == 0, r
+        assert [f["fid"] for f in json.loads(r.stdout)] == expected
+
+        if archive == "points2":
+            r = cli_runner.invoke(
+                ["query", H.POINTS.LAYER, "where", expression, "--workers=2"]
+            )
+            assert r.exit_code == 0, r
+            assert [f["fid"] for f in json.loads(r.stdout)] == expected
+
+        # With a bounding box, only features that are in it are checked.
+        bbox = "177,-38,177.1,-37.9"
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "geo-intersects", bbox])
+        assert r.exit_code == 0, r
+        in_bbox = {f["fid"] for f in json.loads(r.stdout)}
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "where", expression, bbox])
+        assert r.exit_code == 0, r
+        assert [f["fid"] for f in json.loads(r.stdout)] == [
+            fid for fid in expected if fid in in_bbox
+        ]
+
+        r = cli_runner.invoke(["query", H.POINTS.LAYER, "where", "name > 1"])
+        assert r.exit_code == 2, r
+        assert "Can't compare text column 'name' with number" in r.stderr
+
+
+def test_query_cli_where_ref(data_archive_readonly, cli_runner):
+    with data_archive_readonly("points2"):
+        repo = SnoRepo(".")
+        old_dataset = RepositoryStructure.lookup(repo, "HEAD^")[H.POINTS.LAYER]
+        expected = sorted(f["fid"] for f in old_dataset.features() if f["fid"] < 10)
+
+        r = cli_runner.invoke(
+            ["query", H.POINTS.LAYER, "where", "fid < 10", "--ref=HEAD^"]
+        )
+        assert r.exit_code == 0, r
+        assert [f["fid"] for f in json.loads(r.stdout)] == expected
+
+
+@pytest.mark.parametrize("archive", ["points2", "polygons2"])
+def test_build_spatial_index_workers(archive, data_archive):
+    with data_archive(archive):
+        repo = SnoRepo(".")
+        dataset = next(iter(RepositoryStructure(repo)))
+        spatial_index = SpatialIndex(repo, dataset.path)
+
+        assert spatial_index.build(dataset) == dataset.feature_count
+        index = spatial_index.open(dataset)
+        bounds = index.bounds
+        expected = sorted(index.intersection(bounds))
+        index.close()
+        assert len(expected) > 0
+
+        assert spatial_index.build(dataset, num_workers=2) == dataset.feature_count
+        index = spatial_index.open(dataset)
+        assert index.bounds == bounds
+        assert sorted(index.intersection(bounds)) == expected
+        index.close()
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("num_workers", [1, 4])
+def test_build_spatial_index_performance(num_workers, data_archive, benchmark):
+    benchmark.group = "test_build_spatial_index_performance"
+    with data_archive("polygons2"):
+        repo = SnoRepo(".")
+        dataset = RepositoryStructure(repo)[H.POLYGONS.LAYER]
+        spatial_index = SpatialIndex(repo, dataset.path)
+
+        feature_count = benchmark(spatial_index.build, dataset, num_workers=num_workers)
+        assert feature_count == dataset.feature_count
@@ -1,4 +1,6 @@
+import collections
 import contextlib
+import io
 import itertools
 import os
 import re
@@ -10,14 +12,28 @@ import pygit2
 import pytest
 
 from sno import fast_import, gpkg, structure
+from sno.native_import import NativeImport
 from sno.ogr_import_source import OgrImportSource, PostgreSQLImportSource
 from sno.base_dataset import BaseDataset
 from sno.dataset1 import Dataset1
-from sno.dataset2 import Dataset2
+from sno.dataset2 import Dataset2, find_blobs_in_tree
+from sno.dataset3 import (
+    BucketCache,
+    Dataset3,
+    bucket_feature_count,
+    encode_bucket,
+)
+from sno.diff_structs import DatasetDiff, DeltaDiff, Delta
 from sno.exceptions import INVALID_OPERATION
+from sno.feature_cache import feature_cache
 from sno.geometry import ogr_to_gpkg_geom, gpkg_geom_to_ogr
+from sno.out_of_line import OutOfLine
+from sno.path_structure import PathStructure
+from sno.serialise_util import HashedBlob
+from sno.rich_tree_builder import RichTreeBuilder
 from sno.sno_repo import SnoRepo
 from sno.repository_version import REPO_VERSIONS_CHOICE
+from sno.serialise_util import msg_pack, msg_unpack, ValueRef
 
 
 H = pytest.helpers.helpers()
@@ -54,6 +70,7 @@ V1_OR_V2 = ("repo_version", [1, 2])
 def test_dataset_versions():
     assert BaseDataset.for_version(1) == Dataset1
     assert BaseDataset.for_version(2) == Dataset2
+    assert BaseDataset.for_version(3) == Dataset3
 
     for choice in REPO_VERSIONS_CHOICE.choices:
         assert BaseDataset.for_version(choice) is not None
@@ -79,11 +96,16 @@ def _import_check(repo_path, table, source_gpkg, geopackage, repo_version=None):
         )
     elif dataset.VERSION == 2:
         re_paths = r"^\d{6} blob [0-9a-f]{40}\t%s/.sno-dataset/feature/.*$" % table
+    elif dataset.VERSION == 3:
+        # Features are packed into buckets, so there isn't a blob for every feature.
+        num_rows = dataset.feature_count
+        re_paths = None
     else:
         raise NotImplementedError(dataset.VERSION)
 
-    git_paths = [m for m in re.findall(re_paths, o.decode("utf-8"), re.MULTILINE)]
-    assert len(git_paths) == num_rows
+    if re_paths is not None:
+        git_paths = [m for m in re.findall(re_paths, o.decode("utf-8"), re.MULTILINE)]
+        assert len(git_paths) == num_rows
 
     num_features = sum(1 for _ in dataset.features())
     assert num_features == num_rows
@@ -652,6 +674,27 @@ def test_postgis_import_from_view_with_ogc_fid(
         )
 
 
+def test_postgis_import_feature_batches(postgis_layer):
+    with postgis_layer(
+        "gpkg-polygons", "nz-waca-adjustments.gpkg", "nz_waca_adjustments"
+    ):
+        source = OgrImportSource.open(
+            os.environ["SNO_POSTGRES_URL"], table="nz_waca_adjustments"
+        )
+        assert isinstance(source, PostgreSQLImportSource)
+        with source:
+            # The same features, read using OGR.
+            expected = [
+                f for batch in OgrImportSource.feature_batches(source) for f in batch
+            ]
+            batches = list(source.feature_batches(batch_size=50))
+
+        assert len(batches) > 1
+        assert all(len(batch) <= 50 for batch in batches)
+        got = [f for batch in batches for f in batch]
+        assert sorted(got, key=lambda f: f[0]) == sorted(expected, key=lambda f: f[0])
+
+
 def test_pk_encoding():
     ds = Dataset1(None, "mytable")
 
@@ -730,6 +773,504 @@ def test_feature_find_decode_performance(
         raise NotImplementedError(f"Unknown profile: {profile}")
 
 
+@pytest.mark.slow
+@pytest.mark.parametrize(*GPKG_IMPORTS)
+@pytest.mark.parametrize("profile", ["get_feature", "features"])
+def test_features_iteration_performance(
+    profile,
+    archive,
+    source_gpkg,
+    table,
+    data_imported,
+    benchmark,
+    request,
+):
+    """ Check bulk feature decoding performance """
+    param_ids = H.parameter_ids(request)
+    benchmark.group = f"test_features_iteration_performance - {param_ids[-1]}"
+
+    repo_path = data_imported(archive, source_gpkg, table, "2")
+    repo = SnoRepo(repo_path)
+    dataset = structure.RepositoryStructure(repo)["mytable"]
+    expected = sorted(
+        (
+            dataset.get_feature(path=blob.name, data=blob.data, keys=False)
+            for blob in find_blobs_in_tree(dataset.tree / dataset.FEATURE_PATH)
+        ),
+        key=lambda f: f[0],
+    )
+    assert dataset.feature_count == len(expected)
+
+    if profile == "get_feature":
+        # The old way of iterating over features - decoding each blob separately.
+        def _read_all():
+            return [
+                dataset.get_feature(path=blob.name, data=blob.data)
+                for blob in find_blobs_in_tree(dataset.tree / dataset.FEATURE_PATH)
+            ]
+
+    elif profile == "features":
+
+        def _read_all():
+            return list(dataset.features())
+
+        # Both ways of decoding features should give the same results.
+        actual = sorted(dataset.features(keys=False), key=lambda f: f[0])
+        assert actual == expected
+        assert [tuple(f.values()) for f in dataset.features()] == [
+            tuple(f) for f in dataset.features(keys=False)
+        ]
+    else:
+        raise NotImplementedError(f"Unknown profile: {profile}")
+
+    features = benchmark(_read_all)
+    assert len(features) == len(expected)
+
+
+def test_feature_tuples_projection(data_archive_readonly):
+    with data_archive_readonly("points2"):
+        repo = SnoRepo(".")
+        dataset = structure.RepositoryStructure(repo)[H.POINTS.LAYER]
+        pk, geom = dataset.primary_key, dataset.geom_column_name
+        all_names = [c.name for c in dataset.schema]
+        features = {f[pk]: f for f in dataset.features()}
+
+        for col_names in (
+            [pk],
+            [geom, pk],
+            [name for name in reversed(all_names) if name != geom],
+            all_names,
+        ):
+            tuples = list(dataset.feature_tuples(col_names))
+            assert len(tuples) == len(features)
+            for t in tuples:
+                feature = features[t[col_names.index(pk)]]
+                assert t == tuple(feature[name] for name in col_names)
+
+        pks = sorted(features)[:10]
+        assert list(dataset.get_feature_tuples(pks, [geom, pk])) == [
+            (features[p][geom], p) for p in pks
+        ]
+
+
+def test_get_feature_tuples_batched(data_archive_readonly):
+    with data_archive_readonly("points2"):
+        repo = SnoRepo(".")
+        dataset = structure.RepositoryStructure(repo)[H.POINTS.LAYER]
+        pk = dataset.primary_key
+        pk_index = [c.name for c in dataset.schema].index(pk)
+        features = {f[pk]: tuple(f.values()) for f in dataset.features()}
+        pks = list(features)[::7]
+
+        result = list(dataset.get_feature_tuples(reversed(pks)))
+        assert sorted(result, key=lambda t: t[pk_index]) == [
+            features[p] for p in sorted(pks)
+        ]
+        # Features are found by walking the feature tree in order.
+        paths = [dataset.encode_1pk_to_path(t[pk_index]) for t in result]
+        assert paths == sorted(paths)
+
+        with pytest.raises(KeyError):
+            list(dataset.get_feature_tuples([pks[0], -1]))
+        result = list(dataset.get_feature_tuples([pks[0], -1], ignore_missing=True))
+        assert result == [features[pks[0]]]
+
+        # Features can also be read straight from the blob OIDs in a diff.
+        old_dataset = structure.RepositoryStructure.lookup(repo, "HEAD^")[
+            H.POINTS.LAYER
+        ]
+        diff = old_dataset.feature_tree.diff_to_tree(dataset.feature_tree)
+        pk_oids = [
+            (dataset.decode_path_to_1pk(d.new_file.path), d.new_file.id)
+            for d in diff.deltas
+            if d.status != pygit2.GIT_DELTA_DELETED
+        ]
+        assert pk_oids
+        assert list(dataset.get_feature_tuples_by_oid(repo, pk_oids)) == [
+            features[pk] for pk, oid in pk_oids
+        ]
+
+
+def test_get_feature_cached(data_archive_readonly):
+    with data_archive_readonly("points2"):
+        repo = SnoRepo(".")
+        dataset = structure.RepositoryStructure(repo)[H.POINTS.LAYER]
+        feature_cache.clear()
+        hits = feature_cache.hits
+
+        feature = dataset.get_feature([1])
+        assert feature_cache.hits == hits
+        assert dataset.get_feature([1]) == feature
+        assert dataset.get_feature([1], keys=False) == tuple(feature.values())
+        assert feature_cache.hits == hits + 2
+        # Projections and whole-dataset reads don't use the cache.
+        list(dataset.get_feature_tuples([[1]], col_names=[dataset.primary_key]))
+        list(dataset.features())
+        assert feature_cache.hits == hits + 2
+
+
+def test_path_structure():
+    assert PathStructure.parse("auto") == PathStructure.AUTO
+    assert PathStructure.parse("3x4096") == PathStructure(3, 4096)
+    for spec in ("3", "3x100", "0x256", "5x256", "axb"):
+        with pytest.raises(ValueError):
+            PathStructure.parse(spec)
+
+    assert PathStructure.DEFAULT.tree_names("abcdef0123") == ("ab", "cd")
+    assert PathStructure(3, 16).tree_names("abcdef0123") == ("a", "b", "c")
+    assert PathStructure(1, 4096).tree_names("abcdef0123") == ("abc",)
+
+    assert PathStructure.for_feature_count(10_000) == PathStructure(1, 256)
+    assert PathStructure.for_feature_count(1_000_000) == PathStructure(2, 256)
+    assert PathStructure.for_feature_count(100_000_000) == PathStructure(3, 256)
+    assert PathStructure.resolve(None, 100_000_000) == PathStructure.DEFAULT
+
+
+@pytest.mark.parametrize(
+    "path_structure",
+    [PathStructure(1, 4096), PathStructure(3, 16), PathStructure.AUTO],
+    ids=str,
+)
+def test_fast_import_path_structure(
+    path_structure, data_archive, tmp_path, cli_runner, chdir
+):
+    table = H.POINTS.LAYER
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            fast_import.fast_import_tables(
+                repo, [source], path_structure=path_structure
+            )
+
+            dataset = structure.RepositoryStructure(repo)[table]
+            expected = PathStructure.resolve(path_structure, source.feature_count)
+            assert dataset.path_structure == expected
+            assert (
+                dataset.get_data_at(dataset.PATH_STRUCTURE_PATH, missing_ok=True)
+                is not None
+            )
+
+            blobs = list(find_blobs_in_tree(dataset.tree / dataset.FEATURE_PATH))
+            assert len(blobs) == dataset.feature_count == source.feature_count
+            for blob in blobs[:10]:
+                pk = dataset.decode_path_to_1pk(blob.name)
+                path = dataset.encode_1pk_to_path(pk, relative=True)
+                assert len(path.split("/")) == 3 + expected.levels
+                assert dataset.get_blob_id_at(path) == blob.id
+
+            pk = dataset.primary_key
+            assert {f[pk]: f for f in dataset.features()} == {
+                f[pk]: f for f in source.features()
+            }
+            pks = [[1], [2], [3]]
+            assert sorted(f[0] for f in dataset.get_feature_tuples(pks)) == [1, 2, 3]
+
+
+def test_dataset3_buckets(data_archive, tmp_path, cli_runner, chdir):
+    table = H.POINTS.LAYER
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init", "--repo-version", "3"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            fast_import.fast_import_tables(
+                repo, [source], path_structure=PathStructure(1, 256)
+            )
+
+            dataset = structure.RepositoryStructure(repo)[table]
+            assert dataset.VERSION == 3
+            # There is a blob for each bucket, not for each feature.
+            buckets = list(find_blobs_in_tree(dataset.tree / dataset.FEATURE_PATH))
+            assert len(buckets) <= 256
+            assert dataset.feature_count == source.feature_count
+
+            pk = dataset.primary_key
+            features = {f[pk]: f for f in dataset.features()}
+            assert features == {f[pk]: f for f in source.features()}
+            assert dataset.get_feature([1]) == features[1]
+            pks = [[1], [2], [3]]
+            assert sorted(f[0] for f in dataset.get_feature_tuples(pks)) == [1, 2, 3]
+
+            inserted = dict(features[3], fid=9999)
+            updated = dict(features[2], name="Te Motu-a-kore")
+            ds_diff = DatasetDiff()
+            ds_diff["feature"] = DeltaDiff(
+                [
+                    Delta.delete((1, features[1])),
+                    Delta.update((2, features[2]), (2, updated)),
+                    Delta.insert((9999, inserted)),
+                ]
+            )
+            tree_builder = RichTreeBuilder(repo, repo.head.peel(pygit2.Tree))
+            dataset.apply_diff(ds_diff, tree_builder)
+            new_dataset = Dataset3(tree_builder.flush() / dataset.path, dataset.path)
+
+            assert new_dataset.feature_count == dataset.feature_count
+            assert new_dataset.get_feature([2]) == updated
+            assert new_dataset.get_feature([9999]) == inserted
+            with pytest.raises(KeyError):
+                new_dataset.get_feature([1])
+
+            feature_diff = dataset.diff_feature(new_dataset)
+            assert {k: d.type for k, d in feature_diff.items()} == {
+                1: "delete",
+                2: "update",
+                9999: "insert",
+            }
+            assert feature_diff[2].new_value == updated
+            reverse_diff = dataset.diff_feature(new_dataset, reverse=True)
+            assert {k: d.type for k, d in reverse_diff.items()} == {
+                1: "insert",
+                2: "update",
+                9999: "delete",
+            }
+
+            deleted_pks, changed_pk_oids = dataset.diff_feature_oids(new_dataset)
+            assert deleted_pks == [1]
+            changed = new_dataset.get_feature_tuples_by_oid(repo, changed_pk_oids)
+            assert sorted(f[0] for f in changed) == [2, 9999]
+
+            # Resharding rewrites every bucket, but doesn't change any features.
+            fast_import.reshard_datasets(
+                repo, [dataset], PathStructure(2, 16), quiet=True
+            )
+            resharded = structure.RepositoryStructure(repo)[table]
+            assert resharded.path_structure == PathStructure(2, 16)
+            assert resharded.feature_count == dataset.feature_count
+            assert not dataset.diff_feature(resharded)
+            assert new_dataset.diff_feature(resharded).keys() == feature_diff.keys()
+
+
+def test_bucket_feature_count():
+    records = {msg_pack([i]): b"x" * i for i in range(20)}
+    assert bucket_feature_count(encode_bucket(records)) == 20
+    assert bucket_feature_count(encode_bucket({})) == 0
+
+
+def test_bucket_cache():
+    FakeBlob = collections.namedtuple("FakeBlob", ("id", "data"))
+    blobs = [
+        FakeBlob(pygit2.hash(b"%d" % i), encode_bucket({b"%d" % i: b"data"}))
+        for i in range(3)
+    ]
+    cache = BucketCache(max_size=2)
+    bucket = cache.get(blobs[0])
+    assert bucket == {b"0": b"data"}
+    assert cache.get(blobs[0]) is bucket
+    cache.get(blobs[1])
+    cache.get(blobs[2])
+    # The least recently used bucket has been forgotten, so is decoded again.
+    assert cache.get(blobs[0]) is not bucket
+
+
+def test_out_of_line():
+    assert OutOfLine.parse("none") == OutOfLine.NONE
+    assert OutOfLine.parse("geometry") == OutOfLine(geometry=True)
+    assert OutOfLine.parse("65536") == OutOfLine(min_size=65536)
+    assert OutOfLine.parse("geometry, 1000") == OutOfLine(True, 1000)
+    assert not OutOfLine.NONE.enabled
+    assert str(OutOfLine(True, 1000)) == "geometry,1000"
+    for spec in ("geometry,geometry", "1,2", "0", "big"):
+        with pytest.raises(ValueError):
+            OutOfLine.parse(spec)
+
+    out_of_line = OutOfLine(min_size=4)
+    assert out_of_line.stores_out_of_line("abcd")
+    assert not out_of_line.stores_out_of_line("abc")
+    assert not out_of_line.stores_out_of_line(12345)
+
+    ref = ValueRef("ab" * 20, True)
+    assert msg_unpack(msg_pack([1, ref])) == [1, ref]
+    assert msg_unpack(msg_pack([1, ref]), skip_geometry=True) == [1, None]
+
+
+def test_out_of_line_values(data_archive, tmp_path, cli_runner, chdir):
+    table = H.POINTS.LAYER
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            fast_import.fast_import_tables(
+                repo, [source], out_of_line=OutOfLine(geometry=True)
+            )
+
+            dataset = structure.RepositoryStructure(repo)[table]
+            assert dataset.out_of_line == OutOfLine(geometry=True)
+            assert dataset.feature_count == source.feature_count
+            value_tree = dataset.tree / dataset.VALUE_PATH
+            value_blobs = list(find_blobs_in_tree(value_tree, max_depth=3))
+            assert len(value_blobs) == source.feature_count
+
+            pk = dataset.primary_key
+            features = {f[pk]: f for f in dataset.features()}
+            assert features == {f[pk]: f for f in source.features()}
+            assert dataset.get_feature([1]) == features[1]
+            assert sorted(dataset.get_feature_tuples([[1], [2]])) == sorted(
+                tuple(features[i].values()) for i in (1, 2)
+            )
+
+            def value_blob_ids(ds, pk_value):
+                path = ds.encode_1pk_to_path(pk_value, relative=True)
+                return {blob.name for blob in ds.get_value_blobs(path)}
+
+            # Editing only the attributes of a feature doesn't write its geometry again.
+            updated = dict(features[2], name="Te Motu-a-kore")
+            moved = dict(features[3], geom=features[4]["geom"])
+            ds_diff = DatasetDiff()
+            ds_diff["feature"] = DeltaDiff(
+                [
+                    Delta.delete((1, features[1])),
+                    Delta.update((2, features[2]), (2, updated)),
+                    Delta.update((3, features[3]), (3, moved)),
+                ]
+            )
+            tree_builder = RichTreeBuilder(repo, repo.head.peel(pygit2.Tree))
+            dataset.apply_diff(ds_diff, tree_builder)
+            new_dataset = Dataset2(tree_builder.flush() / dataset.path, dataset.path)
+
+            assert new_dataset.get_feature([2]) == updated
+            assert new_dataset.get_feature([3]) == moved
+            with pytest.raises(KeyError):
+                new_dataset.get_feature([1])
+            assert not value_blob_ids(new_dataset, 1)
+            assert value_blob_ids(new_dataset, 2) == value_blob_ids(dataset, 2)
+            assert value_blob_ids(new_dataset, 3) == value_blob_ids(dataset, 4)
+
+            # The geometries are stored by reference, so they can be compared without being read.
+            old_raw = dataset.get_raw_feature_dict([2], resolve_refs=False)
+            new_raw = new_dataset.get_raw_feature_dict([2], resolve_refs=False)
+            assert [v for v in old_raw.values() if isinstance(v, ValueRef)] == [
+                v for v in new_raw.values() if isinstance(v, ValueRef)
+            ]
+
+            feature_diff = dataset.diff_feature(new_dataset)
+            assert {k: d.type for k, d in feature_diff.items()} == {
+                1: "delete",
+                2: "update",
+                3: "update",
+            }
+            assert feature_diff[3].new_value == moved
+
+            # Resharding moves the value blobs along with the features.
+            fast_import.reshard_datasets(
+                repo, [dataset], PathStructure(1, 16), quiet=True
+            )
+            resharded = structure.RepositoryStructure(repo)[table]
+            assert value_blob_ids(resharded, 2) == value_blob_ids(dataset, 2)
+            assert not dataset.diff_feature(resharded)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("repo_version", ["2", "3"])
+def test_feature_buckets_performance(
+    repo_version, data_archive, tmp_path, cli_runner, chdir, benchmark
+):
+    """ Number of git objects in an imported dataset, and the time taken to check it out, for Datasets V2 and V3 """
+    benchmark.group = "test_feature_buckets_performance"
+
+    with data_archive("gpkg-polygons") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init", "--repo-version", repo_version])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-waca-adjustments.gpkg", table=H.POLYGONS.LAYER
+            )
+            fast_import.fast_import_tables(repo, [source])
+
+            o = subprocess.check_output(
+                ["git", "rev-list", "--objects", "--all"], cwd=repo.path
+            )
+            object_count = len(o.splitlines())
+            benchmark.extra_info["object_count"] = object_count
+            benchmark.extra_info["feature_count"] = source.feature_count
+            if repo_version == "3":
+                assert object_count < source.feature_count
+
+            def _checkout():
+                r = cli_runner.invoke(["create-workingcopy", "--force"])
+                assert r.exit_code == 0, r
+
+            benchmark(_checkout)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "feature_count",
+    [
+        pytest.param(10_000, id="10k"),
+        pytest.param(1_000_000, id="1M"),
+        pytest.param(
+            100_000_000,
+            id="100M",
+            marks=pytest.mark.skipif(
+                not os.environ.get("SNO_BENCHMARK_HUGE"),
+                reason="set SNO_BENCHMARK_HUGE to build a 100M feature tree",
+            ),
+        ),
+    ],
+)
+@pytest.mark.parametrize(
+    "path_structure",
+    [PathStructure(1, 256), PathStructure.DEFAULT, PathStructure(3, 256)],
+    ids=str,
+)
+def test_feature_tree_sharding_performance(
+    feature_count, path_structure, tmp_path, benchmark, request
+):
+    """ Per-commit cost of writing a single feature, for different path structures """
+    param_ids = H.parameter_ids(request)
+    benchmark.group = f"test_feature_tree_sharding_performance - {param_ids[-1]}"
+
+    repo = pygit2.init_repository(str(tmp_path / "repo"), bare=True)
+    dataset = Dataset2(tree=None, path="mytable")
+    dataset.path_structure = path_structure
+
+    # Every feature shares the same blob - only the size of the trees matters here.
+    blob = repo[repo.create_blob(b"feature")]
+    tree_builder = RichTreeBuilder(repo, None)
+    for pk in range(feature_count):
+        tree_builder.insert(dataset.encode_1pk_to_path(pk), blob)
+    tree_builder.flush()
+
+    new_blobs = (repo[repo.create_blob(b"%d" % i)] for i in itertools.count())
+    pk_iter = itertools.cycle(range(feature_count))
+
+    def _write_feature():
+        tree_builder.insert(dataset.encode_1pk_to_path(next(pk_iter)), next(new_blobs))
+        return tree_builder.flush()
+
+    benchmark(_write_feature)
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize("repo_version", ["1"])
 def test_import_multiple(
@@ -815,6 +1356,125 @@ def test_import_into_empty_branch(data_archive, cli_runner, chdir, tmp_path):
             assert repo.head.peel(pygit2.Commit)
 
 
+@pytest.mark.slow
+def test_import_multiple_streams(data_archive, chdir, cli_runner, tmp_path):
+    TABLES = ["counties", "countiestbl"]
+
+    with data_archive("gpkg-points") as points_data, data_archive(
+        "gpkg-spec"
+    ) as spec_data:
+        results = []
+        for num_streams in (1, 2):
+            repo_path = tmp_path / f"data-{num_streams}.sno"
+            repo_path.mkdir()
+
+            with chdir(repo_path):
+                r = cli_runner.invoke(["init"])
+                assert r.exit_code == 0, r
+                r = cli_runner.invoke(
+                    ["import", points_data / "nz-pa-points-topo-150k.gpkg"]
+                )
+                assert r.exit_code == 0, r
+
+                repo = SnoRepo(repo_path)
+                orig_commit = repo.head.peel(pygit2.Commit)
+
+                r = cli_runner.invoke(
+                    [
+                        "import",
+                        f"GPKG:{spec_data / 'sample1_2.gpkg'}",
+                        f"--streams={num_streams}",
+                        *TABLES,
+                    ]
+                )
+                assert r.exit_code == 0, r
+
+                # A single commit, on top of the existing commit.
+                commit = repo.head.peel(pygit2.Commit)
+                assert commit.parent_ids == [orig_commit.id]
+                assert repo.head.name == "refs/heads/master"
+                assert len(list(repo.references)) == 1
+
+                rs = structure.RepositoryStructure(repo)
+                assert sorted(ds.path for ds in rs) == sorted([H.POINTS.LAYER, *TABLES])
+                # The existing dataset is untouched.
+                assert rs[H.POINTS.LAYER].tree == orig_commit.tree / H.POINTS.LAYER
+                results.append(
+                    {t: {f["fid"]: f for f in rs[t].features()} for t in TABLES}
+                )
+
+        assert results[0] == results[1]
+
+
+def test_import_multiple_streams_unsupported(
+    data_archive, chdir, cli_runner, tmp_path, monkeypatch
+):
+    def _reopen(self):
+        raise NotImplementedError()
+
+    monkeypatch.setattr(OgrImportSource, "reopen", _reopen)
+    with data_archive("gpkg-spec") as spec_data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            r = cli_runner.invoke(
+                [
+                    "import",
+                    f"GPKG:{spec_data / 'sample1_2.gpkg'}",
+                    "--streams=2",
+                    "counties",
+                    "countiestbl",
+                ]
+            )
+            assert r.exit_code == 0, r
+            assert "can't be read concurrently" in r.stderr
+
+            rs = structure.RepositoryStructure(SnoRepo(repo_path))
+            assert sorted(ds.path for ds in rs) == ["counties", "countiestbl"]
+
+
+def test_import_multiple_streams_error(
+    data_archive, chdir, cli_runner, tmp_path, monkeypatch
+):
+    orig_import_single_source = fast_import._import_single_source
+    stopped = []
+
+    def _import_single_source(repo, stream, source, *args, stop_event, **kwargs):
+        if source.dest_path == "counties":
+            raise ValueError("Couldn't read counties")
+        # The other stream stops as soon as the first one fails.
+        assert stop_event.wait(timeout=30)
+        try:
+            return orig_import_single_source(
+                repo, stream, source, *args, stop_event=stop_event, **kwargs
+            )
+        except Exception as e:
+            stopped.append(e)
+            raise
+
+    monkeypatch.setattr(fast_import, "_import_single_source", _import_single_source)
+    with data_archive("gpkg-spec") as spec_data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            sources = [
+                OgrImportSource.open(spec_data / "sample1_2.gpkg", table=table)
+                for table in ("counties", "countiestbl")
+            ]
+            with pytest.raises(ValueError, match="Couldn't read counties"):
+                fast_import.fast_import_tables(repo, sources, num_streams=2)
+
+            assert [type(e).__name__ for e in stopped] == ["_ImportStopped"]
+            assert repo.head_is_unborn
+            assert not list(repo.references)
+
+
 @pytest.mark.slow
 @pytest.mark.parametrize(*GPKG_IMPORTS)
 @pytest.mark.parametrize(*V1_OR_V2)
@@ -910,3 +1570,412 @@ def test_fast_import(repo_version, data_archive, tmp_path, cli_runner, chdir):
             # has the right number of features
             feature_count = sum(1 for f in dataset.features())
             assert feature_count == source.feature_count
+
+
+def test_fast_import_unknown_feature_count(
+    data_archive, tmp_path, cli_runner, chdir, monkeypatch, capsys
+):
+    table = H.POINTS.LAYER
+    # Features are counted while they are imported, when the source can't count them cheaply.
+    monkeypatch.setattr(OgrImportSource, "estimated_feature_count", None)
+
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            capsys.readouterr()
+            feature_counts = fast_import.fast_import_tables(repo, [source])
+
+        assert feature_counts == {table: H.POINTS.ROWCOUNT}
+        output = capsys.readouterr().out
+        assert "Importing all features" in output
+        assert f"Added {H.POINTS.ROWCOUNT:,d} Features" in output
+
+
+@pytest.mark.slow
+def test_fast_import_parallel(data_archive, tmp_path, cli_runner, chdir, monkeypatch):
+    table = H.POINTS.LAYER
+    # Make sure the features are split over several batches.
+    monkeypatch.setattr(Dataset2, "ENCODE_BATCH_SIZE", 100)
+
+    with data_archive("gpkg-points") as data:
+        # The same source is imported each time, so the same column IDs are used.
+        source = OgrImportSource.open(data / "nz-pa-points-topo-150k.gpkg", table=table)
+        tree_ids = []
+        for num_workers in (1, 3):
+            repo_path = tmp_path / f"data-{num_workers}.sno"
+            repo_path.mkdir()
+
+            with chdir(repo_path):
+                r = cli_runner.invoke(["init"])
+                assert r.exit_code == 0, r
+
+                repo = SnoRepo(repo_path)
+                fast_import.fast_import_tables(repo, [source], num_workers=num_workers)
+                tree_ids.append(repo.head.peel(pygit2.Tree).id)
+
+        # Encoding in parallel gives exactly the same result.
+        assert tree_ids[0] == tree_ids[1]
+
+
+def test_native_import_error(data_archive, tmp_path, cli_runner, chdir, monkeypatch):
+    def _finish(self):
+        raise ValueError("Couldn't write the pack")
+
+    monkeypatch.setattr(NativeImport, "_finish", _finish)
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+            repo.config["sno.import.backend"] = "native"
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=H.POINTS.LAYER
+            )
+            # The cause of the failure reaches the caller.
+            with pytest.raises(ValueError, match="Couldn't write the pack"):
+                fast_import.fast_import_tables(repo, [source])
+            assert repo.head_is_unborn
+
+
+@pytest.mark.parametrize(
+    "option",
+    [["--streams=2"], ["--checkpoint-interval=1000"]],
+    ids=["streams", "checkpoint-interval"],
+)
+def test_native_import_unsupported_options(
+    option, data_archive, tmp_path, cli_runner, chdir
+):
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+            repo.config["sno.import.backend"] = "native"
+
+            r = cli_runner.invoke(
+                ["import", data / "nz-pa-points-topo-150k.gpkg", "--all-tables"]
+                + option
+            )
+            assert r.exit_code == 2, r
+            assert "isn't supported by the native import backend" in r.stderr
+            assert repo.head_is_unborn
+
+
+def test_import_v3_checkpoints_unsupported(data_archive, tmp_path, cli_runner, chdir):
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init", "--repo-version", "3"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            r = cli_runner.invoke(
+                [
+                    "import",
+                    data / "nz-pa-points-topo-150k.gpkg",
+                    "--all-tables",
+                    "--checkpoint-interval=1000",
+                ]
+            )
+            assert r.exit_code == 2, r
+            assert "isn't supported for V3 repositories" in r.stderr
+            assert repo.head_is_unborn
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "backend",
+    [fast_import.ImportBackend.GIT_FAST_IMPORT, fast_import.ImportBackend.NATIVE],
+    ids=["git-fast-import", "native"],
+)
+def test_fast_import_backend(
+    backend, data_archive, tmp_path, cli_runner, chdir, benchmark
+):
+    table = H.POINTS.LAYER
+    benchmark.group = "test_fast_import_backend"
+
+    with data_archive("gpkg-points") as data:
+        source = OgrImportSource.open(data / "nz-pa-points-topo-150k.gpkg", table=table)
+        tree_ids = []
+        for use_backend in (fast_import.ImportBackend.GIT_FAST_IMPORT, backend):
+            repo_path = tmp_path / f"data-{len(tree_ids)}.sno"
+            repo_path.mkdir()
+
+            with chdir(repo_path):
+                r = cli_runner.invoke(["init"])
+                assert r.exit_code == 0, r
+                repo = SnoRepo(repo_path)
+                repo.config["sno.import.backend"] = use_backend.value
+
+                if len(tree_ids) == 1:
+                    benchmark.pedantic(
+                        fast_import.fast_import_tables,
+                        args=(repo, [source]),
+                        rounds=1,
+                        iterations=1,
+                    )
+                else:
+                    fast_import.fast_import_tables(repo, [source])
+
+                assert repo.head.name == "refs/heads/master"
+                assert len(list(repo.references)) == 1
+                assert len([c for c in repo.walk(repo.head.target)]) == 1
+                tree_ids.append(repo.head.peel(pygit2.Tree).id)
+
+                # Importing on top of an existing commit.
+                r = cli_runner.invoke(
+                    ["import", data / "nz-pa-points-topo-150k.gpkg", f"{table}:copy"]
+                )
+                assert r.exit_code == 0, r
+                assert len([c for c in repo.walk(repo.head.target)]) == 2
+                rs = structure.RepositoryStructure(repo)
+                assert rs["copy"].feature_count == source.feature_count
+
+        # Both backends write exactly the same tree.
+        assert tree_ids[0] == tree_ids[1]
+
+
+def test_sort_blobs_by_path(tmp_path):
+    blobs = [
+        (f"feature/{(i * 7919) % 1000:04d}", pygit2.hash(b"%d" % i))
+        if i % 3 == 0
+        else (f"feature/{(i * 7919) % 1000:04d}", b"x" * (i % 10))
+        for i in range(1000)
+    ]
+    expected = sorted(blobs, key=lambda b: b[0])
+    # Everything fits in memory:
+    assert list(fast_import.sort_blobs_by_path(iter(blobs))) == expected
+    # Several runs are written to disk, and merged:
+    sorted_blobs = fast_import.sort_blobs_by_path(
+        iter(blobs), buffer_size=1000, tmp_dir=tmp_path
+    )
+    assert list(sorted_blobs) == expected
+
+
+def test_blob_sorter_keeps_order_of_same_path(tmp_path):
+    # As used by NativeImport - deleting a path, and then writing to it again.
+    items = [(f"dataset/{i % 10}", None if i < 10 else b"%d" % i) for i in range(30)]
+    sorter = fast_import.BlobSorter(buffer_size=40, tmp_dir=tmp_path)
+    for path, data in items:
+        sorter.add(path, data)
+    try:
+        assert list(sorter.sorted_blobs()) == sorted(items, key=lambda b: b[0])
+    finally:
+        sorter.close()
+
+
+def test_write_blobs_to_stream_dedupes():
+    blobs = [
+        ("a", b"one"),
+        ("b", b"two"),
+        ("c", b"one"),
+        ("d", b"three"),
+        ("e", b"two"),
+    ]
+    written_blobs = fast_import.WrittenBlobs(max_size=2)
+    stream = io.BytesIO()
+    for i, path in fast_import.write_blobs_to_stream(stream, blobs, written_blobs):
+        pass
+
+    one_id = pygit2.hash(b"one").hex
+    assert stream.getvalue().decode("utf8").splitlines() == [
+        "M 644 inline a",
+        "data 3",
+        "one",
+        "M 644 inline b",
+        "data 3",
+        "two",
+        f"M 644 {one_id} c",
+        "M 644 inline d",
+        "data 5",
+        "three",
+        # "two" was the least recently used, so it was forgotten when "three" was written.
+        "M 644 inline e",
+        "data 3",
+        "two",
+    ]
+    assert written_blobs.hits == 1
+
+
+def test_write_blobs_to_stream_hashed_blob(monkeypatch):
+    def _hash(data):
+        raise AssertionError("HashedBlob shouldn't be hashed again")
+
+    blob = HashedBlob.of(b"one")
+    monkeypatch.setattr(pygit2, "hash", _hash)
+    written_blobs = fast_import.WrittenBlobs()
+    stream = io.BytesIO()
+    for i, path in fast_import.write_blobs_to_stream(
+        stream, [("a", blob), ("b", blob)], written_blobs
+    ):
+        pass
+
+    assert stream.getvalue().decode("utf8").splitlines() == [
+        "M 644 inline a",
+        "data 3",
+        "one",
+        f"M 644 {blob.id.hex} b",
+    ]
+
+
+@pytest.mark.slow
+def test_fast_import_sort_by_path(data_archive, tmp_path, cli_runner, chdir):
+    table = H.POINTS.LAYER
+    with data_archive("gpkg-points") as data:
+        source = OgrImportSource.open(data / "nz-pa-points-topo-150k.gpkg", table=table)
+        tree_ids = []
+        for sort_by_path in (False, True):
+            repo_path = tmp_path / f"data-{sort_by_path}.sno"
+            repo_path.mkdir()
+
+            with chdir(repo_path):
+                r = cli_runner.invoke(["init"])
+                assert r.exit_code == 0, r
+                repo = SnoRepo(repo_path)
+                fast_import.fast_import_tables(
+                    repo, [source], sort_by_path=sort_by_path
+                )
+                tree_ids.append(repo.head.peel(pygit2.Tree).id)
+
+        # The order the features are written in makes no difference to the result.
+        assert tree_ids[0] == tree_ids[1]
+
+
+@pytest.mark.slow
+def test_fast_import_resume(data_archive, tmp_path, cli_runner, chdir):
+    table = H.POINTS.LAYER
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            orig_feature_tuples = source.feature_tuples
+
+            def _interrupted_features():
+                yield from itertools.islice(orig_feature_tuples(), 1050)
+                raise RuntimeError("Interrupted!")
+
+            source.feature_tuples = _interrupted_features
+            with pytest.raises(RuntimeError):
+                fast_import.fast_import_tables(repo, [source], checkpoint_interval=500)
+
+            assert repo.head_is_unborn
+            resume_path = repo.gitdir_path / "IMPORT_RESUME"
+            assert resume_path.exists()
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            fast_import.fast_import_tables(repo, [source], resume=True)
+
+            assert not resume_path.exists()
+            assert len(list(repo.references)) == 1
+            # has a single commit
+            assert len([c for c in repo.walk(repo.head.target)]) == 1
+
+            dataset = structure.RepositoryStructure(repo)[table]
+            assert dataset.feature_count == source.feature_count
+            pk = dataset.primary_key
+            assert {f[pk]: f for f in dataset.features()} == {
+                f[pk]: f for f in source.features()
+            }
+
+
+def test_fast_import_resume_auto_path_structure(
+    data_archive, tmp_path, cli_runner, chdir, monkeypatch
+):
+    table = H.POINTS.LAYER
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            repo = SnoRepo(repo_path)
+
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            orig_feature_tuples = source.feature_tuples
+
+            def _interrupted_features():
+                yield from itertools.islice(orig_feature_tuples(), 1050)
+                raise RuntimeError("Interrupted!")
+
+            source.feature_tuples = _interrupted_features
+            expected_structure = PathStructure.for_feature_count(
+                source.estimated_feature_count
+            )
+            with pytest.raises(RuntimeError):
+                fast_import.fast_import_tables(
+                    repo,
+                    [source],
+                    checkpoint_interval=500,
+                    path_structure=PathStructure.AUTO,
+                )
+
+            # The estimate changes - eg, a PostgreSQL table has been analyzed since.
+            monkeypatch.setattr(
+                OgrImportSource, "estimated_feature_count", property(lambda s: 10 ** 9)
+            )
+            source = OgrImportSource.open(
+                data / "nz-pa-points-topo-150k.gpkg", table=table
+            )
+            fast_import.fast_import_tables(
+                repo, [source], resume=True, path_structure=PathStructure.AUTO
+            )
+
+            dataset = structure.RepositoryStructure(repo)[table]
+            # The resumed features are sharded the same way as those written before.
+            assert dataset.path_structure == expected_structure
+            assert dataset.feature_count == source.feature_count
+            assert len(list(dataset.get_feature_tuples([[1], [2000]]))) == 2
+
+
+def test_import_without_checkpoints(
+    data_archive, tmp_path, cli_runner, chdir, monkeypatch
+):
+    # Checkpoints are opt-in - an ordinary import never saves any resume state.
+    def _write_resume_state(repo, resume_state):
+        raise AssertionError("Resume state shouldn't be written")
+
+    monkeypatch.setattr(fast_import, "_write_resume_state", _write_resume_state)
+    with data_archive("gpkg-points") as data:
+        repo_path = tmp_path / "data.sno"
+        repo_path.mkdir()
+
+        with chdir(repo_path):
+            r = cli_runner.invoke(["init"])
+            assert r.exit_code == 0, r
+            r = cli_runner.invoke(["import", data / "nz-pa-points-topo-150k.gpkg"])
+            assert r.exit_code == 0, r
+
+            repo = SnoRepo(repo_path)
+            assert not (repo.gitdir_path / "IMPORT_RESUME").exists()
+            assert len([c for c in repo.walk(repo.head.target)]) == 1
@@ -1,6 +1,7 @@
 import json
 import pytest
 
+from sno.exceptions import INVALID_OPERATION
 from sno.sno_repo import SnoRepo
 
 
@@ -86,6 +87,41 @@ def test_upgrade_v1(archive, layer, data_archive, cli_runner, tmp_path, chdir):
         assert dest_branch == src_branch
 
 
+@pytest.mark.slow
+@pytest.mark.parametrize(
+    "archive",
+    [
+        pytest.param("points2", id="points"),
+        pytest.param("polygons2", id="polygons-pk"),
+        pytest.param("table2", id="table"),
+    ],
+)
+def test_upgrade_v2_to_v3(archive, data_archive, cli_runner, tmp_path, chdir):
+    with data_archive(archive) as source_path:
+        r = cli_runner.invoke(["diff", "-o", "json", "HEAD^...HEAD"])
+        assert r.exit_code == 0, r.stderr
+        src_diff = json.loads(r.stdout)
+
+        r = cli_runner.invoke(["upgrade", source_path, tmp_path / "dest"])
+        assert r.exit_code == INVALID_OPERATION, r.stderr
+        assert "already at version 2" in r.stderr
+
+        r = cli_runner.invoke(
+            ["upgrade", "--repo-version=3", source_path, tmp_path / "dest"]
+        )
+        assert r.exit_code == 0, r.stderr
+        assert r.stdout.splitlines()[-1] == "Upgrade complete"
+
+    with chdir(tmp_path / "dest"):
+        r = cli_runner.invoke(["data", "version", "-o", "json"])
+        assert r.exit_code == 0, r.stderr
+        assert json.loads(r.stdout) == {"sno.data.version": 3}
+
+        r = cli_runner.invoke(["diff", "-o", "json", "HEAD^...HEAD"])
+        assert r.exit_code == 0, r.stderr
+        assert json.loads(r.stdout) == src_diff
+
+
 @pytest.mark.parametrize(
     "archive,layer",
     [